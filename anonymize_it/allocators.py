@@ -0,0 +1,226 @@
+import hashlib
+import json
+import math
+import uuid
+
+from fakers import variant_providers
+
+
+class AllocatorError(Exception):
+    pass
+
+
+def fake_key(fake):
+    # fakes are compared by their json encoding, which is also how mapping stores keep them
+    return json.dumps(fake)
+
+
+class IssuedSet:
+    def __init__(self):
+        """exact membership of the fakes issued during this run, held in memory"""
+        self.keys = set()
+
+    def claim(self, key):
+        """marks key as issued, returning False if it already was"""
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        return True
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class SharedIssuedSet:
+    def __init__(self, proxy):
+        """membership of issued fakes shared between worker processes through a multiprocessing manager
+
+        claims use setdefault on the manager, so two workers can never both claim the same fake.
+
+        :param proxy: a DictProxy created by multiprocessing.Manager().dict()
+        """
+        self.proxy = proxy
+        self.token = uuid.uuid4().hex
+        self.local = set()
+
+    def claim(self, key):
+        if key in self.local:
+            return False
+        self.local.add(key)
+        return self.proxy.setdefault(key, self.token) == self.token
+
+    def __len__(self):
+        return len(self.proxy)
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        """a bloom filter sized to hold capacity keys with the given false positive rate"""
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.__positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+
+class SQLiteIssuedSet:
+    def __init__(self, connection, table, capacity=1000000, error_rate=0.001, deferred=False):
+        """membership of issued fakes checked against the masks in a mapping store's sqlite table
+
+        a bloom filter answers most checks in memory, and only fakes it may have seen are looked up in the table. the
+        filter holds every mask in the table, so fakes issued by earlier runs are never reissued. it is saved to the
+        database with the rowid of the last mask it holds, so a later run only reads the masks added since rather
+        than the whole table. a table with no saved filter, or one outgrowing it, is read once into a filter sized
+        for twice the masks it holds.
+
+        :param connection: the sqlite3 connection of the mapping store
+        :param table: the mapping store's table for this provider type
+        :param capacity: the least number of fakes the bloom filter is sized for
+        :param error_rate: the bloom filter's false positive rate at capacity
+        :param deferred: true if the store only writes new masks to the table at the end of the run, in which case
+            fakes issued during this run are also kept in memory
+        """
+        self.connection = connection
+        self.table = table
+        self.local = set() if deferred else None
+        self.lookups = 0
+        self.scanned = 0
+        self.connection.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value TEXT)'.format(table))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS "{0}_value" ON "{0}" (value)'.format(table))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS "{}_bloom" (capacity INTEGER, error_rate REAL, '
+                                'filled INTEGER, bits BLOB)'.format(table))
+        saved = self.connection.execute('SELECT capacity, error_rate, filled, bits FROM "{}_bloom"'
+                                        .format(table)).fetchone()
+        # rowids only grow as masks are added, so the last one bounds the number of masks without counting them
+        last = self.connection.execute('SELECT MAX(rowid) FROM "{}"'.format(table)).fetchone()[0] or 0
+        if saved and saved[0] >= max(capacity, last) and saved[1] == error_rate:
+            self.capacity, _, self.filled, bits = saved
+            self.bloom = BloomFilter(self.capacity, error_rate)
+            self.bloom.bits = bytearray(bits)
+        else:
+            count = self.connection.execute('SELECT COUNT(*) FROM "{}"'.format(table)).fetchone()[0]
+            self.capacity = max(capacity, 2 * count)
+            self.bloom = BloomFilter(self.capacity, error_rate)
+            self.filled = 0
+        self.error_rate = error_rate
+        self.__fill()
+
+    def __fill(self):
+        # adds the masks written to the table since the filter was last filled
+        rows = self.connection.execute('SELECT rowid, value FROM "{}" WHERE rowid > ? ORDER BY rowid'
+                                       .format(self.table), (self.filled,))
+        for rowid, value in rows:
+            self.bloom.add(value)
+            self.filled = rowid
+            self.scanned += 1
+
+    def claim(self, key):
+        if key in self.bloom:
+            if self.local is not None and key in self.local:
+                return False
+            self.lookups += 1
+            row = self.connection.execute('SELECT 1 FROM "{}" WHERE value = ? LIMIT 1'.format(self.table),
+                                          (key,)).fetchone()
+            if row is not None:
+                return False
+        self.bloom.add(key)
+        if self.local is not None:
+            self.local.add(key)
+        return True
+
+    def save(self):
+        """saves the filter, once every mask issued so far is in the table, so a later run need not read them again"""
+        self.__fill()
+        self.connection.execute('DELETE FROM "{}_bloom"'.format(self.table))
+        self.connection.execute('INSERT INTO "{}_bloom" VALUES (?, ?, ?, ?)'.format(self.table),
+                                (self.capacity, self.error_rate, self.filled, bytes(self.bloom.bits)))
+        self.connection.commit()
+
+
+class Allocator:
+    def __init__(self, name, provider, issued, max_retries=100, variant=None):
+        """wraps a provider so that it never returns a fake it has already returned
+
+        a fake that was already issued is a collision, and the provider is asked again. after max_retries collisions
+        in a row, variants of the last fake are tried until one has not been issued. without a variant function an
+        AllocatorError is raised instead. the share of recent attempts that returned a fresh fake is tracked, and
+        while it is below one in max_retries the provider is only asked once per value before its fake is varied, so
+        a provider that has run out of fakes stops costing max_retries calls per value, and gets them back once it
+        returns fresh fakes again.
+
+        :param name: the provider type, used in errors and stats
+        :param provider: the provider to allocate fakes from
+        :param issued: the set of issued fakes, with a claim method
+        :param max_retries: the number of collisions in a row before varying fakes instead
+        :param variant: a callable taking a fake and a number n and returning the nth variant of the fake
+        """
+        self.name = name
+        self.provider = provider
+        self.issued = issued
+        self.max_retries = max_retries
+        self.variant = variant
+        # a moving average of the share of attempts returning a fresh fake, over about the last max_retries attempts
+        self.fresh = 1.0
+        self.decay = 1.0 / max_retries
+        self.allocated = 0
+        self.collisions = 0
+        self.varied = 0
+
+    def __call__(self, value):
+        attempts = self.max_retries if self.fresh * self.max_retries >= 1 else 1
+        for _ in range(attempts):
+            fake = self.provider(value)
+            if self.issued.claim(fake_key(fake)):
+                self.allocated += 1
+                self.fresh += self.decay * (1 - self.fresh)
+                return fake
+            self.collisions += 1
+            self.fresh -= self.decay * self.fresh
+        variant = self.variant
+        if variant is None:
+            raise AllocatorError("unable to allocate a unique {} after {} attempts".format(self.name, attempts))
+        # counting from the number allocated so far makes it likely the first variant tried is free
+        n = self.allocated
+        candidate = variant(fake, n)
+        while not self.issued.claim(fake_key(candidate)):
+            self.collisions += 1
+            n += 1
+            candidate = variant(fake, n)
+        self.allocated += 1
+        self.varied += 1
+        return candidate
+
+    def stats(self):
+        return {
+            "allocated": self.allocated,
+            "collisions": self.collisions,
+            "varied": self.varied
+        }
+
+
+def create_allocators(provider_map, issued_sets, max_retries=100, exclude=("message",)):
+    """wraps every provider with an issued set in an Allocator, returning the providers to mask with
+
+    :param provider_map: a dict of provider type to provider
+    :param issued_sets: a dict of provider type to issued set, see create_issued_sets on the mapping stores
+    :param max_retries: the number of collisions in a row before fakes are varied
+    :param exclude: provider types whose fakes need not be unique, e.g. messages masked in place
+    """
+    masks = {}
+    for name, provider in provider_map.items():
+        if name in exclude:
+            masks[name] = provider
+        else:
+            masks[name] = Allocator(name, provider, issued_sets[name], max_retries, variant_providers.get(name))
+    return masks
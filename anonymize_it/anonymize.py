@@ -22,6 +22,9 @@ if __name__ == "__main__":
     config_file = sys.argv[1]
     config = read_config(config_file)
     config = utils.parse_config(config)
+    # --profile profiles a run with the default settings, without editing its config
+    if "--profile" in sys.argv[2:] and config.profiling is None:
+        config = config._replace(profiling={})
 
     for conf in config._fields:
         logging.info("{} = {}".format(conf, getattr(config, conf)))
@@ -35,7 +38,12 @@ if __name__ == "__main__":
     writer = writer(config.dest['params'])
 
     logging.info("configuring anonymizer...")
-    anon = anonymizer_mapping[config.anonymizer](reader=reader, writer=writer)
+    anon = anonymizer_mapping[config.anonymizer](reader=reader, writer=writer, workers=config.workers,
+                                                 masking=config.masking, mapping_store=config.mapping_store,
+                                                 codec=config.codec, pipeline=config.pipeline,
+                                                 scrubbing=config.scrubbing, metrics=config.metrics,
+                                                 profiling=config.profiling, checkpoint=config.checkpoint,
+                                                 incremental=config.incremental)
 
     logging.info("performing anonymization...")
     anon.anonymize(infer=True, include_rest=config.include_rest)
@@ -1,14 +1,33 @@
 import collections
-
+import glob
+import multiprocessing
+import os
+import random
+import secrets
+import time
+
+import numpy as np
 from faker import Faker
 import warnings
+import allocators
+import fakers
 import readers
 import writers
+import mappings
 import utils
-import json
+import json_codecs
+import pipeline
+import pools
 import logging
 
-from fakers import geo_point, geo_point_key, ipv4, file_path, message, message_key, service_name, username
+from ip_masking import PrefixPreservingIP
+from checkpoints import create_checkpointer
+from manifests import create_manifest
+from metrics import create_metrics
+from profiling import create_profiler
+from scrubbing import MessageScrubber
+from fakers import email, geo_point, geo_point_key, ipv4, file_path, keyed, message_key, service_name, username, uuid
+from mappings import SharedMappingStore
 
 
 class AnonymizerError(Exception):
@@ -23,8 +42,14 @@ class WriterError(Exception):
     pass
 
 
+# documents written to each output file. checkpoints are taken between output files
+documents_per_file = 100000
+
+
 class Anonymizer:
-    def __init__(self, reader=None, writer=None, field_maps={}):
+    def __init__(self, reader=None, writer=None, field_maps={}, workers=1, masking=None, mapping_store=None,
+                 codec=None, pipeline=None, scrubbing=None, metrics=None, profiling=None, checkpoint=None,
+                 incremental=None):
         """a prepackaged anonymizer class
 
         an anonymizer is responsible for grabbing data from the source datastore,
@@ -35,6 +60,29 @@ class Anonymizer:
         :param reader: an instantiated reader
         :param writer: an instantiated writer
         :param field_maps: a dict like {'field.name': 'mapping_type'}
+        :param workers: number of processes to anonymize with. only supported by anonymizers with file based readers
+        :param masking: a dict like {'mode': 'keyed', 'secret': '...'}. keyed masks are derived from an HMAC of each
+            value rather than looked up in a map, so they are stable across runs and processes. with
+            {'mode': 'pool', 'batch_size': 10000} masks are mapped as usual but drawn from pools of unique fakes
+            generated in bulk
+        :param mapping_store: a dict like {'type': 'sqlite', 'cache_size': 100000} selecting where masks are kept.
+            defaults to keeping every mask in memory
+        :param codec: the name of the json codec used to decode and encode documents, one of json, ujson or orjson
+        :param pipeline: a dict like {'queue_size': 2}. if set, documents are read and batches are written on
+            background threads connected to masking by queues of queue_size
+        :param scrubbing: a dict like {'detectors': {'ipv4': 'ipv4', 'email': 'email'}} naming the detectors run over
+            message fields and the provider type masking each detector's matches
+        :param metrics: a dict like {'sinks': [{'type': 'log'}, {'type': 'json', 'path': 'stats.json'}]}. if set,
+            counters and timings of each stage, field and mapping are reported to the sinks as the run progresses
+        :param profiling: a dict like {'docs': 10000, 'path': 'anonymize.pstats'}. if set, the first docs documents or
+            seconds of the run are profiled, and the time spent per stage, provider and function is logged when the
+            run completes
+        :param checkpoint: a dict like {'path': 'anonymize.checkpoint', 'interval': 60}. if set, the lazy anonymizer
+            saves its progress between output files at most every interval seconds, and a run started with the same
+            path resumes from the last checkpoint, giving values seen before the same masks
+        :param incremental: a dict like {'path': 'anonymize.manifest'}. if set, the lazy anonymizer records the input
+            files read in a manifest, and later runs only read files, or the part of files, not read before. requires
+            keyed masking or a mapping_store with a path, so values keep their masks from one run to the next
         """
 
         # add provider mappings here. these should map strings from the config to Faker providers
@@ -42,7 +90,8 @@ class Anonymizer:
             "file_path": file_path,
             "ipv4": ipv4,
             "geo_point": geo_point,
-            "message": message,
+            "email": email,
+            "uuid": uuid,
             "service": service_name,
             "username": username
         }
@@ -52,9 +101,63 @@ class Anonymizer:
             "message": message_key
         }
 
+        # providers that compute each mask from the value alone, so they need no map of masks or allocator
+        self.computed_providers = {"ip", "message"}
+
         self.field_maps = field_maps
         self.reader = reader
         self.writer = writer
+        self.workers = workers or 1
+        self.masking = masking or {}
+        self.keyed = self.masking.get('mode') == 'keyed'
+        self.mapping_store = mapping_store or {}
+        self.store = None
+        self.masks = self.provider_map
+        self.allocation_stats = {}
+        self.codec = json_codecs.get_codec(codec)
+        self.pipeline = pipeline
+        self.scrubbing = scrubbing or {}
+        self.metrics_params = metrics
+        self.metrics = create_metrics(metrics)
+        self.profiling = profiling
+        self.profiler = create_profiler(profiling)
+        self.profile_report = None
+        self.type_maps = {}
+        self.manifest = create_manifest(incremental)
+        self.input_files = None
+        if self.manifest and not self.keyed and not self.mapping_store.get('path'):
+            raise AnonymizerError("incremental runs require stable masks, use keyed masking or a mapping_store with "
+                                  "a path")
+        self.checkpointer = create_checkpointer(checkpoint)
+        self.resume_state = self.checkpointer.load() if self.checkpointer else None
+        # masks are kept in the checkpoint's file unless the store keeps them somewhere already
+        self.checkpoint_masks = bool(self.checkpointer and not self.keyed and not self.mapping_store.get('path'))
+        if self.checkpoint_masks:
+            self.mapping_store = dict(self.mapping_store, path=self.checkpointer.masks_path)
+
+        if self.keyed:
+            if not self.masking.get('secret'):
+                raise AnonymizerError("keyed masking requires a secret")
+            cache_size = self.masking.get('cache_size', 100000)
+            self.provider_map = {name: keyed(provider, self.masking['secret'], cache_size)
+                                 for name, provider in self.provider_map.items()}
+        elif self.masking.get('mode') == 'pool':
+            self.provider_map = pools.create_pools(self.provider_map, self.masking.get('batch_size', 10000))
+        self.generated_secret = not self.masking.get('secret')
+        if self.generated_secret:
+            # without a secret, ip masks are consistent within a run and its workers but not across runs, other than
+            # runs resumed from a checkpoint, which keeps the secret
+            secret = (self.resume_state or {}).get('secret') or secrets.token_hex(32)
+            self.masking = dict(self.masking, secret=secret)
+            if self.manifest:
+                logging.warning("without a masking secret ip masks differ from those of earlier incremental runs")
+        self.provider_map["ip"] = PrefixPreservingIP(self.masking['secret'])
+        # values found in messages are masked like the structured fields of their detector's provider type
+        self.provider_map["message"] = MessageScrubber(self.mask_value, self.scrubbing.get('detectors'))
+        for detector, mask_str in self.provider_map["message"].types.items():
+            if mask_str not in self.provider_map or mask_str == "message":
+                raise AnonymizerError("detector {} masks with unknown provider {}".format(detector, mask_str))
+        self.masks = self.provider_map
 
         self.source = None
         self.dest = None
@@ -96,6 +199,20 @@ class Anonymizer:
 
         self.writer = writer(dest_params)
 
+    def mask_value(self, mask_str, value):
+        """returns the mask of a value, consistent with every other value of the same provider type"""
+        mask = self.masks[mask_str]
+        type_map = self.type_maps.get(mask_str)
+        if type_map is None:
+            return mask(value)
+        if not value in type_map:
+            type_map[value] = mask(value)
+        return type_map[value]
+
+    def mapped_types(self):
+        """the provider types whose masks are kept in a map"""
+        return [key for key in self.provider_map.keys() if key not in self.computed_providers]
+
     def anonymize(self, infer=False, include_rest=False):
         """this is the core method for anonymizing data
 
@@ -103,30 +220,65 @@ class Anonymizer:
         we define mappings of unmasked values to masked values, and anonymize fields using self.faker
         """
 
+        if self.checkpointer:
+            raise AnonymizerError("checkpoints require the lazy anonymizer and a file based reader")
+        if self.manifest:
+            raise AnonymizerError("incremental runs require the lazy anonymizer and a file based reader")
+
         # first, infer mappings based on indices and overwrite the config.
         if infer:
             self.reader.infer_providers()
 
-        # next, create masking maps that will be used for lookups when anonymizing data
-        self.field_maps = self.reader.create_mappings()
-
-        for field, map in self.field_maps.items():
+        # the writer is prepared once for the whole run, e.g. to pause index refreshes, and closed even if it fails
+        # documents are written after their bulk actions, see __anonymize
+        self.writer.prepare(actions=True)
+        try:
+            return self.__anonymize(include_rest)
+        finally:
+            self.writer.close()
+
+    def __anonymize(self, include_rest):
+        if self.profiler:
+            self.profiler.start()
+
+        # masks are shared per provider type through the mapping store, which may hold masks from earlier runs
+        if not self.keyed:
+            self.store = mappings.create_store(self.mapping_store)
+            self.type_maps = self.store.create_field_maps(self.mapped_types())
+        self.create_masks()
+        if self.metrics:
+            self.metrics.start()
+
+        # next, create masking maps that will be used for lookups when anonymizing data. each field's values are
+        # masked as soon as they are fetched, while the values of later fields are still being fetched
+        self.field_maps = {}
+        for field, map in self.reader.iter_mappings():
+            self.field_maps[field] = map
+            mask_str = self.reader.masked_fields[field]
+            if mask_str == 'infer':
+                continue
+            start = time.perf_counter()
             for value, _ in map.items():
-                mask_str = self.reader.masked_fields[field]
-                if mask_str != 'infer':
-                    mask = self.provider_map[mask_str]
-                    map[value] = mask(value)
+                map[value] = self.mask_value(mask_str, value)
+            if self.metrics:
+                self.metrics.add_field(field, mask_str, len(map), time.perf_counter() - start)
+        self.close_store()
+        self.type_maps = {}
 
         # get generator object from reader
         total = self.reader.get_count()
         logging.info("total number of records {}...".format(total))
 
         data = self.reader.get_data(list(self.field_maps.keys()), self.reader.suppressed_fields, include_rest)
+        if self.metrics:
+            data = self.metrics.timed(data, "read")
+        if self.profiler:
+            data = self.profiler.limit(data)
 
         # batch process the data and write out to json in chunks
         count = 0
         for batchiter in utils.batch(data, 10000):
-            tmp = []
+            self.writer.open_file()
             for item in batchiter:
                 bulk = {
                     "index": {
@@ -134,39 +286,103 @@ class Anonymizer:
                         "_type": 'doc'
                     }
                 }
-                tmp.append(json.dumps(bulk))
+                self.writer.write_document(self.codec.encode(bulk))
                 item = utils.flatten_nest(item.to_dict())
                 for field, v in item.items():
                     if self.field_maps[field]:
                         item[field] = self.field_maps[field][item[field]]
-                tmp.append(json.dumps(utils.flatten_nest(item)))
-            self.writer.write_data(tmp)
-            count += len(tmp) / 2 # There is a bulk row for every document
-            logging.info("{} % complete...".format(count/total * 100))
+                self.writer.write_document(self.codec.encode(utils.flatten_nest(item)))
+                count += 1
+            self.writer.close_file()
+            if total:
+                logging.info("{:.1f} % complete...".format(count / total * 100))
+            if self.metrics:
+                self.metrics.counters["docs"] = count
+                self.metrics.emit()
+        if self.metrics:
+            self.metrics.emit(final=True)
+        self.report_profile()
+        return count
+
+    def report_profile(self):
+        if self.profiler and self.profiler.reporting:
+            self.profile_report = self.profiler.report()
+
+    def create_masks(self):
+        """wraps the providers in allocators so that distinct values of a provider type are never given the same fake
+
+        fakes are checked against those already issued by the mapping store. keyed masks are derived from each value
+        rather than stored, so there is nothing to check them against and the providers are used as they are.
+        """
+        if self.keyed:
+            self.masks = self.provider_map
+            return self.masks
+        types = self.mapped_types()
+        if self.store:
+            issued_sets = self.store.create_issued_sets(types)
+        else:
+            issued_sets = {key: allocators.IssuedSet() for key in types}
+        self.masks = allocators.create_allocators(self.provider_map, issued_sets, self.masking.get('max_retries', 100),
+                                                  exclude=self.computed_providers)
+        return self.masks
+
+    def close_store(self):
+        for mask_str, mask in self.masks.items():
+            if isinstance(mask, allocators.Allocator):
+                self.allocation_stats[mask_str] = mask.stats()
+                logging.info(f"{mask_str} allocation {mask.stats()}")
+        logging.info(f"message scrubbing {self.provider_map['message'].stats()}")
+        self.masks = self.provider_map
+        if self.metrics:
+            self.metrics.add_mappings(self.allocation_stats)
+        if not self.store:
+            return
+        store_stats = self.store.stats()
+        for mask_str, stats in store_stats.items():
+            logging.info(f"{mask_str} mapping {stats}")
+        if self.metrics:
+            self.metrics.add_mappings(store_stats)
+        self.store.close()
+        self.store = None
+
+
+def _anonymize_shard(shard, filepath, byte_range, writer_class, writer_params, masked_fields, suppressed_fields,
+                     include_rest, masking, codec, pipeline, scrubbing, metrics, profiling, shared):
+    # runs in a worker process: each shard is an input file, or a byte range of one, written to its own numbered set
+    # of output files. a byte range is read through the worker's own memory map of the file, so no data is copied
+    # between processes
+    #
+    # forked workers inherit the parent's random state, so without reseeding every worker generates the same fakes
+    # and they spend their time colliding with each other's
+    fakers.faker.seed_instance(int.from_bytes(os.urandom(8), 'big'))
+    random.seed()
+    np.random.seed()
+    reader = readers.JSONFileReader({"filepath": glob.escape(filepath), "byte_range": byte_range}, masked_fields,
+                                    suppressed_fields)
+    writer = writer_class(writer_params)
+    anon = LazyAnonymizer(reader=reader, writer=writer, masking=masking, codec=codec, pipeline=pipeline,
+                          scrubbing=scrubbing, metrics=metrics, profiling=profiling)
+    if shared:
+        anon.store = SharedMappingStore(*shared)
+    count = anon.anonymize(include_rest=include_rest, file_name="documents-{}-%s".format(shard))
+    return (count, anon.allocation_stats, anon.metrics.snapshot() if anon.metrics else None,
+            anon.profiler.snapshot() if anon.profiler else None)
 
 
 class LazyAnonymizer(Anonymizer):
-    def __init__(self, reader=None, writer=None, field_maps={}):
-        super().__init__(reader, writer, field_maps)
+    def __init__(self, reader=None, writer=None, field_maps={}, workers=1, masking=None, mapping_store=None,
+                 codec=None, pipeline=None, scrubbing=None, metrics=None, profiling=None, checkpoint=None,
+                 incremental=None):
+        super().__init__(reader, writer, field_maps, workers, masking, mapping_store, codec, pipeline, scrubbing,
+                         metrics, profiling, checkpoint, incremental)
+
+    def mask_value(self, mask_str, value):
+        return self.__anon_field_value(mask_str, value)
 
     # required as dictionary can be
     def __generate_field_map_key(self):
         pass
 
-    def __delete_field_in_place(self, doc, field_path):
-        if len(field_path) > 1:
-            if field_path[0] in doc and  isinstance(doc[field_path[0]], collections.MutableMapping):
-                deleted = self.__delete_field_in_place(doc[field_path[0]], field_path[1:])
-                if deleted:
-                    #check for empty key
-                    if not doc[field_path[0]]:
-                        del doc[field_path[0]]
-                return deleted
-        elif len(field_path) == 1:
-            if field_path[0] in doc:
-                del doc[field_path[0]]
-                return True
-
     def __anon_field_value(self, mask_str, value):
         if not mask_str:
             return value
@@ -181,84 +397,343 @@ class LazyAnonymizer(Anonymizer):
                 list = True
             else:
                 mask_keys = [value]
-        mask = self.provider_map[mask_str]
+        mask = self.masks[mask_str]
+        if list and field_map is None and hasattr(mask, 'mask_batch'):
+            return mask.mask_batch(mask_keys)
         masked_values = []
         for mask_key in mask_keys:
-            if mask_key:
+            if not mask_key:
+                masked_values.append(mask(value))
+            elif field_map is None:
+                # keyed and computed masks are derived from the key itself so there is nothing to look up
+                masked_values.append(mask(mask_key))
+            else:
                 if not mask_key in field_map:
-                    field_map[mask_key] = mask(value)
+                    field_map[mask_key] = mask(mask_key)
                 masked_values.append(field_map[mask_key])
-            else:
-                masked_values.append(mask(value))
         if not list:
             return masked_values[0]
         return masked_values
 
+    def __timed_field_value(self, node, value):
+        start = time.perf_counter()
+        masked = self.__anon_field_value(node.mask_str, value)
+        values = len(value) if isinstance(value, collections.MutableSequence) else 1
+        self.metrics.add_field(node.field, node.mask_str, values, time.perf_counter() - start)
+        return masked
+
     # used when we want to keep most fields i.e. include_rest=True. Copying every field more expensive than modifying those that need to be changed
-    def __anon_field_in_place(self, doc, field_path, mask_str):
-        if len(field_path) > 1:
-            if field_path[0] in doc and isinstance(doc[field_path[0]], collections.MutableMapping):
-                self.__anon_field_in_place(doc[field_path[0]], field_path[1:], mask_str)
-        elif len(field_path) == 1:
-            if field_path[0] in doc:
-                doc[field_path[0]] = self.__anon_field_value(mask_str, doc[field_path[0]])
-
-    def __anon_field(self, doc, field_path, mask_str):
-        new_field = {}
-        if len(field_path) > 1:
-            if field_path[0] in doc and isinstance(doc[field_path[0]], collections.MutableMapping):
-                new_value = self.__anon_field(doc[field_path[0]], field_path[1:], mask_str)
-                # field may not exist, dont create empty entries
-                if not isinstance(new_value, collections.MutableMapping) or new_value:
-                    new_field.update({
-                        field_path[0]: new_value
-                    })
-        elif len(field_path):
-            if field_path[0] in doc:
-                return {
-                    field_path[0]: self.__anon_field_value(mask_str, doc[field_path[0]])
-                }
-        return new_field
-
-    def __anon_doc_include_all(self, doc, mask_fields, exclude, sep='.'):
-        for field, mask_str in mask_fields.items():
-            if not field in exclude:
-                # update doc in place as we want all the other fields
-                self.__anon_field_in_place(doc, field.split(sep), mask_str)
-        for field in exclude:
-            self.__delete_field_in_place(doc, field.split(sep))
-        return doc
+    def __anon_fields_in_place(self, doc, plan):
+        deleted = False
+        for key, node in plan.items():
+            if not key in doc:
+                continue
+            if node.excluded:
+                del doc[key]
+                deleted = True
+                continue
+            value = doc[key]
+            if node.children and isinstance(value, collections.MutableMapping):
+                if self.__anon_fields_in_place(value, node.children) and not value:
+                    # check for empty key left behind by excluded fields
+                    del doc[key]
+                    deleted = True
+                    continue
+            if node.included:
+                if self.metrics is None:
+                    doc[key] = self.__anon_field_value(node.mask_str, value)
+                else:
+                    doc[key] = self.__timed_field_value(node, value)
+        return deleted
 
-    def __anon_doc(self, doc, mask_fields, exclude, sep='.'):
+    def __anon_fields(self, doc, plan):
         new_doc = {}
-        for field, mask_str in mask_fields.items():
-            if not field in exclude:
-                new_doc.update(self.__anon_field(doc, field.split(sep), mask_str))
-        for field in exclude:
-            self.__delete_field_in_place(new_doc, field.split(sep))
+        for key, node in plan.items():
+            if node.excluded or not key in doc:
+                continue
+            value = doc[key]
+            if node.included:
+                if node.children and isinstance(value, collections.MutableMapping):
+                    self.__anon_fields_in_place(value, node.children)
+                if self.metrics is None:
+                    new_doc[key] = self.__anon_field_value(node.mask_str, value)
+                else:
+                    new_doc[key] = self.__timed_field_value(node, value)
+            elif isinstance(value, collections.MutableMapping):
+                new_value = self.__anon_fields(value, node.children)
+                # field may not exist, dont create empty entries
+                if new_value:
+                    new_doc[key] = new_value
         return new_doc
 
-    def anonymize(self, infer=False, include_rest=True):
+    def __anon_doc_include_all(self, doc, plan):
+        # update doc in place as we want all the other fields
+        self.__anon_fields_in_place(doc, plan)
+        return doc
+
+    def __anon_doc(self, doc, plan):
+        return self.__anon_fields(doc, plan)
+
+    def __anonymize_parallel(self, include_rest):
+        if not hasattr(self.reader, 'get_shards'):
+            raise AnonymizerError("parallel anonymization requires a file based reader")
+        if not self.keyed and (self.mapping_store.get('type', 'memory') != 'memory' or self.mapping_store.get('path')):
+            raise AnonymizerError("parallel anonymization shares masks in memory, use keyed masking to bound memory "
+                                  "or reuse masks across runs")
+        shards = self.reader.get_shards(self.input_files)
+        if self.manifest:
+            shards = [("run{}-{}".format(self.manifest.run, shard), filepath, byte_range)
+                      for shard, filepath, byte_range in shards]
+        logging.info(f"anonymizing {len(shards)} shards using {self.workers} workers")
+        if self.keyed:
+            # keyed masks only depend on the value and the secret, so workers need no coordination
+            count = self.__run_shards(shards, include_rest, None)
+        else:
+            with multiprocessing.Manager() as manager:
+                # masks are shared through the manager so a value gets the same mask regardless of the worker it lands on,
+                # and so are issued fakes so two workers never give different values the same mask
+                field_maps = {key: manager.dict() for key in self.mapped_types()}
+                issued_sets = {key: manager.dict() for key in self.mapped_types()}
+                count = self.__run_shards(shards, include_rest, (field_maps, issued_sets))
+        logging.info(f"{count} documents complete")
+        return count
+
+    def __run_shards(self, shards, include_rest, shared):
+        # workers count and time without sinks, their snapshots are merged and reported here
+        shard_metrics = {"sinks": []} if self.metrics else None
+        # likewise each worker profiles the start of its own shards, and their profiles are added together
+        shard_profiling = dict(self.profiling, report=False) if self.profiler else None
+        shards = [(shard, filepath, byte_range, type(self.writer), self.writer.params, self.reader.masked_fields,
+                   self.reader.suppressed_fields, include_rest, self.masking, self.codec.type,
+                   self.pipeline, self.scrubbing, shard_metrics, shard_profiling, shared)
+                  for shard, filepath, byte_range in shards]
+        with multiprocessing.Pool(self.workers) as pool:
+            results = pool.starmap(_anonymize_shard, shards)
+        self.allocation_stats = {}
+        for _, allocation_stats, snapshot, profile in results:
+            if snapshot:
+                self.metrics.merge(snapshot)
+            if profile:
+                self.profiler.add(profile)
+            for mask_str, stats in allocation_stats.items():
+                totals = self.allocation_stats.setdefault(mask_str, collections.Counter())
+                totals.update(stats)
+        for mask_str, stats in self.allocation_stats.items():
+            logging.info(f"{mask_str} allocation {dict(stats)}")
+        return sum(result[0] for result in results)
+
+    def anonymize(self, infer=False, include_rest=True, file_name="documents-%s"):
         if infer:
             self.reader.infer_providers()
+        if self.manifest:
+            file_name = self.__start_incremental(file_name)
+        if self.checkpointer:
+            self.__start_checkpoints()
+        self.writer.prepare()
+        try:
+            count = self.__anonymize(include_rest, file_name)
+        finally:
+            self.writer.close()
+        if self.manifest:
+            # saved before the checkpoint is cleared, so a run is never read twice
+            self.manifest.save(self.manifest_entries)
+        if self.checkpointer:
+            # the run is complete once the writer has closed, and there is nothing left to resume
+            self.checkpointer.clear(masks=self.checkpoint_masks)
+            self.checkpointer.report()
+        return count
+
+    def __start_incremental(self, file_name):
+        """plans the byte ranges of the input files to read, and returns the output file names of this run"""
+        if not self.reader.resumable:
+            raise AnonymizerError("incremental runs require a file based reader")
+        state = self.resume_state
+        if state and 'manifest' in state:
+            # a run resumed from a checkpoint reads what it planned to, whatever has been written to the files since
+            self.input_files = [(file, tuple(byte_range)) for file, byte_range in state['files']]
+            self.manifest_entries = state['manifest']
+        else:
+            self.input_files, self.manifest_entries = self.manifest.plan(self.reader.get_files())
+        # outputs are numbered by run, so they do not replace those of earlier runs
+        return file_name.replace("%s", "run{}-%s".format(self.manifest.run))
+
+    def __start_checkpoints(self):
+        if self.workers > 1 or not self.reader.resumable:
+            raise AnonymizerError("checkpoints require a single worker and a file based reader")
+        if self.manifest:
+            self.checkpoint_files = [[file, list(byte_range)] for file, byte_range in self.input_files]
+        else:
+            self.checkpoint_files = self.reader.get_files()
+        # the position after every output file's documents, recorded by the reader, see __checkpoint
+        self.marks = {}
+        state = self.resume_state
+        if state is None:
+            # masks left by a run that failed before its first checkpoint belong to documents that will be masked again
+            self.checkpointer.clear(masks=self.checkpoint_masks)
+            return
+        if self.checkpoint_files[:len(state['files'])] != state['files']:
+            raise AnonymizerError("the files read have changed since checkpoint {}, remove it to start over"
+                                  .format(self.checkpointer.path))
+        index, offset = state['position']
+        logging.info("resuming from checkpoint after {} documents, at {} offset {}".format(
+            state['docs'], self.checkpoint_files[index] if index < len(self.checkpoint_files) else "the end", offset))
+
+    def __checkpoint(self, writer, count, output):
+        """saves the position after the count documents written to output files up to output, if a checkpoint is due"""
+        position = self.marks.pop(count, None)
+        if position is None or not self.checkpointer.due():
+            return
+        started = time.perf_counter()
+        # the documents and masks a checkpoint covers are durable before the checkpoint is
+        writer.flush()
+        if self.store:
+            self.store.checkpoint()
+        state = {
+            "files": self.checkpoint_files,
+            "position": position,
+            "docs": (self.resume_state or {}).get('docs', 0) + count,
+            "output": output + 1,
+            "secret": self.masking['secret'] if self.generated_secret else None
+        }
+        if self.manifest:
+            # the manifest is saved once the run completes, so a resumed run saves what this one planned
+            state["manifest"] = self.manifest_entries
+        self.checkpointer.save(state, started)
+        if self.metrics:
+            self.metrics.counters["checkpoints"] += 1
+            self.metrics.seconds["checkpoint"] += time.perf_counter() - started
+
+    def __anonymize(self, include_rest, file_name):
+        if self.metrics:
+            self.metrics.start()
+        if self.workers > 1:
+            count = self.__anonymize_parallel(include_rest)
+            if self.metrics:
+                self.metrics.emit(final=True)
+            self.report_profile()
+            return count
         # rather than a map of values per field we create a map of values per type - this ensures fields are consistently mapped across fields in a document as well as across values
-        self.field_maps = {key: {} for key in self.provider_map.keys()}
-        data = self.reader.get_data(list(self.field_maps.keys()), self.reader.suppressed_fields, include_rest)
-        exclude = set(self.reader.suppressed_fields)
+        if self.keyed:
+            self.field_maps = {key: None for key in self.provider_map.keys()}
+        elif not self.field_maps:
+            if not self.store:
+                self.store = mappings.create_store(self.mapping_store)
+            self.field_maps = dict(self.store.create_field_maps(self.mapped_types()))
+            self.field_maps.update({key: None for key in self.computed_providers})
+        self.create_masks()
+        if self.profiler:
+            self.profiler.start()
+        try:
+            count = self.__anonymize_documents(include_rest, file_name)
+        finally:
+            if self.profiler:
+                self.profiler.stop()
+            if self.store:
+                self.field_maps = {}
+            self.close_store()
+        if self.metrics:
+            self.metrics.emit(final=True)
+        self.report_profile()
+        return count
+
+    def __anonymize_documents(self, include_rest, file_name):
+        # when keeping the rest of the document, readers may return lines holding none of the masked or excluded
+        # fields as raw bytes, which are written unchanged
+        options = {}
+        if self.checkpointer:
+            options = {"start": (self.resume_state or {}).get('position'), "marks": self.marks,
+                       "mark_every": documents_per_file}
+        if self.manifest:
+            options["files"] = self.input_files
+        data = self.reader.get_data(list(self.field_maps.keys()), self.reader.suppressed_fields, include_rest,
+                                    codec=self.codec, passthrough=include_rest, metrics=self.metrics, **options)
+        if self.metrics:
+            data = self.metrics.timed(data, "read")
+        # fields are compiled once into a trie so each document is walked without splitting or slicing field paths
+        plan = utils.compile_field_plan(self.reader.masked_fields, set(self.reader.suppressed_fields))
+        if not self.pipeline:
+            if self.profiler:
+                data = self.profiler.limit(data)
+            return self.__anonymize_batches(data, self.writer, include_rest, plan, file_name)
+
+        # reading and writing run on their own threads, so a slow flush or upload overlaps with masking
+        queue_size = self.pipeline.get('queue_size', 2)
+        ahead = pipeline.read_ahead(data, queue_size)
+        # the profiler only sees the thread it was started on, so documents are counted as they reach masking
+        data = self.profiler.limit(ahead) if self.profiler else ahead
+        writer = pipeline.BackgroundWriter(self.writer, queue_size)
+        try:
+            count = self.__anonymize_batches(data, writer, include_rest, plan, file_name)
+        except BaseException:
+            writer.abort()
+            ahead.close()
+            raise
+        writer.close()
+        return count
+
+    def __anonymize_batches(self, data, writer, include_rest, plan, file_name):
+        if self.metrics:
+            return self.__anonymize_batches_timed(data, writer, include_rest, plan, file_name)
+        count = 0
+        # a resumed run carries on from the output file after the last checkpoint's
+        i = self.resume_state['output'] if self.resume_state else 0
+        for batchiter in utils.batch(data, documents_per_file):
+            # documents are streamed to the writer, so memory does not grow with the number of documents per file
+            writer.open_file(file_name % i)
+            for item in batchiter:
+                if isinstance(item, bytes):
+                    writer.write_document(item)
+                elif include_rest:
+                    writer.write_document(self.codec.encode(self.__anon_doc_include_all(item, plan)))
+                else:
+                    writer.write_document(self.codec.encode(self.__anon_doc(item, plan)))
+                count += 1
+            writer.close_file()
+            logging.info(f"{count} documents complete")
+            if self.checkpointer:
+                self.__checkpoint(writer, count, i)
+            i += 1
+        return count
+
+    def __anonymize_batches_timed(self, data, writer, include_rest, plan, file_name):
+        # as __anonymize_batches, timing each stage. kept apart so runs without metrics don't pay for the timers
+        metrics = self.metrics
+        seconds = metrics.seconds
+        counters = metrics.counters
+        anon_doc = self.__anon_doc_include_all if include_rest else self.__anon_doc
+        clock = time.perf_counter
         count = 0
-        file_name = "documents-%s"
-        i = 0
-        for batchiter in utils.batch(data, 100000):
-            tmp = []
+        i = self.resume_state['output'] if self.resume_state else 0
+        for batchiter in utils.batch(data, documents_per_file):
+            start = clock()
+            writer.open_file(file_name % i)
+            seconds["write"] += clock() - start
             for item in batchiter:
-                if include_rest:
-                    tmp.append(json.dumps(self.__anon_doc_include_all(item, self.reader.masked_fields, exclude)))
+                if isinstance(item, bytes):
+                    counters["passthrough_docs"] += 1
+                    encoded = item
                 else:
-                    tmp.append(json.dumps(self.__anon_doc(item, self.reader.masked_fields, exclude)))
-            self.writer.write_data(tmp, file_name=file_name % i)
-            count += len(tmp)
+                    start = clock()
+                    doc = anon_doc(item, plan)
+                    masked = clock()
+                    encoded = self.codec.encode(doc)
+                    seconds["mask"] += masked - start
+                    seconds["encode"] += clock() - masked
+                start = clock()
+                writer.write_document(encoded)
+                seconds["write"] += clock() - start
+                counters["bytes_written"] += len(encoded) + 1
+                counters["docs"] += 1
+                count += 1
+            start = clock()
+            writer.close_file()
+            seconds["write"] += clock() - start
             logging.info(f"{count} documents complete")
+            if self.checkpointer:
+                self.__checkpoint(writer, count, i)
+            metrics.emit()
             i += 1
+        return count
 
 anonymizer_mapping = {
     "default": Anonymizer,
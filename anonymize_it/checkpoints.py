@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+class CheckpointError(Exception):
+    pass
+
+
+# bumped whenever the saved state changes in a way older runs cannot resume from
+version = 1
+
+
+class Checkpointer:
+    def __init__(self, params):
+        """saves the progress of a run at most every interval seconds, so a failed run resumes from its last checkpoint
+
+        a checkpoint is only taken between output files, once the documents written so far and the masks given to
+        their values are durable, so the time it takes is bounded by the masks created since the previous one.
+
+        :param params: a dict like {'path': 'anonymize.checkpoint', 'interval': 60}. masks are kept in masks_path,
+            by default the path with .masks.db appended, unless the mapping store has a path of its own
+        """
+        self.path = params.get('path')
+        if not self.path:
+            raise CheckpointError("checkpoints require a path. please check config.")
+        self.interval = params.get('interval', 60)
+        self.masks_path = params.get('masks_path', self.path + '.masks.db')
+        self.saved = time.perf_counter()
+        self.started = self.saved
+        self.checkpoints = 0
+        self.seconds = 0.0
+
+    def load(self):
+        """returns the state saved by the last checkpoint, or None if there is none to resume from"""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('version') != version:
+            raise CheckpointError("checkpoint {} was saved by an incompatible version, remove it to start over"
+                                  .format(self.path))
+        return state
+
+    def due(self):
+        return time.perf_counter() - self.saved >= self.interval
+
+    def save(self, state, started):
+        """writes state atomically, counting the time since started as checkpoint overhead"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".anonymize-it-checkpoint-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(dict(state, version=version), f)
+            f.flush()
+            # the rename is only as durable as the file it replaces the checkpoint with
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.saved = time.perf_counter()
+        self.checkpoints += 1
+        self.seconds += self.saved - started
+        logging.info("checkpoint saved after {} documents in {:.3f}s".format(state.get('docs'),
+                                                                            self.saved - started))
+
+    def clear(self, masks=True):
+        """removes the checkpoint once the run is complete, and the masks kept for it unless masks is false"""
+        paths = [self.path, self.masks_path] if masks else [self.path]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        logging.info("{} checkpoints took {:.2f}s, {:.2%} of the run".format(
+            self.checkpoints, self.seconds, self.seconds / elapsed if elapsed else 0.0))
+
+
+def create_checkpointer(params=None):
+    """returns a Checkpointer configured by params, or None if checkpoints are not enabled"""
+    if not params:
+        return None
+    return Checkpointer(params)
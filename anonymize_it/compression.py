@@ -0,0 +1,145 @@
+import collections
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# zstd is optional, gzip from the standard library is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CompressionError(Exception):
+    pass
+
+
+class GzipCompression:
+    """compresses blocks into gzip members, which concatenated are a valid gzip file"""
+    type = 'gzip'
+    extension = '.gz'
+    available = True
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        # wbits of 31 writes a gzip header and trailer rather than a raw zlib stream
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+
+class ZstdCompression:
+    """compresses blocks into zstd frames, which concatenated are a valid zstd file"""
+    type = 'zstd'
+    extension = '.zst'
+    available = zstandard is not None
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        # compressors are not thread safe, so each block gets its own
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+
+compression_mapping = {
+    "gzip": GzipCompression,
+    "zstd": ZstdCompression
+}
+
+
+class Compressor:
+    def __init__(self, params):
+        """compresses output files in blocks on a pool of threads, so compression runs alongside masking
+
+        each block is compressed independently, as a gzip member or a zstd frame, and written to the file in order.
+        compressing blocks separately costs a little ratio, but lets every block be compressed at once.
+
+        :param params: a dict like {'type': 'gzip', 'level': 6, 'threads': 4, 'block_size': 1048576}, or just the
+            name of the compression
+        """
+        if isinstance(params, str):
+            params = {'type': params}
+        compression = compression_mapping.get(params.get('type'))
+        if not compression:
+            raise CompressionError("No compression named {} defined.".format(params.get('type')))
+        if not compression.available:
+            raise CompressionError("{} compression requires the {} package".format(compression.type, "zstandard"))
+        self.compression = compression(params['level']) if 'level' in params else compression()
+        self.extension = compression.extension
+        self.threads = params.get('threads', min(4, os.cpu_count() or 1))
+        self.block_size = params.get('block_size', 1024 * 1024)
+        self.executor = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # summed across threads, so it can exceed the time taken to write a file
+        self.seconds = 0.0
+
+    def open(self, fileobj):
+        """returns a CompressedFile writing compressed blocks to fileobj"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        return CompressedFile(self, fileobj)
+
+    def compress(self, block):
+        start = time.perf_counter()
+        data = self.compression.compress(block)
+        return data, time.perf_counter() - start
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+
+
+class CompressedFile:
+    def __init__(self, compressor, fileobj):
+        """a write only file compressing what is written to it into fileobj, see Compressor"""
+        self.compressor = compressor
+        self.fileobj = fileobj
+        self.buffer = []
+        self.size = 0
+        # blocks being compressed, in the order they are written. a few are kept in flight per thread so the threads
+        # are never idle waiting for the next block
+        self.pending = collections.deque()
+        self.max_pending = 2 * compressor.threads
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.compressor.block_size:
+            self.__submit()
+
+    def __submit(self):
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.compressor.bytes_in += len(block)
+        self.pending.append(self.compressor.executor.submit(self.compressor.compress, block))
+        while len(self.pending) > self.max_pending:
+            self.__write_next()
+
+    def __write_next(self):
+        data, seconds = self.pending.popleft().result()
+        self.compressor.bytes_out += len(data)
+        self.compressor.seconds += seconds
+        self.fileobj.write(data)
+
+    def close(self):
+        """writes every block still being compressed, leaving fileobj open"""
+        if self.buffer:
+            self.__submit()
+        while self.pending:
+            self.__write_next()
+
+
+def create_compressor(params=None):
+    """returns a Compressor configured by params, or None if output is not compressed"""
+    if not params:
+        return None
+    return Compressor(params)
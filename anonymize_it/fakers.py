@@ -1,36 +1,143 @@
-import re
+import collections
+import functools
+import hashlib
+import hmac
+import ipaddress
+import os
 
 import faker_microservice
+import numpy as np
 from faker import Faker
+from faker.providers.geo import Provider as GeoProvider
 
 faker = Faker()
 faker.add_provider(faker_microservice.Provider)
 
-ip_pattern = re.compile("(?<![0-9])(?:(?:25[0-5]|2[0-4][0-9]|[0-1]?[0-9]{1,2})[.](?:25[0-5]|2[0-4][0-9]|[0-1]?[0-9]{1,2})[.](?:25[0-5]|2[0-4][0-9]|[0-1]?[0-9]{1,2})[.](?:25[0-5]|2[0-4][0-9]|[0-1]?[0-9]{1,2}))(?![0-9])")
+def ipv4(value, fake=faker):
+    return fake.ipv4()
 
-def ipv4(value):
-    return faker.ipv4()
+def file_path(value, fake=faker):
+    return fake.file_path()
 
-def file_path(value):
-    return faker.file_path()
-
-def geo_point(value):
-    location = faker.location_on_land()
+def geo_point(value, fake=faker):
+    location = fake.location_on_land()
     return {"country_iso_code": location[3],  "location": { "lat": location[0], "lon": location[1] }, "continent_name": location[4].split('/')[0]}
 
 def geo_point_key(value):
     return ["%s:%s" % (value["location"]["lat"], value["location"]["lon"])]
 
 def message_key(_):
-    # dont case just process every time
+    # messages are scrubbed every time, the values found in them are mapped like any other value
     return [None]
 
-def message(value):
-    # we don't consistently replace values. Not sure it matters given this is a string field.
-    return ip_pattern.sub(faker.ipv4(), value)
+def email(value, fake=faker):
+    return fake.email()
+
+def uuid(value, fake=faker):
+    return fake.uuid4()
+
+def service_name(value, fake=faker):
+    # faker_microservice chooses between the shapes of a name with the random module rather than the generator, so
+    # the same choice is made here with the generator's random, keeping seeded generators deterministic
+    ms = faker_microservice
+    delimiter = fake.random_element(ms.DELIMITERS)
+    prefix = fake.random_element(ms.PREFIXES)
+    suffix = fake.random_element(ms.SUFFIXES)
+    singular_noun = fake.random_element(ms.SINGULAR_NOUNS)
+    nouns = ms.SINGULAR_NOUNS + ms.PLURAL_NOUNS
+    # each shape is weighted by the number of names it can make, as faker_microservice does
+    names = collections.OrderedDict([
+        (fake.random_element(nouns), len(nouns)),
+        (singular_noun + delimiter + suffix, len(ms.SINGULAR_NOUNS) * len(ms.SUFFIXES)),
+        (prefix + delimiter + singular_noun, len(ms.SINGULAR_NOUNS)),
+        (prefix + delimiter + singular_noun + delimiter + suffix, len(ms.SINGULAR_NOUNS) * len(ms.SUFFIXES))
+    ])
+    return fake.random_element(names)
+
+def username(value, fake=faker):
+    # profile() generates a whole profile to return its username, user_name() is the same provider without the waste
+    return fake.user_name()
+
+def ipv4_batch(size, rng=np.random):
+    ips = rng.randint(0, 2 ** 32, size=size, dtype=np.uint64)
+    octets = [((ips >> shift) & 255).tolist() for shift in (24, 16, 8, 0)]
+    return ['%d.%d.%d.%d' % ip for ip in zip(*octets)]
+
+def geo_point_batch(size, rng=np.random):
+    # locations are sampled from faker's table of places on land, then moved by up to ~5km so that more distinct
+    # points are available than there are places in the table
+    land_coords = GeoProvider.land_coords
+    jitter = rng.uniform(-0.05, 0.05, size=(size, 2)).tolist()
+    points = []
+    for index, (lat, lon) in zip(rng.randint(0, len(land_coords), size=size).tolist(), jitter):
+        location = land_coords[index]
+        points.append({"country_iso_code": location[3],
+                       "location": {"lat": "%.5f" % (float(location[0]) + lat),
+                                    "lon": "%.5f" % (float(location[1]) + lon)},
+                       "continent_name": location[4].split('/')[0]})
+    return points
+
+# providers with a faster way of generating many values at once than calling them one value at a time
+batch_providers = {
+    "ipv4": ipv4_batch,
+    "geo_point": geo_point_batch
+}
+
+def geo_point_variant(point, n):
+    # faker only knows ~1000 places on land, so once they have all been used a point is moved by up to ~5km
+    lat, lon = np.random.uniform(-0.05, 0.05, size=2).tolist()
+    return {"country_iso_code": point["country_iso_code"],
+            "location": {"lat": "%.5f" % (float(point["location"]["lat"]) + lat),
+                         "lon": "%.5f" % (float(point["location"]["lon"]) + lon)},
+            "continent_name": point["continent_name"]}
+
+def ipv4_variant(ip, n):
+    # steps through the address space from the fake, so variants are still addresses
+    return str(ipaddress.IPv4Address((int(ipaddress.IPv4Address(ip)) + n) % 2 ** 32))
+
+def email_variant(address, n):
+    local, _, domain = address.rpartition('@')
+    return "%s%d@%s" % (local, n, domain)
+
+def file_path_variant(path, n):
+    root, extension = os.path.splitext(path)
+    return "%s%d%s" % (root, n, extension)
+
+def suffix_variant(fake, n):
+    # only for free text, where a numeric suffix leaves a fake that still looks like one
+    return fake + str(n)
+
+# how to vary a fake once the provider keeps repeating itself, keeping the format of the provider's fakes. providers
+# without a variant, e.g. uuid, raise an AllocatorError instead
+variant_providers = {
+    "geo_point": geo_point_variant,
+    "ipv4": ipv4_variant,
+    "email": email_variant,
+    "file_path": file_path_variant,
+    "username": suffix_variant,
+    "service": suffix_variant
+}
+
+def keyed(provider, secret, cache_size=100000):
+    """wraps a provider so that its fake value is derived from the original value
+
+    the generator is seeded with an HMAC of the value, so the same value and secret always produce the same mask in
+    any process or run, without keeping a map of the values seen. the masks of the cache_size most recently seen values
+    are kept, so repeated values skip the HMAC and the provider.
+    """
+    seeded = Faker()
+    seeded.add_provider(faker_microservice.Provider)
+    key = secret.encode('utf-8')
+
+    # the HMAC is of the value's string, so values are cached by it, which also makes dicts and lists cacheable
+    @functools.lru_cache(maxsize=cache_size)
+    def derive(text):
+        digest = hmac.new(key, text.encode('utf-8'), hashlib.sha256).digest()
+        seeded.seed_instance(int.from_bytes(digest[:8], 'big'))
+        return provider(text, seeded)
 
-def service_name(value):
-    return faker.microservice()
+    def mask(value):
+        return derive(str(value))
 
-def username(value):
-    return faker.profile(fields=["username"])["username"]
+    mask.cache_info = derive.cache_info
+    return mask
@@ -0,0 +1,108 @@
+import hashlib
+import ipaddress
+
+import numpy as np
+
+families = {
+    32: ipaddress.IPv4Address,
+    128: ipaddress.IPv6Address
+}
+
+
+class PrefixPreservingIP:
+    def __init__(self, secret, cache_bits=24):
+        """masks IPv4 and IPv6 addresses so that addresses sharing an n bit prefix share an n bit prefix once masked
+
+        this is the Crypto-PAn construction with a keyed blake2b in place of AES: bit i of the masked address is bit i
+        of the address flipped by a pseudorandom function of the i bits before it. the mapping is a bijection within
+        each address family, so distinct addresses never share a mask, and it only depends on the secret, so it is
+        the same in every run and worker without keeping a map of the addresses seen.
+
+        rather than one hash per bit, one hash of the prefix before each byte gives the flips for all 255 prefixes
+        within that byte, so an IPv4 address costs 4 hashes and an IPv6 address 16.
+
+        :param secret: the key of the pseudorandom function, as a string or bytes
+        :param cache_bits: hashes of prefixes shorter than cache_bits are cached. every address starts with one of
+            them, and there are at most 2 ** (cache_bits - 8) of the longest
+        """
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        # blake2b keys are at most 64 bytes
+        self.key = hashlib.sha512(secret).digest()
+        self.cache_bits = cache_bits
+        self.cache = {}
+
+    def __digest(self, prefix, length, bits):
+        if length < self.cache_bits:
+            key = (bits, length, prefix)
+            digest = self.cache.get(key)
+            if digest is None:
+                digest = self.cache[key] = self.__hash(prefix, length, bits)
+            return digest
+        return self.__hash(prefix, length, bits)
+
+    def __hash(self, prefix, length, bits):
+        # 32 bytes hold a complete binary tree of flips, node (2 ** j - 1 + p) for each j bit prefix p of the next byte
+        return hashlib.blake2b(prefix.to_bytes(16, 'big') + bytes((length, bits)), key=self.key,
+                               digest_size=32).digest()
+
+    def mask_int(self, address, bits=32):
+        """masks an address given as an integer, bits is 32 for IPv4 and 128 for IPv6"""
+        masked = 0
+        for length in range(0, bits, 8):
+            tree = int.from_bytes(self.__digest(address >> (bits - length), length, bits), 'little')
+            byte = (address >> (bits - length - 8)) & 255
+            flips = 0
+            for j in range(8):
+                flips = (flips << 1) | ((tree >> ((1 << j) - 1 + (byte >> (8 - j)))) & 1)
+            masked = (masked << 8) | (byte ^ flips)
+        return masked
+
+    def mask_ints(self, addresses, bits=32):
+        """masks many addresses given as integers at once
+
+        the hash for each distinct prefix is computed once per batch, so addresses from the same subnets share the
+        work. IPv4 addresses are masked a byte at a time across the whole batch with numpy.
+        """
+        if bits > 32:
+            return [self.mask_int(address, bits) for address in addresses]
+        addresses = np.asarray(addresses, dtype=np.uint64)
+        masked = np.zeros(len(addresses), dtype=np.uint64)
+        for length in range(0, bits, 8):
+            prefixes, inverse = np.unique(addresses >> np.uint64(bits - length), return_inverse=True)
+            trees = np.frombuffer(b''.join(self.__digest(prefix, length, bits) for prefix in prefixes.tolist()),
+                                  dtype=np.uint8).reshape(-1, 32)[inverse]
+            byte = ((addresses >> np.uint64(bits - length - 8)) & np.uint64(255)).astype(np.int64)
+            flips = np.zeros(len(addresses), dtype=np.int64)
+            for j in range(8):
+                node = (1 << j) - 1 + (byte >> (8 - j))
+                flip = (trees[np.arange(len(addresses)), node >> 3] >> (node & 7).astype(np.uint8)) & 1
+                flips = (flips << 1) | flip
+            masked = (masked << np.uint64(8)) | (byte ^ flips).astype(np.uint64)
+        return masked.tolist()
+
+    def __call__(self, value):
+        """masks an address given as a string, keeping its family and format. values that are not addresses, such as
+        '-' for a missing address, are returned as they are"""
+        try:
+            address = ipaddress.ip_address(value)
+        except ValueError:
+            return value
+        return str(families[address.max_prefixlen](self.mask_int(int(address), address.max_prefixlen)))
+
+    def mask_batch(self, values):
+        """masks many addresses given as strings at once, returning the masks in the same order"""
+        masked = list(values)
+        batches = {}
+        for index, value in enumerate(values):
+            try:
+                address = ipaddress.ip_address(value)
+            except ValueError:
+                continue
+            indexes, ints = batches.setdefault(address.max_prefixlen, ([], []))
+            indexes.append(index)
+            ints.append(int(address))
+        for bits, (indexes, ints) in batches.items():
+            for index, address in zip(indexes, self.mask_ints(ints, bits)):
+                masked[index] = str(families[bits](address))
+        return masked
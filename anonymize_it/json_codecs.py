@@ -0,0 +1,83 @@
+import json
+import logging
+
+# faster codecs are optional, json from the standard library is always available as a fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class CodecError(Exception):
+    pass
+
+
+class JSONCodec:
+    """encodes and decodes documents with the json module from the standard library"""
+    type = 'json'
+    available = True
+    # loads accepts the bytes read from a file, so lines never need decoding to str first
+    loads = staticmethod(json.loads)
+    dumps = staticmethod(json.dumps)
+
+    @staticmethod
+    def encode(doc):
+        return json.dumps(doc).encode('utf-8')
+
+
+class UJSONCodec:
+    """encodes and decodes documents with ujson"""
+    type = 'ujson'
+    available = ujson is not None
+
+    @staticmethod
+    def loads(data):
+        return ujson.loads(data)
+
+    @staticmethod
+    def dumps(doc):
+        return ujson.dumps(doc, escape_forward_slashes=False)
+
+    @staticmethod
+    def encode(doc):
+        return ujson.dumps(doc, escape_forward_slashes=False).encode('utf-8')
+
+
+class OrJSONCodec:
+    """encodes and decodes documents with orjson"""
+    type = 'orjson'
+    available = orjson is not None
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+    @staticmethod
+    def dumps(doc):
+        return orjson.dumps(doc).decode('utf-8')
+
+    # writers accept bytes, so encode is preferred over dumps when writing documents
+    encode = staticmethod(orjson.dumps) if orjson else None
+
+
+codec_mapping = {
+    "json": JSONCodec,
+    "ujson": UJSONCodec,
+    "orjson": OrJSONCodec
+}
+
+
+def get_codec(name=None):
+    """returns the codec named in the config, falling back to the standard library if it is not installed"""
+    codec = codec_mapping.get(name or 'json')
+    if not codec:
+        raise CodecError("No codec named {} defined.".format(name))
+    if not codec.available:
+        logging.warning("{} is not installed, falling back to json".format(codec.type))
+        return JSONCodec
+    return codec
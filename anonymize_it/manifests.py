@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import time
+
+
+class ManifestError(Exception):
+    pass
+
+
+# bumped whenever the saved manifest changes in a way older runs cannot read
+version = 1
+
+
+class Manifest:
+    def __init__(self, params):
+        """records the input files read by each run, so the next run only reads what is new
+
+        a file is recorded with its size, modification time, inode, the offset read up to and a hash of what was read.
+        a file whose size and modification time are unchanged is skipped without being read. a file that has grown is
+        read from the offset the last run stopped at, once the hash shows the part already read is unchanged. any
+        other file is read again from the start.
+
+        :param params: a dict like {'path': 'anonymize.manifest', 'hash_size': 1048576, 'settle': 60}. the hash covers
+            the first and last hash_size bytes read. a last line without a newline is only read once the file has
+            not been modified for settle seconds, until then it is assumed to still be being written
+        """
+        self.path = params.get('path')
+        if not self.path:
+            raise ManifestError("incremental runs require a manifest path. please check config.")
+        self.hash_size = params.get('hash_size', 1024 * 1024)
+        self.settle = params.get('settle', 60)
+        self.files, self.run = self.load()
+        self.stats = {"new": 0, "appended": 0, "changed": 0, "unchanged": 0, "bytes_skipped": 0}
+
+    def load(self):
+        """returns the files recorded by the last run and the number of the run about to start"""
+        if not os.path.exists(self.path):
+            return {}, 1
+        with open(self.path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != version:
+            raise ManifestError("manifest {} was saved by an incompatible version".format(self.path))
+        return manifest['files'], manifest['run'] + 1
+
+    def plan(self, files):
+        """returns the (file, (start, end)) byte ranges to read from files, and the entries to save once they are read
+
+        :param files: the input files, in the order they are read
+        """
+        stats = [(path, os.stat(path)) for path in files]
+        inodes = {(stat.st_dev, stat.st_ino) for _, stat in stats}
+        # files are followed by inode, so a file renamed since it was read, as logs are when rotated, is still known.
+        # a file replaced by a copy is known by its path, as long as the file it replaced is gone
+        by_inode = {tuple(entry['inode']): entry for entry in self.files.values()}
+        sources = []
+        entries = {}
+        now = time.time()
+        for path, stat in stats:
+            inode = (stat.st_dev, stat.st_ino)
+            entry = by_inode.get(inode)
+            if entry is None and path in self.files and tuple(self.files[path]['inode']) not in inodes:
+                entry = self.files[path]
+            settled = now - stat.st_mtime >= self.settle
+            # a file is unchanged unless it has grown, or a last line held back has since settled
+            if (entry and stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+                    and (entry['end'] == stat.st_size or not settled)):
+                self.stats["unchanged"] += 1
+                self.stats["bytes_skipped"] += stat.st_size
+                entries[path] = dict(entry, inode=inode)
+                continue
+            if entry and stat.st_size >= entry['end'] and self.__hash(path, entry['end']) == entry['hash']:
+                start = entry['end']
+                # a file only touched since has nothing new to read
+                self.stats["appended" if stat.st_size > start else "unchanged"] += 1
+                self.stats["bytes_skipped"] += start
+            else:
+                if entry:
+                    logging.warning("{} has changed since it was last read, reading it again".format(path))
+                    self.stats["changed"] += 1
+                else:
+                    self.stats["new"] += 1
+                start = 0
+            end = self.__end(path, start, stat.st_size, settled)
+            entries[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "inode": inode, "end": end,
+                             "hash": self.__hash(path, end)}
+            if end > start:
+                sources.append((path, (start, end)))
+        logging.info("run {} reads {} new, {} appended and {} changed files, skipping {} unchanged files and {} bytes "
+                     "already read".format(self.run, self.stats["new"], self.stats["appended"], self.stats["changed"],
+                                           self.stats["unchanged"], self.stats["bytes_skipped"]))
+        return sources, entries
+
+    def __end(self, path, start, size, settled):
+        # the offset just after the last complete line, so a line still being written is read by a later run
+        if settled or start == size:
+            return size
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.rfind(b'\n', start, size) + 1 or start
+
+    def __hash(self, path, end):
+        # the first and last hash_size bytes, so checking a large file for appends costs two reads rather than a scan
+        digest = hashlib.blake2b(str(end).encode('utf-8'), digest_size=16)
+        with open(path, "rb") as f:
+            digest.update(f.read(min(end, self.hash_size)))
+            tail = max(self.hash_size, end - self.hash_size)
+            if tail < end:
+                f.seek(tail)
+                digest.update(f.read(end - tail))
+        return digest.hexdigest()
+
+    def save(self, entries):
+        """records entries as the files read by this run, atomically, once its output is complete"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".anonymize-it-manifest-")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": version, "run": self.run, "files": entries}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        logging.info("manifest {} saved after run {}".format(self.path, self.run))
+
+
+def create_manifest(params=None):
+    """returns a Manifest configured by params, or None if runs are not incremental"""
+    if not params:
+        return None
+    return Manifest(params)
@@ -0,0 +1,312 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+
+from allocators import IssuedSet, SharedIssuedSet, SQLiteIssuedSet
+
+class MappingStoreError(Exception):
+    pass
+
+
+class SharedFieldMap:
+    def __init__(self, proxy):
+        """a per process view onto a field map held by a multiprocessing manager
+
+        masks are cached locally so each distinct value costs at most one round trip to the manager. new masks are
+        written with setdefault, so if two workers mask the same value at the same time both keep whichever got there
+        first and the value is masked consistently across all output.
+
+        :param proxy: a DictProxy created by multiprocessing.Manager().dict()
+        """
+        self.proxy = proxy
+        self.local = {}
+
+    def __contains__(self, key):
+        if key in self.local:
+            return True
+        value = self.proxy.get(key)
+        if value is None:
+            return False
+        self.local[key] = value
+        return True
+
+    def __getitem__(self, key):
+        return self.local[key]
+
+    def __setitem__(self, key, value):
+        self.local[key] = self.proxy.setdefault(key, value)
+
+    def __len__(self):
+        return len(self.proxy)
+
+
+class SQLiteFieldMap:
+    def __init__(self, connection, table, cache_size=100000, commit_every=10000):
+        """a field map with a bounded in memory LRU tier backed by a sqlite table
+
+        every mask is written through to sqlite, so evicting it from memory never loses it and a value that comes
+        back is given the mask it had before. only the cache_size most recently used masks are held in memory.
+
+        :param connection: a sqlite3 connection shared by the field maps of a store
+        :param table: the table holding this provider type's masks
+        :param cache_size: the maximum number of masks held in memory
+        :param commit_every: the number of new masks written between commits
+        """
+        self.connection = connection
+        self.table = table
+        self.cache_size = cache_size
+        self.commit_every = commit_every
+        self.cache = collections.OrderedDict()
+        self.pending = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.connection.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value TEXT)'.format(table))
+
+    def __cache(self, key, value):
+        self.cache[key] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def __contains__(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return True
+        row = self.connection.execute('SELECT value FROM "{}" WHERE key = ?'.format(self.table),
+                                      (json.dumps(key),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False
+        self.disk_hits += 1
+        self.__cache(key, json.loads(row[0]))
+        return True
+
+    def __getitem__(self, key):
+        return self.cache[key]
+
+    def __setitem__(self, key, value):
+        self.connection.execute('INSERT OR IGNORE INTO "{}" (key, value) VALUES (?, ?)'.format(self.table),
+                                (json.dumps(key), json.dumps(value)))
+        self.__cache(key, value)
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM "{}"'.format(self.table)).fetchone()[0]
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def stats(self):
+        return {
+            "cached": len(self.cache),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses
+        }
+
+
+class PersistentFieldMap:
+    def __init__(self, connection, table):
+        """a field map held in memory that is loaded lazily from, and appended to, a sqlite table
+
+        masks saved by earlier runs are only read when their value is first seen, and masks created during this run
+        are appended to the table by save(). existing rows are never rewritten.
+
+        :param connection: a sqlite3 connection shared by the field maps of a store
+        :param table: the table holding this provider type's masks
+        """
+        self.connection = connection
+        self.table = table
+        self.masks = {}
+        self.new = {}
+        self.loaded = 0
+        self.connection.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value TEXT)'.format(table))
+
+    def __contains__(self, key):
+        if key in self.masks:
+            return True
+        row = self.connection.execute('SELECT value FROM "{}" WHERE key = ?'.format(self.table),
+                                      (json.dumps(key),)).fetchone()
+        if row is None:
+            return False
+        self.loaded += 1
+        self.masks[key] = json.loads(row[0])
+        return True
+
+    def __getitem__(self, key):
+        return self.masks[key]
+
+    def __setitem__(self, key, value):
+        self.masks[key] = value
+        self.new[key] = value
+
+    def __len__(self):
+        return len(self.masks)
+
+    def save(self):
+        self.connection.executemany('INSERT OR IGNORE INTO "{}" (key, value) VALUES (?, ?)'.format(self.table),
+                                    ((json.dumps(key), json.dumps(value)) for key, value in self.new.items()))
+        self.connection.commit()
+        self.new = {}
+
+    def stats(self):
+        return {
+            "cached": len(self.masks),
+            "loaded": self.loaded,
+            "new": len(self.new)
+        }
+
+
+class SQLiteMappingStore:
+    def __init__(self, params):
+        """creates one sqlite backed field map per provider type, all sharing a single database
+
+        :param params: a dict like {'type': 'sqlite', 'path': 'masks.db', 'cache_size': 100000}. without a path the
+            database is a temporary file removed on close, with a path the masks are kept for later runs. issued fakes
+            are checked against a bloom filter sized by bloom_capacity and bloom_error_rate before the database
+        """
+        self.cache_size = params.get('cache_size', 100000)
+        # a mask looked up is read from the cache, so the cache must hold at least that one
+        if not isinstance(self.cache_size, int) or self.cache_size < 1:
+            raise MappingStoreError("cache_size must be a positive integer. please check config.")
+        self.bloom_capacity = params.get('bloom_capacity', 1000000)
+        self.bloom_error_rate = params.get('bloom_error_rate', 0.001)
+        self.path = params.get('path')
+        self.temporary = not self.path
+        if self.temporary:
+            fd, self.path = tempfile.mkstemp(suffix='.db', prefix='anonymize-it-')
+            os.close(fd)
+        # masking may run on a different thread to the one that opened the store
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.field_maps = {}
+        self.issued_sets = {}
+        logging.info("using sqlite mapping store {} with cache size {}".format(self.path, self.cache_size))
+
+    def create_field_maps(self, provider_types):
+        self.field_maps = {key: SQLiteFieldMap(self.connection, key, self.cache_size) for key in provider_types}
+        return self.field_maps
+
+    def create_issued_sets(self, provider_types):
+        self.issued_sets = {key: SQLiteIssuedSet(self.connection, key, self.bloom_capacity, self.bloom_error_rate)
+                            for key in provider_types}
+        return self.issued_sets
+
+    def stats(self):
+        return {key: field_map.stats() for key, field_map in self.field_maps.items()}
+
+    def checkpoint(self):
+        """makes every mask created so far durable, so a run resumed from a checkpoint gives its values the same masks"""
+        for field_map in self.field_maps.values():
+            field_map.commit()
+        for issued in self.issued_sets.values():
+            issued.save()
+
+    def close(self):
+        self.checkpoint()
+        self.connection.close()
+        if self.temporary:
+            os.remove(self.path)
+
+
+class MemoryMappingStore:
+    def __init__(self, params):
+        """keeps every mask in a dict for the duration of the run
+
+        :param params: a dict like {'type': 'memory', 'path': 'masks.db'}. with a path, masks from earlier runs are
+            loaded from the file as their values are seen and new masks are appended to it on close
+        """
+        self.path = params.get('path')
+        self.bloom_capacity = params.get('bloom_capacity', 1000000)
+        self.bloom_error_rate = params.get('bloom_error_rate', 0.001)
+        self.connection = None
+        self.field_maps = {}
+        self.issued_sets = {}
+        if self.path:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            logging.info("using mapping file {}".format(self.path))
+
+    def create_field_maps(self, provider_types):
+        if self.connection:
+            self.field_maps = {key: PersistentFieldMap(self.connection, key) for key in provider_types}
+        else:
+            self.field_maps = {key: {} for key in provider_types}
+        return self.field_maps
+
+    def create_issued_sets(self, provider_types):
+        if self.connection:
+            # masks from earlier runs are only in the file, masks from this run are only written to it on close
+            self.issued_sets = {key: SQLiteIssuedSet(self.connection, key, self.bloom_capacity, self.bloom_error_rate,
+                                                     deferred=True) for key in provider_types}
+            return self.issued_sets
+        return {key: IssuedSet() for key in provider_types}
+
+    def stats(self):
+        if self.connection:
+            return {key: field_map.stats() for key, field_map in self.field_maps.items()}
+        return {key: {"cached": len(field_map)} for key, field_map in self.field_maps.items()}
+
+    def checkpoint(self):
+        if not self.connection:
+            raise MappingStoreError("masks held only in memory cannot be checkpointed, give the store a path")
+        # only masks created since the last save are written
+        for field_map in self.field_maps.values():
+            field_map.save()
+        for issued in self.issued_sets.values():
+            issued.save()
+
+    def close(self):
+        if not self.connection:
+            return
+        self.checkpoint()
+        self.connection.close()
+
+
+class SharedMappingStore:
+    def __init__(self, field_maps, issued_sets):
+        """a worker process' view onto masks and issued fakes held by a multiprocessing manager
+
+        the manager belongs to the parent process, so closing this store leaves the masks in place for other workers.
+
+        :param field_maps: a dict of DictProxy per provider type holding masks
+        :param issued_sets: a dict of DictProxy per provider type holding issued fakes
+        """
+        self.proxies = field_maps
+        self.issued_proxies = issued_sets
+        self.field_maps = {}
+
+    def create_field_maps(self, provider_types):
+        self.field_maps = {key: SharedFieldMap(self.proxies[key]) for key in provider_types}
+        return self.field_maps
+
+    def create_issued_sets(self, provider_types):
+        return {key: SharedIssuedSet(self.issued_proxies[key]) for key in provider_types}
+
+    def stats(self):
+        return {key: {"cached": len(field_map.local)} for key, field_map in self.field_maps.items()}
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        pass
+
+
+store_mapping = {
+    "memory": MemoryMappingStore,
+    "sqlite": SQLiteMappingStore
+}
+
+
+def create_store(params=None):
+    params = params or {}
+    store = store_mapping.get(params.get('type', 'memory'))
+    if not store:
+        raise MappingStoreError("No mapping store named {} defined.".format(params.get('type')))
+    return store(params)
@@ -0,0 +1,231 @@
+import collections
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+class MetricsError(Exception):
+    pass
+
+
+# stages a document passes through. read is the time spent waiting for the reader less the time it spent decoding
+stages = ("read", "decode", "mask", "encode", "write")
+
+
+class Metrics:
+    def __init__(self, sinks=None):
+        """counters and timings of an anonymization run, reported to sinks as it progresses
+
+        anonymizers only time and count when they have a Metrics, so a run without one pays nothing for it.
+
+        :param sinks: the sinks each snapshot is emitted to
+        """
+        self.sinks = sinks or []
+        self.counters = collections.Counter()
+        self.seconds = collections.Counter()
+        self.field_values = collections.Counter()
+        self.field_seconds = collections.Counter()
+        self.field_providers = {}
+        self.mappings = {}
+        self.started = time.perf_counter()
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def timed(self, iterable, stage):
+        """iterates over iterable, adding the time spent waiting for each item to stage"""
+        iterator = iter(iterable)
+        seconds = self.seconds
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                seconds[stage] += time.perf_counter() - start
+                return
+            seconds[stage] += time.perf_counter() - start
+            yield item
+
+    def add_field(self, field, mask_str, values, seconds):
+        self.field_values[field] += values
+        self.field_seconds[field] += seconds
+        self.field_providers[field] = mask_str
+
+    def add_mappings(self, mappings):
+        """records the stats of each provider type's mapping, like {'ipv4': {'cached': 10, 'allocated': 10}}"""
+        for mask_str, stats in mappings.items():
+            self.mappings.setdefault(mask_str, {}).update(stats)
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.started
+        providers = {}
+        for field, mask_str in self.field_providers.items():
+            provider = providers.setdefault(mask_str, {"values": 0, "seconds": 0.0})
+            provider["values"] += self.field_values[field]
+            provider["seconds"] += self.field_seconds[field]
+        mappings = {}
+        for mask_str, stats in self.mappings.items():
+            mappings[mask_str] = dict(stats)
+            values = providers.get(mask_str, {}).get("values")
+            # every value not already in the mapping is allocated a new fake
+            if values and "allocated" in stats:
+                mappings[mask_str]["hit_rate"] = max(0.0, 1 - stats["allocated"] / values)
+        stage_seconds = {stage: self.seconds[stage] for stage in stages}
+        stage_seconds["read"] = max(0.0, stage_seconds["read"] - stage_seconds["decode"])
+        return {
+            "elapsed": elapsed,
+            "docs": self.counters["docs"],
+            "passthrough_docs": self.counters["passthrough_docs"],
+            "bytes_read": self.counters["bytes_read"],
+            "bytes_written": self.counters["bytes_written"],
+            "docs_per_sec": self.counters["docs"] / elapsed if elapsed else 0.0,
+            "bytes_per_sec": self.counters["bytes_read"] / elapsed if elapsed else 0.0,
+            "stages": stage_seconds,
+            "checkpoints": self.counters["checkpoints"],
+            "checkpoint_seconds": self.seconds["checkpoint"],
+            "fields": {field: {"provider": self.field_providers[field], "values": self.field_values[field],
+                               "seconds": self.field_seconds[field]} for field in self.field_providers},
+            "providers": providers,
+            "mappings": mappings
+        }
+
+    def merge(self, snapshot):
+        """adds the counters and timings of a snapshot taken in another process, such as a worker's"""
+        for counter in ("docs", "passthrough_docs", "bytes_read", "bytes_written"):
+            self.counters[counter] += snapshot[counter]
+        for stage, seconds in snapshot["stages"].items():
+            self.seconds[stage] += seconds
+        # snapshots report read less decode, so decode is added back to keep the subtraction in snapshot() right
+        self.seconds["read"] += snapshot["stages"]["decode"]
+        for field, stats in snapshot["fields"].items():
+            self.add_field(field, stats["provider"], stats["values"], stats["seconds"])
+        for mask_str, stats in snapshot["mappings"].items():
+            totals = self.mappings.setdefault(mask_str, {})
+            for key, value in stats.items():
+                if key != "hit_rate" and isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+
+    def emit(self, final=False):
+        if not self.sinks:
+            return
+        snapshot = self.snapshot()
+        snapshot["final"] = final
+        for sink in self.sinks:
+            sink.emit(snapshot)
+
+
+def _write_atomically(path, text):
+    # written to a temporary file and renamed over the target, so a reader never sees a partial file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".anonymize-it-metrics-")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class LogSink:
+    def __init__(self, params):
+        """logs a single line per snapshot"""
+        self.params = params
+
+    def emit(self, snapshot):
+        stage_seconds = " ".join("{}={:.2f}s".format(stage, seconds) for stage, seconds in snapshot["stages"].items())
+        logging.info("{} documents, {:.0f} docs/s, {:.2f} MB/s, {}".format(
+            snapshot["docs"], snapshot["docs_per_sec"], snapshot["bytes_per_sec"] / (1024 * 1024), stage_seconds))
+        if snapshot["final"]:
+            for field, stats in sorted(snapshot["fields"].items(), key=lambda item: -item[1]["seconds"]):
+                logging.info("field {} ({}) {} values in {:.2f}s".format(field, stats["provider"], stats["values"],
+                                                                      stats["seconds"]))
+
+
+class JSONFileSink:
+    def __init__(self, params):
+        """writes each snapshot to a json file, replacing the previous one
+
+        :param params: a dict like {'type': 'json', 'path': 'stats.json'}
+        """
+        self.path = params.get("path")
+        if not self.path:
+            raise MetricsError("json metrics sink requires a path")
+
+    def emit(self, snapshot):
+        _write_atomically(self.path, json.dumps(snapshot, indent=2))
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class PrometheusFileSink:
+    def __init__(self, params):
+        """writes each snapshot to a file in the prometheus text format, e.g. for node_exporter's textfile collector
+
+        :param params: a dict like {'type': 'prometheus', 'path': 'anonymize_it.prom', 'prefix': 'anonymize_it'}
+        """
+        self.path = params.get("path")
+        self.prefix = params.get("prefix", "anonymize_it")
+        if not self.path:
+            raise MetricsError("prometheus metrics sink requires a path")
+
+    def emit(self, snapshot):
+        lines = []
+
+        def metric(name, kind, help, samples):
+            name = "{}_{}".format(self.prefix, name)
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(key, _label(label)) for key, label in labels.items())
+                lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+
+        metric("documents_total", "counter", "Documents anonymized.", [({}, snapshot["docs"])])
+        metric("passthrough_documents_total", "counter", "Documents written without being decoded.",
+               [({}, snapshot["passthrough_docs"])])
+        metric("read_bytes_total", "counter", "Bytes read.", [({}, snapshot["bytes_read"])])
+        metric("written_bytes_total", "counter", "Bytes written.", [({}, snapshot["bytes_written"])])
+        metric("documents_per_second", "gauge", "Documents anonymized per second.", [({}, snapshot["docs_per_sec"])])
+        metric("read_bytes_per_second", "gauge", "Bytes read per second.", [({}, snapshot["bytes_per_sec"])])
+        metric("stage_seconds_total", "counter", "Seconds spent in each stage.",
+               [({"stage": stage}, seconds) for stage, seconds in snapshot["stages"].items()])
+        metric("checkpoints_total", "counter", "Checkpoints saved.", [({}, snapshot["checkpoints"])])
+        metric("checkpoint_seconds_total", "counter", "Seconds spent saving checkpoints.",
+               [({}, snapshot["checkpoint_seconds"])])
+        metric("field_values_total", "counter", "Values masked per field.",
+               [({"field": field, "provider": stats["provider"]}, stats["values"])
+                for field, stats in snapshot["fields"].items()])
+        metric("field_seconds_total", "counter", "Seconds spent masking each field.",
+               [({"field": field, "provider": stats["provider"]}, stats["seconds"])
+                for field, stats in snapshot["fields"].items()])
+        metric("mapping_size", "gauge", "Masks held per provider type.",
+               [({"provider": mask_str}, stats["cached"]) for mask_str, stats in snapshot["mappings"].items()
+                if "cached" in stats])
+        metric("mapping_hit_ratio", "gauge", "Values found already masked per provider type.",
+               [({"provider": mask_str}, stats["hit_rate"]) for mask_str, stats in snapshot["mappings"].items()
+                if "hit_rate" in stats])
+        _write_atomically(self.path, "\n".join(lines) + "\n")
+
+
+sink_mapping = {
+    "log": LogSink,
+    "json": JSONFileSink,
+    "prometheus": PrometheusFileSink
+}
+
+
+def create_metrics(params=None):
+    """returns a Metrics reporting to the sinks in params, or None if metrics are not enabled
+
+    :param params: a dict like {'sinks': [{'type': 'log'}, {'type': 'json', 'path': 'stats.json'}]}. without sinks,
+        metrics are logged
+    """
+    if params is None:
+        return None
+    sinks = []
+    for sink_params in params.get("sinks", [{"type": "log"}]):
+        sink = sink_mapping.get(sink_params.get("type"))
+        if not sink:
+            raise MetricsError("No metrics sink named {} defined.".format(sink_params.get("type")))
+        sinks.append(sink(sink_params))
+    return Metrics(sinks)
@@ -0,0 +1,175 @@
+import queue
+import threading
+from itertools import islice
+
+_DONE = object()
+
+
+class PipelineError(Exception):
+    pass
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(q, item, stop):
+    # a bounded put that gives up once the other end of the queue has gone away
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def read_ahead(iterable, queue_size=2, chunk_size=1000):
+    """iterates over an iterable on a background thread
+
+    items are handed over in chunks of chunk_size, and at most queue_size chunks are held waiting for the consumer
+    so a fast reader cannot run ahead indefinitely. an exception raised by the iterable is re-raised to the consumer,
+    and the thread is stopped if the consumer stops iterating early.
+    """
+    return read_merged([iterable], queue_size, chunk_size)
+
+
+def read_merged(iterables, queue_size=2, chunk_size=1000):
+    """iterates over several iterables at once, each on its own background thread
+
+    as read_ahead, with the chunks of every iterable interleaved in the order they are read. an exception raised by
+    any iterable stops the others and is re-raised to the consumer.
+    """
+    chunks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def produce(iterable):
+        try:
+            iterator = iter(iterable)
+            while not stop.is_set():
+                chunk = list(islice(iterator, chunk_size))
+                if not chunk:
+                    break
+                if not _put(chunks, chunk, stop):
+                    return
+        except BaseException as e:
+            _put(chunks, _Failure(e), stop)
+            return
+        _put(chunks, _DONE, stop)
+
+    threads = [threading.Thread(target=produce, args=(iterable,), daemon=True,
+                                name='anonymize-it-reader' if len(iterables) == 1 else 'anonymize-it-reader-%d' % i)
+               for i, iterable in enumerate(iterables)]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                running -= 1
+                continue
+            if isinstance(chunk, _Failure):
+                raise chunk.error
+            yield from chunk
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+class BackgroundWriter:
+    def __init__(self, writer, queue_size=2, chunk_size=1000):
+        """wraps a writer so that documents are written on a background thread
+
+        documents are handed to the thread in chunks of chunk_size, so the caller can carry on masking while earlier
+        documents are flushed or uploaded. at most queue_size operations wait to be written before the caller blocks.
+        if writing fails, the error is raised from the next call made by the caller.
+
+        :param writer: an instantiated writer
+        :param queue_size: the number of chunks that may wait to be written
+        :param chunk_size: the number of documents handed over at a time
+        """
+        self.writer = writer
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.operations = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.__write, name='anonymize-it-writer', daemon=True)
+        self.thread.start()
+
+    def __write(self):
+        while True:
+            operation = self.operations.get()
+            if operation is _DONE:
+                return
+            method, args = operation
+            try:
+                method(*args)
+            except BaseException as e:
+                self.error = e
+                self.stop.set()
+                return
+
+    def __write_documents(self, docs):
+        for doc in docs:
+            self.writer.write_document(doc)
+
+    def __raise_error(self):
+        if self.error:
+            raise PipelineError("writing failed: {}".format(self.error)) from self.error
+
+    def __queue(self, method, *args):
+        if not _put(self.operations, (method, args), self.stop):
+            self.__raise_error()
+            raise PipelineError("writer has been stopped")
+
+    def __flush(self):
+        if self.chunk:
+            self.__queue(self.__write_documents, self.chunk)
+            self.chunk = []
+
+    def open_file(self, file_name=None):
+        self.__queue(self.writer.open_file, file_name)
+
+    def write_document(self, doc):
+        self.chunk.append(doc)
+        if len(self.chunk) >= self.chunk_size:
+            self.__flush()
+
+    def close_file(self):
+        self.__flush()
+        self.__queue(self.writer.close_file)
+
+    def flush(self):
+        """waits for every queued document to be written, and the writer to be flushed"""
+        self.__flush()
+        flushed = threading.Event()
+        self.__queue(self.__flush_writer, flushed)
+        while not flushed.wait(0.1):
+            if self.stop.is_set():
+                self.__raise_error()
+                raise PipelineError("writer has been stopped")
+
+    def __flush_writer(self, flushed):
+        self.writer.flush()
+        flushed.set()
+
+    def close(self):
+        """waits for every queued document to be written"""
+        _put(self.operations, _DONE, self.stop)
+        self.thread.join()
+        self.__raise_error()
+
+    def abort(self):
+        """stops writing without waiting for queued documents"""
+        self.stop.set()
+        try:
+            while True:
+                self.operations.get_nowait()
+        except queue.Empty:
+            pass
+        self.operations.put(_DONE)
+        self.thread.join()
@@ -0,0 +1,52 @@
+import numpy as np
+
+from fakers import batch_providers
+
+
+class FakePool:
+    def __init__(self, name, generate, batch_size=10000):
+        """hands out pre-generated fake values
+
+        fakes are generated batch_size at a time. a pool may hand out the same fake twice, uniqueness is left to the
+        allocator wrapping it.
+
+        :param name: the provider type
+        :param generate: a callable taking a number n and returning a list of n fake values
+        :param batch_size: the number of fakes generated at a time
+        """
+        self.name = name
+        self.generate = generate
+        self.batch_size = batch_size
+        self.fakes = []
+
+    def __call__(self, value):
+        if not self.fakes:
+            self.fakes = self.generate(self.batch_size)
+            self.fakes.reverse()
+        return self.fakes.pop()
+
+
+def _generate_with(provider):
+    def generate(size):
+        return [provider(None) for _ in range(size)]
+    return generate
+
+
+def create_pools(provider_map, batch_size=10000, exclude=("message",)):
+    """wraps every provider that does not depend on the original value in a FakePool
+
+    providers with an entry in fakers.batch_providers generate their fakes in bulk, the rest are called batch_size
+    times per batch.
+    """
+    rng = np.random.RandomState()
+    pools = {}
+    for name, provider in provider_map.items():
+        if name in exclude:
+            pools[name] = provider
+        elif name in batch_providers:
+            batch_provider = batch_providers[name]
+            pools[name] = FakePool(name, lambda size, batch_provider=batch_provider: batch_provider(size, rng),
+                                   batch_size)
+        else:
+            pools[name] = FakePool(name, _generate_with(provider), batch_size)
+    return pools
@@ -0,0 +1,236 @@
+import cProfile
+import logging
+import os
+import pstats
+import re
+import time
+
+
+class ProfilerError(Exception):
+    pass
+
+
+# modules whose functions mask values, reported by function so the cost of each provider can be told apart
+provider_modules = {"fakers.py", "allocators.py", "pools.py", "ip_masking.py", "scrubbing.py", "mappings.py"}
+
+# the stage each module's own time is attributed to, see metrics.stages
+module_stages = {
+    "source.py": "read",
+    "readers.py": "read",
+    "decoder.py": "decode",
+    "scanner.py": "decode",
+    "encoder.py": "encode",
+    "anonymizers.py": "mask",
+    "utils.py": "mask",
+    "writers.py": "write",
+    "pipeline.py": "write",
+    "gzip.py": "write"
+}
+module_stages.update((module, "mask") for module in provider_modules)
+
+# the stage of builtins, which have no module of their own, by a word in their name
+builtin_stages = (
+    (re.compile(r"\b(loads|decode|scanstring|scan_once)\b"), "decode"),
+    (re.compile(r"\b(dumps|encode|encode_basestring_ascii|c_make_encoder)\b"), "encode"),
+    (re.compile(r"\b(write|writelines|flush|compress)\b"), "write"),
+    (re.compile(r"\b(read|readline|readlines|readinto)\b"), "read")
+)
+
+
+def stage_of(filename, name):
+    """returns the stage of a function from its module or name, or None for functions used by every stage"""
+    module = os.path.basename(filename)
+    if module == "json_codecs.py":
+        return "decode" if name == "loads" else "encode"
+    if module in module_stages:
+        return module_stages[module]
+    if "{0}faker{0}".format(os.sep) in filename:
+        return "mask"
+    if "{0}elasticsearch".format(os.sep) in filename:
+        return "read"
+    if filename == "~":
+        for pattern, stage in builtin_stages:
+            if pattern.search(name):
+                return stage
+    return None
+
+
+def stage_shares(stats):
+    """returns the share of each function's own time attributed to each stage
+
+    functions without a stage of their own, like the standard library or str.join, take the stages of their callers
+    in proportion to the time spent in them from each caller, so the time faker spends in ipaddress counts as masking.
+
+    :param stats: a dict of pstats.Stats.stats
+    """
+    shares = {}
+
+    def resolve(function, visiting):
+        if function in shares:
+            return shares[function]
+        stage = stage_of(function[0], function[2])
+        if stage:
+            shares[function] = {stage: 1.0}
+            return shares[function]
+        if function in visiting:
+            # recursion, the time is accounted for by the callers outside the cycle
+            return {}
+        visiting.add(function)
+        callers = stats[function][4]
+        total = sum(caller_stats[3] for caller_stats in callers.values())
+        result = {}
+        for caller, caller_stats in callers.items():
+            weight = caller_stats[3] / total if total else 1.0 / len(callers)
+            for caller_stage, share in (resolve(caller, visiting) if caller in stats else {}).items():
+                result[caller_stage] = result.get(caller_stage, 0.0) + weight * share
+        visiting.discard(function)
+        if not result:
+            result = {"other": 1.0}
+        shares[function] = result
+        return result
+
+    for function in stats:
+        resolve(function, set())
+    return shares
+
+
+def label(function):
+    filename, line, name = function
+    if filename == "~":
+        return name
+    return "{}:{}({})".format(os.path.basename(filename), line, name)
+
+
+class _Snapshot:
+    def __init__(self, stats):
+        # the interface pstats.Stats expects of a profiler
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    def __init__(self, params=None):
+        """profiles the start of a run, then reports where its time went by stage and by provider
+
+        profiling every call slows masking down several times over, so only the first docs documents or seconds of
+        the run are profiled, after which documents are processed at full speed. only the thread masking documents is
+        profiled; readers and writers running on pipeline threads are not.
+
+        :param params: a dict like {'docs': 10000, 'seconds': 60, 'top': 20, 'path': 'anonymize.pstats'}. profiling
+            stops at whichever of docs or seconds comes first, and defaults to 10000 documents. top is the number of
+            functions reported, and the raw profile is written to path, if set, for pstats or snakeviz
+        """
+        params = params or {}
+        self.docs = params.get('docs')
+        self.seconds = params.get('seconds')
+        if self.docs is None and self.seconds is None:
+            self.docs = 10000
+        if (self.docs is not None and self.docs < 1) or (self.seconds is not None and self.seconds <= 0):
+            raise ProfilerError("profiling requires a positive number of docs or seconds")
+        self.top = params.get('top', 20)
+        self.path = params.get('path')
+        # workers leave reporting to the parent, which adds their profiles to its own
+        self.reporting = params.get('report', True)
+        self.profile = cProfile.Profile()
+        self.profiled_docs = 0
+        self.running = False
+        self.started = None
+        self.snapshots = []
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.running = True
+        self.profile.enable()
+
+    def stop(self):
+        if self.running:
+            self.profile.disable()
+            self.running = False
+
+    def limit(self, iterable):
+        """yields from iterable, stopping the profiler once enough documents have been processed"""
+        iterator = iter(iterable)
+        for item in iterator:
+            yield item
+            # back from the yield, the document has been masked and written
+            self.profiled_docs += 1
+            if (self.docs is not None and self.profiled_docs >= self.docs) or \
+                    (self.seconds is not None and time.perf_counter() - self.started >= self.seconds):
+                self.stop()
+                break
+        yield from iterator
+
+    def snapshot(self):
+        """returns the profile as a picklable dict, e.g. to be added to a parent process' profiler"""
+        self.stop()
+        self.profile.create_stats()
+        return {"stats": self.profile.stats, "docs": self.profiled_docs}
+
+    def add(self, snapshot):
+        self.snapshots.append(snapshot["stats"])
+        self.profiled_docs += snapshot["docs"]
+
+    def stats(self):
+        """returns the pstats.Stats of this profiler and any added to it, or None if nothing was profiled"""
+        self.stop()
+        self.profile.create_stats()
+        profiles = [profile for profile in [self.profile.stats] + self.snapshots if profile]
+        if not profiles:
+            return None
+        # pstats merges into the first profile it is given, so it is given a copy
+        stats = pstats.Stats(_Snapshot(dict(profiles[0])))
+        for profile in profiles[1:]:
+            stats.add(_Snapshot(profile))
+        return stats
+
+    def report(self):
+        """logs and returns the time spent per stage, per provider function and in the slowest functions
+
+        stage times are each function's own time, so they add up to the profiled time. provider and function times
+        are cumulative, including the functions they call.
+        """
+        stats = self.stats()
+        if stats is None:
+            logging.info("nothing was profiled")
+            return {"docs": 0, "seconds": 0.0, "stages": {}, "providers": [], "functions": []}
+        stages = {}
+        providers = {}
+        functions = []
+        shares = stage_shares(stats.stats)
+        for function, (_, calls, own, cumulative, _) in stats.stats.items():
+            for stage, share in shares[function].items():
+                stages[stage] = stages.get(stage, 0.0) + own * share
+            entry = {"function": label(function), "calls": calls, "seconds": own, "cumulative": cumulative}
+            if os.path.basename(function[0]) in provider_modules:
+                providers[entry["function"]] = entry
+            functions.append(entry)
+        functions.sort(key=lambda entry: -entry["cumulative"])
+        report = {
+            "docs": self.profiled_docs,
+            "seconds": stats.total_tt,
+            "stages": stages,
+            "providers": sorted(providers.values(), key=lambda entry: -entry["cumulative"])[:self.top],
+            "functions": functions[:self.top]
+        }
+
+        logging.info("profiled {} documents in {:.2f}s".format(report["docs"], report["seconds"]))
+        for stage, seconds in sorted(stages.items(), key=lambda item: -item[1]):
+            logging.info("stage {:<6} {:>8.2f}s {:>6.1%}".format(stage, seconds,
+                                                                 seconds / stats.total_tt if stats.total_tt else 0))
+        for title, entries in (("provider", report["providers"]), ("function", report["functions"])):
+            for entry in entries:
+                logging.info("{} {} {} calls {:.2f}s cumulative {:.2f}s".format(
+                    title, entry["function"], entry["calls"], entry["seconds"], entry["cumulative"]))
+        if self.path:
+            stats.dump_stats(self.path)
+            logging.info("profile written to {}".format(self.path))
+        return report
+
+
+def create_profiler(params=None):
+    """returns a Profiler configured by params, or None if profiling is not enabled"""
+    if params is None:
+        return None
+    return Profiler(params)
@@ -1,11 +1,18 @@
 import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from natsort import natsorted
 from abc import ABCMeta, abstractmethod
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, TransportError
 from elasticsearch_dsl import Search, A
+from elasticsearch_dsl.response import Hit
 import getpass
 
-from source import FileReader, JSONFileSetReader
+from source import FileReader, JSONFileSetReader, split_ranges
+from json_codecs import JSONCodec
+import pipeline
 import utils
 import logging
 
@@ -18,6 +25,10 @@ class ProviderInferenceError(Exception):
     pass
 
 
+# statuses of requests worth retrying, the cluster is overloaded or a node is briefly unavailable
+retry_statuses = {429, 502, 503, 504}
+
+
 def es_field_mappings(es_type, field):
     es_types = {
         "text": [],
@@ -53,6 +64,9 @@ def es_field_mappings(es_type, field):
 
 
 class BaseReader:
+    # readers able to start from a position recorded while reading, so a run can resume from a checkpoint
+    resumable = False
+
     def __init__(self, params, masked_fields, suppressed_fields):
         self.masked_fields = masked_fields
         self.suppressed_fields = suppressed_fields
@@ -64,8 +78,12 @@ class BaseReader:
     def create_mappings(self):
         pass
 
+    def iter_mappings(self):
+        """yields each masked field and its mapping as it becomes available, see create_mappings"""
+        yield from self.create_mappings().items()
+
     @abstractmethod
-    def get_data(self, field_maps, suppressed_fields, include_all):
+    def get_data(self, field_maps, suppressed_fields, include_all, codec=None, passthrough=False, metrics=None):
         pass
 
     @abstractmethod
@@ -75,6 +93,15 @@ class BaseReader:
 
 class ESReader(BaseReader):
     def __init__(self, params, masked_fields, suppressed_fields):
+        """reads documents from elasticsearch
+
+        :param params: a dict like {'host': 'localhost:9200', 'index': 'logs-*', 'query': {...}, 'slices': 4,
+            'page_size': 1000}. with slices above 1 the scroll is split into that many slices, read concurrently.
+            page_size is the number of hits per scroll request, scroll how long each scroll is kept open between
+            requests, and a request failing with a connection error or an overloaded cluster is retried up to
+            max_retries times, waiting retry_delay seconds doubled on each attempt. the values of up to
+            mapping_concurrency masked fields are fetched at once
+        """
         super().__init__(params, masked_fields, suppressed_fields)
 
         self.type = 'elasticsearch'
@@ -84,39 +111,77 @@ class ESReader(BaseReader):
         self.index_pattern = params.get('index')
         self.query = params.get('query')
         self.use_ssl = params.get('use_ssl', False)
+        self.slices = params.get('slices', 1)
+        self.page_size = params.get('page_size', 1000)
+        self.scroll = params.get('scroll', '5m')
+        self.max_retries = params.get('max_retries', 3)
+        self.retry_delay = params.get('retry_delay', 1)
+        self.mapping_concurrency = params.get('mapping_concurrency', 4)
         self.es = None
 
+        if not isinstance(self.slices, int) or self.slices < 1:
+            raise ESReaderError("slices must be a positive integer. please check config.")
+        if not isinstance(self.mapping_concurrency, int) or self.mapping_concurrency < 1:
+            raise ESReaderError("mapping_concurrency must be a positive integer. please check config.")
+
 
         if not all([self.host, self.username, self.password]):
             raise ESReaderError("elasticsearch configuration malformed. please check config.")
 
-        self.es = Elasticsearch([self.host], use_ssl=self.use_ssl, http_auth=(self.username, self.password), verify_certs=False)
+        # a connection per concurrent request, beyond which urllib3 would open and discard connections
+        self.es = Elasticsearch([self.host], use_ssl=self.use_ssl, http_auth=(self.username, self.password), verify_certs=False,
+                                maxsize=max(10, self.slices, self.mapping_concurrency))
 
         logging.info("elasticsearch host = {}".format(self.host))
         logging.info("elasticsearch index = {}".format(self.index_pattern))
         logging.info("using query = {}".format(self.query))
 
     def create_mappings(self):
+        mappings = dict(self.iter_mappings())
+        return {field: mappings[field] for field in self.masked_fields}
+
+    def iter_mappings(self):
+        """yields each masked field and a dict of its values, in the order the fields' values are fetched
+
+        the values of up to mapping_concurrency fields are fetched at once, so a caller can mask the values of one field
+        while those of the next are still being fetched
+        """
         logging.info("creating mappings...")
-        mappings = {}
+        fields = []
         for field, provider in self.masked_fields.items():
-            logging.info("getting values for {} using provider {}".format(field, provider))
-            mappings[field] = {}
-            cont = True
-            term = ""
-            size = 10000
             if provider:
-                while cont:
-                    response = self.es.search(index=self.index_pattern,
-                                              body=utils.composite_query(field, size, self.query, term))
-                    for hit in response['aggregations']['my_buckets']['buckets']:
-                        mappings[field][hit['key'][field]] = None
-                    if len(response['aggregations']["my_buckets"]['buckets']) < size:
-                        cont = False
-                    term = response['aggregations']["my_buckets"]['buckets'][-1]['key'][field]
-
+                fields.append(field)
+            else:
+                yield field, {}
+        executor = ThreadPoolExecutor(max_workers=self.mapping_concurrency)
+        futures = {executor.submit(self.field_values, field): field for field in fields}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # a failed field stops those not yet started
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
         logging.info("mappings completed...")
-        return mappings
+
+    def field_values(self, field):
+        """returns a dict with the distinct values of field as keys, paging through a composite aggregation"""
+        logging.info("getting values for {} using provider {}".format(field, self.masked_fields[field]))
+        values = {}
+        term = ""
+        size = 10000
+        while True:
+            response = self.request("values of {}".format(field), self.es.search, index=self.index_pattern,
+                                    body=utils.composite_query(field, size, self.query, term))
+            buckets = response['aggregations']['my_buckets']['buckets']
+            for hit in buckets:
+                values[hit['key'][field]] = None
+            if len(buckets) < size:
+                break
+            term = buckets[-1]['key'][field]
+        logging.info("{} values for {}".format(len(values), field))
+        return values
 
     def get_count(self):
         s = Search(using=self.es, index=self.index_pattern)
@@ -124,11 +189,14 @@ class ESReader(BaseReader):
             s.update_from_dict({"query": self.query})
         return s.count()
 
-    def get_data(self, include, suppressed_fields, include_all=False):
+    def get_data(self, include, suppressed_fields, include_all=False, codec=None, passthrough=False, metrics=None):
         """
         :param field_maps:
         :param suppressed_fields:
         :param include_all:
+        :param codec: unused, hits are decoded by the elasticsearch client
+        :param passthrough: unused, hits are always decoded
+        :param metrics: unused, hits are decoded by the elasticsearch client
         :return:
         """
 
@@ -140,11 +208,72 @@ class ESReader(BaseReader):
             s = s.source(include=include, exclude=suppressed_fields)
         else:
             s = s.source(exclude=suppressed_fields)
+        body = s.to_dict()
+
+        logging.info("gathering data from elasticsearch using {} slices...".format(self.slices))
+        if self.slices == 1:
+            return self.scroll_slice(body)
+        # each slice is scrolled on its own thread, and their pages are interleaved as they arrive
+        return pipeline.read_merged([self.scroll_slice(body, slice_id) for slice_id in range(self.slices)],
+                                    queue_size=2 * self.slices, chunk_size=self.page_size)
 
-        logging.info("gathering data from elasticsearch...")
+    def request(self, name, method, **kwargs):
+        """calls an elasticsearch client method, retrying connection errors and overloaded clusters
 
-        response = s.scan()
-        return response
+        :param name: what is being requested, e.g. 'slice 2', for logs and errors
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return method(**kwargs)
+            except TransportError as e:
+                if not isinstance(e, ESConnectionError) and e.status_code not in retry_statuses:
+                    raise ESReaderError("{} failed: {}".format(name, e)) from e
+                if attempt == self.max_retries:
+                    raise ESReaderError("{} failed after {} retries: {}".format(name, attempt, e)) from e
+                delay = self.retry_delay * 2 ** attempt
+                logging.warning("{} request failed, retrying in {}s: {}".format(name, delay, e))
+                time.sleep(delay)
+
+    def scroll_slice(self, body, slice_id=0):
+        """yields the hits of one slice of a scroll over body, logging its progress"""
+        if self.slices > 1:
+            body = dict(body, slice={"id": slice_id, "max": self.slices})
+        name = "slice {}".format(slice_id)
+        response = self.request(name, self.es.search, index=self.index_pattern, body=body, scroll=self.scroll,
+                                size=self.page_size)
+        scroll_id = response.get('_scroll_id')
+        total = response['hits']['total']
+        # elasticsearch 7 reports the total as {'value': n, 'relation': 'eq'}
+        total = total['value'] if isinstance(total, dict) else total
+        fetched = 0
+        logged = 0
+        try:
+            while True:
+                shards = response.get('_shards', {})
+                if shards.get('failed'):
+                    raise ESReaderError("slice {} failed on {} of {} shards".format(slice_id, shards['failed'],
+                                                                                     shards.get('total')))
+                hits = response['hits']['hits']
+                if not hits:
+                    break
+                for hit in hits:
+                    yield Hit(hit)
+                fetched += len(hits)
+                if total and fetched * 10 // total > logged:
+                    logged = fetched * 10 // total
+                    logging.info("slice {}: {} of {} documents read".format(slice_id, fetched, total))
+                # a scroll request lost after elasticsearch answered it would skip a page on retry, the transport's
+                # own retries make that unlikely
+                response = self.request(name, self.es.scroll, scroll_id=scroll_id, scroll=self.scroll)
+                scroll_id = response.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+                except TransportError:
+                    pass
+        if fetched != total:
+            logging.warning("slice {}: read {} of {} documents".format(slice_id, fetched, total))
 
     def infer_providers(self):
 
@@ -166,11 +295,19 @@ class ESReader(BaseReader):
 
 
 class JSONFileReader(BaseReader):
+    resumable = True
 
     def __init__(self, params, masked_fields, suppressed_fields):
         super().__init__(params, masked_fields, suppressed_fields)
         self.type = 'json_file_reader'
         self.filepath = params.get('filepath')
+        # with processes > 1 files are decoded concurrently, see source.JSONFileSetReader
+        self.processes = params.get('processes', 1)
+        self.ordered = params.get('ordered', True)
+        self.batch_size = params.get('batch_size', 1000)
+        # files larger than split_size are divided between parallel workers, each reading a byte_range of the file
+        self.split_size = params.get('split_size')
+        self.byte_range = params.get('byte_range')
         logging.info("using files = {}".format(self.filepath))
 
     def create_mappings(self):
@@ -182,8 +319,58 @@ class JSONFileReader(BaseReader):
         logging.info("mappings completed...")
         return mappings
 
-    def get_data(self, include, exclude, include_all):
-        return JSONFileSetReader(natsorted(glob.glob(self.filepath))).read()
+    def get_files(self):
+        return natsorted(glob.glob(self.filepath))
+
+    def get_shards(self, files=None):
+        """returns a (name, file, byte range) for each shard of the input read by a parallel worker
+
+        a file is a shard named by its number, or if larger than split_size is divided into byte ranges of about
+        split_size bytes named number-range, so the names of the shards, and of their outputs, sort in input order.
+        the byte range of a whole file is None.
+
+        :param files: an optional list of files or (file, byte range) pairs to shard instead of get_files()
+        """
+        shards = []
+        if files is None:
+            files = self.get_files()
+        files = [file if isinstance(file, tuple) else (file, None) for file in files]
+        for number, (file, byte_range) in enumerate(files):
+            start, end = byte_range or (0, os.path.getsize(file))
+            if self.split_size and end - start > self.split_size:
+                shards.extend(("{}-{}".format(number, part), file, part_range)
+                              for part, part_range in enumerate(split_ranges(file, self.split_size, byte_range)))
+            else:
+                shards.append((str(number), file, byte_range))
+        return shards
+
+    def get_data(self, include, exclude, include_all, codec=None, passthrough=False, metrics=None, start=None,
+                 marks=None, mark_every=None, files=None):
+        """
+        :param include:
+        :param exclude:
+        :param include_all:
+        :param codec: the codec used to decode documents
+        :param passthrough: if true, lines that cannot contain a masked or excluded field are returned as raw bytes
+            rather than the decoded document
+        :param metrics: an optional Metrics counting the bytes read and the time spent decoding
+        :param start: an optional (file index, offset) position in get_files() to start reading from
+        :param marks: an optional dict filled with the position after every mark_every documents, see
+            source.JSONFileSetReader
+        :param files: an optional list of files or (file, byte range) pairs to read instead of get_files()
+        :return:
+        """
+        key_filter = None
+        if passthrough:
+            fields = [field for field, mask_str in self.masked_fields.items() if mask_str] + list(exclude)
+            key_filter = utils.compile_key_filter(fields)
+        if files is None:
+            files = self.get_files()
+            if self.byte_range:
+                files = [(file, tuple(self.byte_range)) for file in files]
+        return JSONFileSetReader(files, codec or JSONCodec, key_filter, metrics, processes=self.processes,
+                                 ordered=self.ordered, batch_size=self.batch_size, start=start, marks=marks,
+                                 mark_every=mark_every).read()
 
     def infer_providers(self):
         pass
@@ -193,7 +380,7 @@ class CSVReader(BaseReader):
     def __init__(self, params):
         super().__init__(params)
 
-    def get_data(self, field_maps, suppressed_fields, include_all):
+    def get_data(self, field_maps, suppressed_fields, include_all, codec=None, passthrough=False, metrics=None):
         pass
 
     def infer_providers(self):
@@ -204,7 +391,7 @@ class PandasReader(BaseReader):
     def __init__(self, params):
         super().__init__(params)
 
-    def get_data(self, field_maps, suppressed_fields, include_all):
+    def get_data(self, field_maps, suppressed_fields, include_all, codec=None, passthrough=False, metrics=None):
         pass
 
     def infer_providers(self):
@@ -0,0 +1,129 @@
+import ipaddress
+import re
+
+
+class ScrubberError(Exception):
+    pass
+
+
+def _is_ipv4(value):
+    return all(int(octet) <= 255 for octet in value.split("."))
+
+
+def _is_ipv6(value):
+    try:
+        ipaddress.IPv6Address(value)
+    except ValueError:
+        return False
+    return True
+
+
+class Detector:
+    def __init__(self, pattern, hints, validate=None, screen=None):
+        """a kind of value to find in free text
+
+        :param pattern: a regex matching candidate values, without capturing groups
+        :param hints: substrings of which every candidate contains at least one, text containing none of them is
+            skipped without running the regex
+        :param validate: an optional callable returning False for candidates that are not really values of this kind
+        :param screen: an optional regex that text holding a hint must also match for the detector to run. for hints
+            common in text without candidates, like the dashes and colons of timestamps
+        """
+        self.pattern = pattern
+        self.hints = hints
+        self.validate = validate
+        self.screen = re.compile(screen) if screen else None
+
+
+detector_mapping = {
+    # patterns start with a lookbehind so each run of characters is only tried from its start, rather than from
+    # every position in it
+    "ipv4": Detector(r"(?<![0-9.])[0-9]{1,3}[.][0-9]{1,3}[.][0-9]{1,3}[.][0-9]{1,3}(?![0-9]|[.][0-9])", (".",),
+                     _is_ipv4),
+    # candidates are any run of hex digits and colons with two or more colons, which also matches times and mac
+    # addresses, so candidates are checked to be addresses before being masked. an address either holds "::" or
+    # six groups followed by a colon, which times and mac addresses never do
+    "ipv6": Detector(r"(?<![0-9A-Fa-f:])[0-9A-Fa-f]{0,4}:[0-9A-Fa-f]{0,4}:[0-9A-Fa-f:]{0,35}(?![0-9A-Fa-f:])", (":",),
+                     _is_ipv6, r"::|(?:[0-9A-Fa-f]{1,4}:){6}"),
+    "email": Detector(r"(?<![A-Za-z0-9._%+-])[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:[.][A-Za-z0-9-]+)*[.][A-Za-z]{2,}",
+                      ("@",)),
+    "uuid": Detector(r"(?<![0-9A-Fa-f-])[0-9A-Fa-f]{8}(?:-[0-9A-Fa-f]{4}){3}-[0-9A-Fa-f]{12}(?![0-9A-Fa-f-])",
+                     ("-",), screen=r"[0-9A-Fa-f]{8}-"),
+    "username": Detector(r"(?:(?<=user=)|(?<=user: )|(?<=user )|(?<=username=)|(?<=username: ))[A-Za-z0-9._-]+",
+                         ("user",)),
+    "hostname": Detector(r"(?<![A-Za-z0-9.-])(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?[.])+[A-Za-z]{2,63}"
+                         r"(?![A-Za-z0-9-])", (".",))
+}
+
+# detectors run over messages by default, and the provider type whose masks replace their matches
+default_detectors = {
+    "ipv4": "ipv4",
+    "ipv6": "ip",
+    "email": "email",
+    "uuid": "uuid"
+}
+
+
+class MessageScrubber:
+    def __init__(self, mask_value, detectors=None):
+        """replaces the values found in free text with masks, in a single pass over the text
+
+        the patterns of the detectors whose hints appear in the text, and whose screens match it, are combined into one
+        regex, so text is scanned once however many detectors could match, and text without any is returned as it is
+        without running the combined regex. each
+        match is masked through mask_value with the provider type of its detector, so a value found in a message is
+        given the same mask as the value in a structured field of that type.
+
+        :param mask_value: a callable taking a provider type and a value and returning the value's mask
+        :param detectors: a dict like {'ipv4': 'ipv4', 'email': 'email'} of the detectors to run and the provider type
+            masking each detector's matches, see detector_mapping for the available detectors
+        """
+        self.mask_value = mask_value
+        detectors = detectors or default_detectors
+        unknown = set(detectors) - set(detector_mapping)
+        if unknown:
+            raise ScrubberError("No detector named {} defined.".format(", ".join(sorted(unknown))))
+        # matches are attributed to their detector by the name of the group they matched
+        self.types = dict(detectors)
+        self.validators = {name: detector_mapping[name].validate for name in detectors
+                           if detector_mapping[name].validate}
+        self.detectors = [(name, detector_mapping[name].hints, detector_mapping[name].screen) for name in detectors]
+        # one regex per combination of detectors seen, at most 2 ** len(detectors)
+        self.patterns = {}
+        self.skipped = 0
+        self.scrubbed = 0
+        self.matches = 0
+
+    def __replace(self, match):
+        name = match.lastgroup
+        value = match.group()
+        validate = self.validators.get(name)
+        if validate and not validate(value):
+            return value
+        self.matches += 1
+        return self.mask_value(self.types[name], value)
+
+    def __pattern(self, names):
+        pattern = self.patterns.get(names)
+        if pattern is None:
+            pattern = self.patterns[names] = re.compile(
+                "|".join("(?P<{}>{})".format(name, detector_mapping[name].pattern) for name in names))
+        return pattern
+
+    def __call__(self, value):
+        if not isinstance(value, str):
+            return value
+        names = tuple(name for name, hints, screen in self.detectors
+                      if any(hint in value for hint in hints) and (screen is None or screen.search(value)))
+        if not names:
+            self.skipped += 1
+            return value
+        self.scrubbed += 1
+        return self.__pattern(names).sub(self.__replace, value)
+
+    def stats(self):
+        return {
+            "skipped": self.skipped,
+            "scrubbed": self.scrubbed,
+            "matches": self.matches
+        }
@@ -14,16 +14,33 @@
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitations
 # under the License.
-import json
+import collections
 import logging
+import multiprocessing
+import queue
+import time
 from contextlib import suppress
 
 import mmap
 
+from json_codecs import JSONCodec
+
+
+class SourceError(Exception):
+    pass
+
+
 class MmapSource:
-    def __init__(self, file_name, encoding="utf-8"):
+    def __init__(self, file_name, encoding="utf-8", byte_range=None):
+        """reads a file through a memory map
+
+        :param byte_range: an optional (start, end) pair. lines are then read from start until end, which are
+            expected to fall just after a newline, see split_ranges. an end of None reads to the end of the file
+        """
         self.file_name = file_name
         self.encoding = encoding
+        self.byte_range = byte_range
+        self.end = None
         self.f = None
         self.mm = None
 
@@ -33,6 +50,12 @@ class MmapSource:
         # madvise is available in Python 3.8+
         with suppress(AttributeError):
             self.mm.madvise(mmap.MADV_SEQUENTIAL)
+        if self.byte_range:
+            start, self.end = self.byte_range
+            self.mm.seek(start)
+            if self.end is not None:
+                # shadows readline, so reading a whole file pays nothing for the end check
+                self.readline = self.__readline_range
 
         # allow for chaining
         return self
@@ -40,12 +63,20 @@ class MmapSource:
     def seek(self, offset):
         self.mm.seek(offset)
 
+    def tell(self):
+        return self.mm.tell()
+
     def read(self):
         return self.mm.read()
 
     def readline(self):
         return self.mm.readline()
 
+    def __readline_range(self):
+        if self.mm.tell() >= self.end:
+            return b''
+        return self.mm.readline()
+
     def close(self):
         self.mm.close()
         self.mm = None
@@ -64,10 +95,33 @@ class MmapSource:
         return self.file_name
 
 
+def split_ranges(file_name, size, byte_range=None):
+    """returns the (start, end) byte ranges dividing a file into ranges of about size bytes
+
+    each range but the last ends just after a newline, so every line falls in exactly one range. the newlines are
+    found through a memory map, so only the pages around each boundary are read.
+
+    :param byte_range: an optional (start, end) pair, to divide only that range of the file
+    """
+    with MmapSource(file_name) as source:
+        start, length = byte_range or (0, len(source.mm))
+        ranges = []
+        while start < length:
+            end = length
+            if start + size < length:
+                newline = source.mm.find(b'\n', start + size - 1, length)
+                if newline != -1:
+                    end = newline + 1
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
 class FileReader:
-    def __init__(self, file_name, source_class):
+    def __init__(self, file_name, source_class, byte_range=None):
         self.source_class = source_class
         self.file_name = file_name
+        self.byte_range = byte_range
         self.source = None
         self.current_line = 0
 
@@ -76,7 +130,10 @@ class FileReader:
         return self
 
     def open(self):
-        self.source = self.source_class(self.file_name).open()
+        if self.byte_range:
+            self.source = self.source_class(self.file_name, byte_range=self.byte_range).open()
+        else:
+            self.source = self.source_class(self.file_name).open()
         return self
 
     def close(self):
@@ -101,25 +158,203 @@ class FileReader:
 
 class JSONFileSetReader:
 
-    def __init__(self, files):
-        self.readers = []
-        for filename in files:
-            reader = FileReader(filename, MmapSource)
-            self.readers.append(reader.open())
-        self._num_readers = len(self.readers)
-        self._current_reader = 0
+    def __init__(self, files, codec=JSONCodec, passthrough=None, metrics=None, processes=1, ordered=True,
+                 batch_size=1000, queue_size=4, start=None, marks=None, mark_every=None):
+        """reads newline delimited json documents from a set of files
+
+        files are opened as they are reached and closed once read, so only the files being read hold a descriptor.
+        with more than one process, files are decoded concurrently in that many reader processes, each reading a
+        file at a time and sending its documents back in batches.
+
+        :param files: the files to read, in order. a (file, (start, end)) pair reads only that byte range of the file
+        :param codec: the codec used to decode each line
+        :param passthrough: an optional compiled regex. lines holding a single json object that the regex does not
+            match are yielded as raw bytes, without the newline, instead of the decoded document. they are still
+            decoded, so a malformed line is logged and dropped
+        :param metrics: an optional Metrics counting the bytes read and the time spent decoding
+        :param processes: the number of reader processes decoding files. with 1 files are read in this process
+        :param ordered: if true documents are yielded in file order, as they are without processes. otherwise batches
+            are yielded as soon as any process has decoded them, so one slow file does not hold up the others
+        :param batch_size: the number of documents a reader process sends at a time
+        :param queue_size: the number of batches each reader process may decode ahead of those yielded
+        :param start: an optional (file index, offset) pair to start reading from, like a position in marks
+        :param marks: an optional dict, filled with the (file index, offset) following every mark_every documents
+            yielded, keyed by the number of documents, so reading can later start after any of them. marks are only
+            kept when reading in this process
+        """
+        self.files = [file if isinstance(file, tuple) else (file, None) for file in files]
+        self.codec = codec
+        self.passthrough = passthrough
+        self.metrics = metrics
+        self.processes = min(processes, len(self.files))
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.start = start
+        self.marks = marks
+        self.mark_every = mark_every
+        self.count = 0
+        if marks is not None and self.processes > 1:
+            raise SourceError("marks require reading in this process, set processes to 1")
 
     def read(self):
-        while self._current_reader != self._num_readers:
-            reader = self.readers[self._current_reader]
-            doc = next(reader)
-            if doc:
-                try:
-                    doc = json.loads(doc)
-                    yield doc
-                except json.decoder.JSONDecodeError:
-                    logging.error("Failed to decode document")
+        if self.processes > 1:
+            return self.__read_parallel()
+        return self.__read_serial()
+
+    def __read_serial(self):
+        first, offset = self.start or (0, 0)
+        for index in range(first, len(self.files)):
+            file_name, byte_range = self.files[index]
+            if index == first and offset:
+                byte_range = (offset, byte_range[1] if byte_range else None)
+            with FileReader(file_name, MmapSource, byte_range) as reader:
+                docs = _decode_lines(reader.source, self.codec, self.passthrough, self.metrics)
+                if self.marks is None:
+                    yield from docs
+                else:
+                    yield from self.__marked(docs, reader.source, index)
+            logging.info(f"Completed file {_describe(file_name, byte_range)}")
+
+    def __marked(self, docs, source, index):
+        for doc in docs:
+            self.count += 1
+            if self.count % self.mark_every == 0:
+                # the line has been read, so the source is positioned at the start of the next document
+                self.marks[self.count] = (index, source.tell())
+            yield doc
+
+    def __read_parallel(self):
+        for batch in self.read_batches():
+            yield from batch
+
+    def read_batches(self):
+        """yields lists of documents decoded by reader processes, see processes and ordered"""
+        if self.ordered:
+            # file i is read by process i % processes, so each file's batches arrive in order on that process' queue
+            tasks = [multiprocessing.Queue() for _ in range(self.processes)]
+            results = [multiprocessing.Queue(self.queue_size) for _ in range(self.processes)]
+            for index in range(len(self.files)):
+                tasks[index % self.processes].put(index)
+        else:
+            # files are handed to whichever process is free, and batches are taken from all of them as they arrive
+            tasks = [multiprocessing.Queue()] * self.processes
+            results = [multiprocessing.Queue(self.queue_size * self.processes)] * self.processes
+            for index in range(len(self.files)):
+                tasks[0].put(index)
+        for task in tasks:
+            task.put(None)
+        workers = [multiprocessing.Process(target=_decode_files, name='anonymize-it-reader-{}'.format(n), daemon=True,
+                                           args=(self.files, tasks[n], results[n], self.codec, self.passthrough,
+                                                 self.batch_size, self.metrics is not None))
+                   for n in range(self.processes)]
+        for worker in workers:
+            worker.start()
+        try:
+            remaining = len(self.files)
+            current = 0
+            while remaining:
+                message = self.__receive(results[current % self.processes], workers)
+                if message[0] == _ERROR:
+                    raise SourceError("reading {} failed: {}".format(_describe(*self.files[message[1]]), message[2]))
+                if message[0] == _DONE:
+                    logging.info(f"Completed file {_describe(*self.files[message[1]])}")
+                    remaining -= 1
+                    current += 1
+                    continue
+                _, _, docs, bytes_read, decode_seconds = message
+                if self.metrics is not None:
+                    self.metrics.counters["bytes_read"] += bytes_read
+                    # decoding ran in the reader processes while this one waited, and the wait is counted as read
+                    # less decode, so decode is added to both to leave read as the time spent waiting
+                    self.metrics.seconds["decode"] += decode_seconds
+                    self.metrics.seconds["read"] += decode_seconds
+                yield docs
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            # files left unread when stopping early are dropped rather than waited on as this process exits
+            for task in set(tasks):
+                task.cancel_join_thread()
+
+    def __receive(self, results, workers):
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                for worker in workers:
+                    if worker.exitcode:
+                        raise SourceError("reader process {} exited with {}".format(worker.name, worker.exitcode))
+
+
+def _describe(file_name, byte_range):
+    if byte_range is None:
+        return file_name
+    return "{} bytes {}-{}".format(file_name, byte_range[0], "" if byte_range[1] is None else byte_range[1])
+
+
+_BATCH = "batch"
+_DONE = "done"
+_ERROR = "error"
+
+
+def _decode_lines(source, codec, passthrough, metrics):
+    for doc in iter(source.readline, b''):
+        if metrics is not None:
+            metrics.counters["bytes_read"] += len(doc)
+        raw = None
+        if passthrough is not None:
+            line = doc.strip()
+            if line[:1] == b'{' and line[-1:] == b'}' and not passthrough.search(line):
+                raw = line
+        try:
+            # the codec decodes the raw bytes of the line directly. a line passed through is still decoded, so a
+            # malformed one is dropped like any other, but it is yielded as read rather than masked and encoded again
+            if metrics is None:
+                doc = codec.loads(doc)
             else:
-                logging.info(f"Completed file {reader.file_name}")
-                reader.close()
-                self._current_reader += 1
+                start = time.perf_counter()
+                doc = codec.loads(doc)
+                metrics.seconds["decode"] += time.perf_counter() - start
+            yield doc if raw is None else raw
+        except ValueError:
+            logging.error("Failed to decode document")
+
+
+class _Counters:
+    # counts bytes read and decode time in a reader process, with the same attributes as Metrics
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.seconds = collections.Counter()
+
+
+def _decode_files(files, tasks, results, codec, passthrough, batch_size, timed):
+    # runs in a reader process: decodes each file index taken from tasks, putting batches of its documents on results
+    index = None
+    try:
+        for index in iter(tasks.get, None):
+            counters = _Counters() if timed else None
+            batch = []
+            file_name, byte_range = files[index]
+            with FileReader(file_name, MmapSource, byte_range) as reader:
+                for doc in _decode_lines(reader.source, codec, passthrough, counters):
+                    batch.append(doc)
+                    if len(batch) >= batch_size:
+                        results.put(_batch(index, batch, counters))
+                        batch = []
+            if batch:
+                results.put(_batch(index, batch, counters))
+            results.put((_DONE, index))
+    except Exception as e:
+        results.put((_ERROR, index, "{}: {}".format(type(e).__name__, e)))
+
+
+def _batch(index, docs, counters):
+    if counters is None:
+        return _BATCH, index, docs, 0, 0.0
+    message = _BATCH, index, docs, counters.counters["bytes_read"], counters.seconds["decode"]
+    counters.counters.clear()
+    counters.seconds.clear()
+    return message
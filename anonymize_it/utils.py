@@ -1,4 +1,5 @@
 import collections
+import re
 import warnings
 from itertools import islice, chain
 import json
@@ -18,6 +19,55 @@ def flatten_nest(d, parent_key='', sep='.'):
             items.append((new_key, v))
     return dict(items)
 
+class FieldPlanNode:
+    __slots__ = ('children', 'included', 'mask_str', 'excluded', 'field')
+
+    def __init__(self):
+        self.children = {}
+        self.included = False
+        self.mask_str = None
+        self.excluded = False
+        self.field = None
+
+
+def compile_field_plan(include, exclude, sep='.'):
+    """compiles included and excluded field names into a trie of FieldPlanNodes keyed by path segment
+
+    fields sharing a prefix, e.g. source.ip and source.address, share the nodes of that prefix so documents are
+    only descended into once per prefix. excluded fields are never included, even if listed in include.
+    """
+    plan = {}
+
+    def node_for(field):
+        children = plan
+        for key in field.split(sep):
+            node = children.setdefault(key, FieldPlanNode())
+            children = node.children
+        return node
+
+    for field, mask_str in include.items():
+        if not field in exclude:
+            node = node_for(field)
+            node.included = True
+            node.mask_str = mask_str
+            node.field = field
+    for field in exclude:
+        node_for(field).excluded = True
+    return plan
+
+
+def compile_key_filter(fields, sep='.'):
+    """compiles a regex matching raw json lines that may contain any of the given fields
+
+    only the last segment of each field is looked for, as a quoted key. lines with unicode escapes always match
+    because a key could be escaped.
+    """
+    keys = sorted({field.split(sep)[-1] for field in fields})
+    patterns = [b'"' + re.escape(key.encode('utf-8')) + b'"' for key in keys]
+    patterns.append(re.escape(b'\\u'))
+    return re.compile(b'|'.join(patterns))
+
+
 def parse_config(config):
     """first pass parsing of config file
 
@@ -29,6 +79,16 @@ def parse_config(config):
     suppressed_fields = config.get('exclude')
     include_rest = config.get('include_rest')
     anonymizer = config.get('anonymizer')
+    workers = config.get('workers', 1)
+    masking = config.get('masking', {'mode': 'map'})
+    mapping_store = config.get('mapping_store', {'type': 'memory'})
+    codec = config.get('codec', 'json')
+    pipeline = config.get('pipeline')
+    scrubbing = config.get('scrubbing', {})
+    metrics = config.get('metrics')
+    profiling = config.get('profiling')
+    checkpoint = config.get('checkpoint')
+    incremental = config.get('incremental')
 
     if not source:
         raise ConfigParserError("source error: source not defined. Please check config.")
@@ -46,8 +106,20 @@ def parse_config(config):
     if not writer_type:
         raise ConfigParserError("destination error: dest type not defined. Please check config.")
 
-    Config = collections.namedtuple('Config', 'anonymizer source dest masked_fields suppressed_fields include_rest')
-    config = Config(anonymizer, source, dest, masked_fields, suppressed_fields, include_rest)
+    if not isinstance(workers, int) or workers < 1:
+        raise ConfigParserError("workers error: workers must be a positive integer. Please check config.")
+
+    if masking.get('mode') not in ('map', 'keyed', 'pool'):
+        raise ConfigParserError("masking error: masking mode must be one of map, keyed or pool. Please check config.")
+
+    if masking.get('mode') == 'keyed' and not masking.get('secret'):
+        raise ConfigParserError("masking error: keyed masking requires a secret. Please check config.")
+
+    Config = collections.namedtuple('Config', 'anonymizer source dest masked_fields suppressed_fields include_rest '
+                                              'workers masking mapping_store codec pipeline scrubbing metrics '
+                                              'profiling checkpoint incremental')
+    config = Config(anonymizer, source, dest, masked_fields, suppressed_fields, include_rest, workers, masking,
+                    mapping_store, codec, pipeline, scrubbing, metrics, profiling, checkpoint, incremental)
     return config
 
 
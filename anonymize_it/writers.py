@@ -1,22 +1,303 @@
 from abc import abstractmethod, ABCMeta
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+import getpass
+import inspect
+import json
+import logging
+import threading
+import time
 import uuid
 import os
+import tempfile
 
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, TransportError
+from google.api_core.exceptions import GoogleAPICallError
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import storage
+import requests
+from requests.adapters import HTTPAdapter
+
+import compression
+
+
+class ESWriterError(Exception):
+    pass
+
+
+class GCSWriterError(Exception):
+    pass
+
+
+# statuses of bulk requests, and of documents within them, worth retrying
+retry_statuses = {429, 502, 503, 504}
+# gcs asks for internal errors and timeouts to be retried too
+gcs_retry_statuses = retry_statuses | {408, 500}
+# the most objects a single gcs compose accepts
+max_compose_sources = 32
+# objects up to this size are uploaded in a single request, so only larger ones are given a chunk size
+gcs_multipart_size = 8 * 1024 * 1024
+# turns off the retries of an upload within google-cloud-storage, leaving them to the writer. versions before 2.0,
+# including the pinned 1.14, only take num_retries, which google-resumable-media exceeds by one, so 0 still retries
+# once and -1 does not. later versions take retry
+gcs_upload_no_retry = ({'retry': None} if 'retry' in inspect.signature(storage.Blob.upload_from_file).parameters
+                       else {'num_retries': -1})
+
+
+class EndpointSession(requests.Session):
+    # google-cloud-storage sends requests to google's hosts whatever the connection's base url, uploads always do
+    # before 2.0, so the session sends them on to the endpoint instead
+    hosts = ('https://www.googleapis.com', 'https://storage.googleapis.com')
+    # later versions switch to their mutual tls host if the session has a client certificate
+    is_mtls = False
+
+    def __init__(self, endpoint):
+        super().__init__()
+        self.endpoint = endpoint.rstrip('/')
+
+    def request(self, method, url, *args, **kwargs):
+        for host in self.hosts:
+            if url.startswith(host + '/'):
+                url = self.endpoint + url[len(host):]
+                break
+        return super().request(method, url, *args, **kwargs)
 
 
 class BaseWriter(metaclass=ABCMeta):
     def __init__(self, params):
+        """writers are streaming: each output file is opened, written one document at a time and closed
+
+        documents are serialized json as bytes or str, without a trailing newline. writers buffer internally, so
+        memory use does not grow with the number of documents in a file.
+        """
         self.type = params.get('type')
+        # kept so that parallel anonymizers can create an identical writer in each worker process
+        self.params = params
 
     @abstractmethod
-    def write_data(self, data, file_name=None):
+    def open_file(self, file_name=None):
+        pass
+
+    @abstractmethod
+    def write_document(self, doc):
+        pass
+
+    @abstractmethod
+    def close_file(self):
         pass
 
+    def prepare(self, actions=False):
+        """called once before an anonymizer opens the first file
+
+        :param actions: true if the anonymizer writes each document after a bulk action line, as the default
+            anonymizer does
+        """
+        pass
+
+    def close(self):
+        """called once after an anonymizer closes the last file, or fails"""
+        pass
+
+    def flush(self):
+        """waits until every closed file is durably written, e.g. before a checkpoint"""
+        pass
+
+    def write_data(self, data, file_name=None):
+        """writes an iterable of documents to a single output file"""
+        self.open_file(file_name)
+        for doc in data:
+            self.write_document(doc)
+        self.close_file()
+
 
 class ESWriter(BaseWriter):
     def __init__(self, params):
+        """indexes documents into elasticsearch with concurrent bulk requests
+
+        documents are gathered into bulk requests of about chunk_size bytes, and up to concurrency requests are sent at
+        once. requests, and documents within them, rejected because the cluster is overloaded are retried up to
+        max_retries times, waiting retry_delay seconds doubled on each attempt. other rejected documents are logged and
+        counted. closing a file waits for all of its documents to be indexed.
+
+        :param params: a dict like {'host': 'localhost:9200', 'index': 'anonymized', 'concurrency': 4,
+            'chunk_size': 5242880, 'disable_refresh': True}. without an index, documents are expected in pairs of a
+            bulk action and a source, which only the default anonymizer writes. with an index every source is indexed
+            into it, and the actions of an anonymizer writing them are replaced. with disable_refresh, refreshes of the index, or of refresh_index, are paused until
+            the writer is closed. username and password are prompted for unless given
+        """
         super().__init__(params)
+        self.type = 'elasticsearch'
+        self.host = params.get('host')
+        self.index = params.get('index')
+        self.doc_type = params.get('doc_type', 'doc')
+        self.use_ssl = params.get('use_ssl', False)
+        self.concurrency = params.get('concurrency', 4)
+        self.chunk_size = params.get('chunk_size', 5 * 1024 * 1024)
+        self.max_retries = params.get('max_retries', 5)
+        self.retry_delay = params.get('retry_delay', 1)
+        self.disable_refresh = params.get('disable_refresh', False)
+        self.refresh_index = params.get('refresh_index', self.index)
+        username = params.get('username')
+        password = params.get('password')
+        if username is None:
+            username = getpass.getpass('elasticsearch username: ')
+            password = getpass.getpass('elasticsearch password: ')
+        # workers of a parallel anonymizer write with these params, leaving refreshes to the writer that created them
+        self.params = dict(params, username=username, password=password, disable_refresh=False)
+
+        if not self.host:
+            raise ESWriterError("elasticsearch configuration malformed. please check config.")
+        if not isinstance(self.concurrency, int) or self.concurrency < 1:
+            raise ESWriterError("concurrency must be a positive integer. please check config.")
+        if self.disable_refresh and not self.refresh_index:
+            raise ESWriterError("disable_refresh requires an index or refresh_index. please check config.")
+
+        self.es = Elasticsearch([self.host], use_ssl=self.use_ssl, verify_certs=False,
+                                http_auth=(username, password) if username else None,
+                                maxsize=max(10, self.concurrency))
+        if self.index:
+            self.action = json.dumps({"index": {"_index": self.index, "_type": self.doc_type}}).encode('utf-8')
+        self.executor = None
+        self.pending = []
+        self.docs = []
+        self.size = 0
+        self.pending_action = None
+        self.actions = False
+        self.refresh_intervals = {}
+        self.lock = threading.Lock()
+        self.indexed = 0
+        self.rejected = 0
+        self.retried = 0
+
+    def prepare(self, actions=False):
+        if not self.index and not actions:
+            # documents would be paired with each other, and each indexed with the one before it as its action
+            raise ESWriterError("this anonymizer writes no bulk actions, an index is required. please check config.")
+        self.actions = actions
+        if self.disable_refresh:
+            self.__pause_refresh()
+
+    def __pause_refresh(self):
+        settings = self.es.indices.get_settings(index=self.refresh_index, name='index.refresh_interval',
+                                                ignore=404)
+        if settings.get('status') == 404:
+            # created up front, so refreshes are paused before the first document arrives
+            self.es.indices.create(index=self.refresh_index, body={"settings": {"index": {"refresh_interval": "-1"}}})
+            self.refresh_intervals = {self.refresh_index: None}
+        elif not settings:
+            logging.warning("no index matches {}, refresh not paused".format(self.refresh_index))
+            return
+        else:
+            # indices left at the default have no refresh_interval setting, and are reset to it with None
+            self.refresh_intervals = {index: setting['settings'].get('index', {}).get('refresh_interval')
+                                      for index, setting in settings.items()}
+            for index in self.refresh_intervals:
+                self.es.indices.put_settings(index=index, body={"index": {"refresh_interval": "-1"}})
+        logging.info("refresh paused on {}".format(", ".join(sorted(self.refresh_intervals))))
+
+    def __restore_refresh(self):
+        for index, interval in self.refresh_intervals.items():
+            self.es.indices.put_settings(index=index, body={"index": {"refresh_interval": interval}})
+        if self.refresh_intervals:
+            self.es.indices.refresh(index=",".join(self.refresh_intervals))
+            logging.info("refresh restored on {}".format(", ".join(sorted(self.refresh_intervals))))
+        self.refresh_intervals = {}
+
+    def open_file(self, file_name=None):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def write_document(self, doc):
+        if isinstance(doc, str):
+            doc = doc.encode('utf-8')
+        if self.index and not self.actions:
+            action = self.action
+        elif self.pending_action is None:
+            self.pending_action = doc
+            return
+        else:
+            action, self.pending_action = self.pending_action, None
+            # the action's index is the one the document was read from, the configured index takes its place
+            if self.index:
+                action = self.action
+        self.docs.append((action, doc))
+        self.size += len(action) + len(doc) + 2
+        if self.size >= self.chunk_size:
+            self.__submit()
+
+    def __submit(self):
+        docs, self.docs, self.size = self.docs, [], 0
+        # at most concurrency requests are in flight, so memory is bounded however fast documents arrive
+        while len(self.pending) >= self.concurrency:
+            self.__wait(FIRST_COMPLETED)
+        self.pending.append(self.executor.submit(self.__send, docs))
+
+    def __wait(self, return_when):
+        done, pending = wait(self.pending, return_when=return_when)
+        self.pending = list(pending)
+        for future in done:
+            # raises the error of a failed request
+            future.result()
+
+    def __send(self, docs):
+        for attempt in range(self.max_retries + 1):
+            body = b"".join(action + b"\n" + doc + b"\n" for action, doc in docs)
+            try:
+                response = self.es.transport.perform_request('POST', '/_bulk', body=body,
+                                                             headers={'content-type': 'application/x-ndjson'})
+            except TransportError as e:
+                if not isinstance(e, ESConnectionError) and e.status_code not in retry_statuses:
+                    raise ESWriterError("bulk request failed: {}".format(e)) from e
+                retry = docs
+                reason = e
+            else:
+                retry = self.__check_items(docs, response)
+                reason = "{} documents rejected".format(len(retry))
+            if not retry:
+                return
+            if attempt == self.max_retries:
+                raise ESWriterError("bulk request failed after {} retries: {}".format(attempt, reason))
+            delay = self.retry_delay * 2 ** attempt
+            logging.warning("bulk request failed, retrying {} documents in {}s: {}".format(len(retry), delay, reason))
+            with self.lock:
+                self.retried += len(retry)
+            time.sleep(delay)
+            docs = retry
+
+    def __check_items(self, docs, response):
+        """counts the documents of a bulk response, returning those to be retried"""
+        retry = []
+        rejected = 0
+        if response.get('errors'):
+            for (action, doc), item in zip(docs, response['items']):
+                result = next(iter(item.values()))
+                status = result.get('status', 200)
+                if status in retry_statuses:
+                    retry.append((action, doc))
+                elif status >= 300:
+                    rejected += 1
+                    if self.rejected + rejected <= 10:
+                        logging.warning("document rejected: {}".format(result.get('error')))
+        with self.lock:
+            self.indexed += len(docs) - len(retry) - rejected
+            self.rejected += rejected
+        return retry
+
+    def close_file(self):
+        if self.pending_action is not None:
+            raise ESWriterError("bulk action without a document, an index is required unless documents come in "
+                                "pairs of an action and a source")
+        if self.docs:
+            self.__submit()
+        self.__wait(ALL_COMPLETED)
+        logging.info("{} documents indexed, {} rejected".format(self.indexed, self.rejected))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.pending = []
+        self.__restore_refresh()
 
 
 # for tests only
@@ -28,45 +309,317 @@ class MemoryWriter(BaseWriter):
         self.keep_buffer = params.get("keep", True)
         self.buffer = []
 
-    def write_data(self, data, file_name=None):
+    def open_file(self, file_name=None):
+        pass
+
+    def write_document(self, doc):
         if self.keep_buffer:
-            self.buffer = self.buffer + data
+            self.buffer.append(doc.decode('utf-8') if isinstance(doc, bytes) else doc)
+
+    def close_file(self):
+        pass
 
 
 class FSWriter(BaseWriter):
     def __init__(self, params):
+        """writes each output file to directory as newline delimited json
+
+        :param params: a dict like {'directory': 'output', 'compression': {'type': 'gzip', 'level': 6},
+            'max_file_size': 1073741824}. compressed files are named .json.gz or .json.zst, see compression.Compressor.
+            a file is split into parts once max_file_size bytes of documents, before compression, are written to it.
+            later parts are named name.part1.json, name.part2.json and so on
+        """
         super().__init__(params)
         self.type = 'filesystem'
         self.out_dir = params.get('directory')
+        self.buffer_size = params.get('buffer_size', 1024 * 1024)
+        self.compressor = compression.create_compressor(params.get('compression'))
+        self.max_file_size = params.get('max_file_size')
+        self.path = None
+        self.part = 0
+        self.part_size = 0
+        self.raw = None
+        self.file = None
 
-    def write_data(self, data, file_name=None):
+    def open_file(self, file_name=None):
         if not file_name:
             file_name = str(uuid.uuid4())
         dir_path = os.path.join(os.path.abspath(os.getcwd()), self.out_dir)
         os.makedirs(dir_path, exist_ok=True)
-        with open("{}/{}.json".format(dir_path, file_name), 'w') as f:
-            for d in data:
-                f.write('{}\n'.format(d))
+        self.path = "{}/{}".format(dir_path, file_name)
+        self.part = 0
+        self.__open_part()
+
+    def __open_part(self):
+        path = "{}{}.json{}".format(self.path, ".part{}".format(self.part) if self.part else "",
+                                    self.compressor.extension if self.compressor else "")
+        self.raw = open(path, 'wb', buffering=self.buffer_size)
+        self.file = self.compressor.open(self.raw) if self.compressor else self.raw
+        self.part_size = 0
+
+    def __close_part(self):
+        self.file.close()
+        if self.file is not self.raw:
+            self.raw.close()
+        self.raw = None
+        self.file = None
+
+    def write_document(self, doc):
+        if isinstance(doc, str):
+            doc = doc.encode('utf-8')
+        if self.file is None:
+            self.__open_part()
+        self.file.write(doc)
+        self.file.write(b'\n')
+        if self.max_file_size:
+            self.part_size += len(doc) + 1
+            if self.part_size >= self.max_file_size:
+                # the next part is only opened once there is a document for it
+                self.__close_part()
+                self.part += 1
+
+    def close_file(self):
+        if self.file is not None:
+            self.__close_part()
+
+    def close(self):
+        if self.compressor:
+            self.compressor.close()
 
 
 class GCSWriter(BaseWriter):
     def __init__(self, params):
+        """uploads each output file to a GCS bucket, compressed and split into parts like FSWriter's files
+
+        objects are uploaded on a pool of upload_concurrency threads sharing the client's authenticated session, so
+        masking carries on while earlier objects upload. objects up to 8MB are sent in a single request, larger ones
+        as resumable uploads in chunks of chunk_size. failed uploads are retried up to max_retries times, waiting
+        retry_delay seconds doubled on each attempt. closing the writer waits for every upload to finish.
+
+        :param params: a dict like {'bucket': 'anonymized', 'credentials': 'credentials.json', 'dir_pattern': 'logs/',
+            'upload_concurrency': 4, 'compose_size': 268435456}. with compose_size, objects are uploaded in components
+            holding compose_size bytes of documents, before compression, which are uploaded concurrently and then
+            composed into the object. endpoint, e.g. a local fake server or emulator, is used without credentials
+        """
         super().__init__(params)
         self.type = 'gcs'
         self.bucket = params.get('bucket')
         self.credentials = params.get('credentials')
-        self.out_dir = params.get('dir_pattern')
+        self.endpoint = params.get('endpoint')
+        self.out_dir = params.get('dir_pattern', '')
+        # objects are uploaded in chunks of chunk_size bytes, which must be a multiple of 256KB
+        self.chunk_size = params.get('chunk_size', 8 * 1024 * 1024)
+        # up to spool_size bytes of an object are held in memory before spilling to a temporary file
+        self.spool_size = params.get('spool_size', 64 * 1024 * 1024)
+        self.upload_concurrency = params.get('upload_concurrency', 4)
+        self.max_retries = params.get('max_retries', 5)
+        self.retry_delay = params.get('retry_delay', 1)
+        self.compose_size = params.get('compose_size')
+        self.compressor = compression.create_compressor(params.get('compression'))
+        self.max_file_size = params.get('max_file_size')
+        if not isinstance(self.upload_concurrency, int) or self.upload_concurrency < 1:
+            raise GCSWriterError("upload_concurrency must be a positive integer. please check config.")
+        self.file_name = None
+        self.name = None
+        self.part = 0
+        self.part_size = 0
+        self.component_size = 0
+        self.components = []
+        self.spool = None
+        self.file = None
+        self.first = True
+        self.executor = None
+        self.composer = None
+        self.pending = []
+        self.lock = threading.Lock()
+        self.uploaded = 0
+        self.bytes_uploaded = 0
+        self.composed = 0
+        self.retried = 0
 
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = self.credentials
-        self.client = storage.Client()
+        if self.endpoint:
+            # the pinned google-cloud-storage takes no client_options, so the session directs requests to the endpoint
+            self.client = storage.Client(project=params.get('project', 'anonymize-it'),
+                                         credentials=AnonymousCredentials(), _http=EndpointSession(self.endpoint))
+        else:
+            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = self.credentials
+            self.client = storage.Client()
+        # every upload thread shares the client's session, which keeps a connection open for each of them
+        adapter = HTTPAdapter(pool_maxsize=self.upload_concurrency)
+        self.client._http.mount('https://', adapter)
+        self.client._http.mount('http://', adapter)
         self.bucket = self.client.get_bucket(self.bucket)
 
-    def write_data(self, data, file_name=None):
+    def open_file(self, file_name=None):
         if not file_name:
             file_name = str(uuid.uuid4())
-        blob = self.bucket.blob('{}{}'.format(self.out_dir, file_name))
-        blob.upload_from_string("\n".join(data))
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.upload_concurrency)
+            # composes wait for their components, so they run apart from uploads
+            self.composer = ThreadPoolExecutor(max_workers=self.upload_concurrency)
+        self.file_name = file_name
+        self.part = 0
+        self.__open_part()
+
+    def __open_part(self):
+        self.name = '{}{}{}{}'.format(self.out_dir, self.file_name, '.part{}'.format(self.part) if self.part else '',
+                                      self.compressor.extension if self.compressor else '')
+        self.components = []
+        self.part_size = 0
+        self.first = True
+        self.__open_spool()
+
+    def __open_spool(self):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self.file = self.compressor.open(self.spool) if self.compressor else self.spool
+        self.component_size = 0
+
+    def __close_spool(self, name):
+        if self.file is not self.spool:
+            self.file.close()
+        spool = self.spool
+        self.spool = None
+        self.file = None
+        return self.__submit(self.executor, self.__upload, name, spool)
+
+    def __close_component(self):
+        # compressed blocks are whole gzip members or zstd frames, so composed components are still a valid file
+        name = '{}.component{}'.format(self.name, len(self.components))
+        self.components.append(self.__close_spool(name))
+
+    def __close_part(self):
+        if not self.components:
+            self.__close_spool(self.name)
+        else:
+            if self.file is not None:
+                self.__close_component()
+            self.__submit(self.composer, self.__compose, self.name, self.components)
+        self.name = None
+        self.components = []
+
+    def __submit(self, executor, function, *args):
+        # at most twice upload_concurrency objects are pending, bounding the spools held however fast documents arrive
+        while len(self.pending) >= 2 * self.upload_concurrency:
+            self.__wait(FIRST_COMPLETED)
+        future = executor.submit(function, *args)
+        self.pending.append(future)
+        return future
+
+    def __wait(self, return_when):
+        done, pending = wait(self.pending, return_when=return_when)
+        self.pending = list(pending)
+        for future in done:
+            # raises the error of a failed upload
+            future.result()
+
+    def __retry(self, action, function):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function()
+            except (GoogleAPICallError, requests.ConnectionError, requests.Timeout) as e:
+                if isinstance(e, GoogleAPICallError) and e.code not in gcs_retry_statuses:
+                    raise GCSWriterError("{} failed: {}".format(action, e)) from e
+                if attempt == self.max_retries:
+                    raise GCSWriterError("{} failed after {} retries: {}".format(action, attempt, e)) from e
+                delay = self.retry_delay * 2 ** attempt
+                logging.warning("{} failed, retrying in {}s: {}".format(action, delay, e))
+                with self.lock:
+                    self.retried += 1
+                time.sleep(delay)
+
+    def __upload(self, name, spool):
+        try:
+            size = spool.tell()
+            blob = self.bucket.blob(name, chunk_size=self.chunk_size if size > gcs_multipart_size else None)
+            # retries are left to __retry, which restarts the upload from the start of the spool
+            self.__retry("upload of {}".format(name),
+                         lambda: blob.upload_from_file(spool, rewind=True, size=size, **gcs_upload_no_retry))
+        finally:
+            spool.close()
+        with self.lock:
+            self.uploaded += 1
+            self.bytes_uploaded += size
+        return blob
+
+    def __compose(self, name, components):
+        sources = [component.result() for component in components]
+        temporary = list(sources)
+        level = 0
+        # a compose takes at most 32 sources, so many components are composed in steps
+        while len(sources) > max_compose_sources:
+            composites = []
+            for i in range(0, len(sources), max_compose_sources):
+                composite = self.bucket.blob('{}.composite{}-{}'.format(name, level, len(composites)))
+                self.__compose_blob(composite, sources[i:i + max_compose_sources])
+                composites.append(composite)
+            temporary.extend(composites)
+            sources = composites
+            level += 1
+        blob = self.bucket.blob(name)
+        self.__compose_blob(blob, sources)
+        for source in temporary:
+            source.delete()
+        with self.lock:
+            self.composed += 1
+        return blob
+
+    def __compose_blob(self, blob, sources):
+        blob.content_type = sources[0].content_type
+        # google-cloud-storage does not retry a compose without a generation precondition, so __retry is the only one
+        self.__retry("compose of {}".format(blob.name), lambda: blob.compose(sources))
+
+    def write_document(self, doc):
+        if isinstance(doc, str):
+            doc = doc.encode('utf-8')
+        if self.name is None:
+            self.__open_part()
+        elif self.file is None:
+            self.__open_spool()
+        # documents are separated rather than terminated by newlines
+        if not self.first:
+            self.file.write(b'\n')
+        self.first = False
+        self.file.write(doc)
+        if self.max_file_size or self.compose_size:
+            self.part_size += len(doc) + 1
+            self.component_size += len(doc) + 1
+            if self.max_file_size and self.part_size >= self.max_file_size:
+                self.__close_part()
+                self.part += 1
+            elif self.compose_size and self.component_size >= self.compose_size:
+                # the next component is only started once there is a document for it
+                self.__close_component()
+
+    def close_file(self):
+        # uploads carry on in the background, flush and close wait for them
+        if self.name is not None:
+            self.__close_part()
+
+    def flush(self):
+        if self.pending:
+            self.__wait(ALL_COMPLETED)
 
+    def close(self):
+        if self.spool is not None:
+            # the file being written when the run failed is not uploaded
+            self.spool.close()
+            self.spool = None
+            self.file = None
+            self.name = None
+        try:
+            if self.pending:
+                self.__wait(ALL_COMPLETED)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.composer.shutdown()
+                self.executor = None
+                self.composer = None
+            self.pending = []
+            if self.compressor:
+                self.compressor.close()
+        logging.info("{} objects uploaded, {} bytes, {} composed, {} retries".format(
+            self.uploaded, self.bytes_uploaded, self.composed, self.retried))
 
 
 writer_mapping = {
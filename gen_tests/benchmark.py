@@ -0,0 +1,290 @@
+import argparse
+import datetime
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import corpus
+
+# masking presets a run is benchmarked with, passed to the anonymizer as masking and mapping_store
+maskings = {
+    "map": ({"mode": "map"}, {"type": "memory"}),
+    "keyed": ({"mode": "keyed", "secret": "benchmark"}, {"type": "memory"}),
+    "pool": ({"mode": "pool", "batch_size": 10000}, {"type": "memory"}),
+    "sqlite": ({"mode": "map"}, {"type": "sqlite", "cache_size": 10000})
+}
+
+readers = ["file"]
+writers = ["memory", "fs"]
+# compressions fs writers are benchmarked with, none writes plain json
+compressions = ["none", "gzip", "zstd"]
+
+
+class TimedReader:
+    def __init__(self, reader):
+        """times how long the anonymizer waits for documents from a reader, which includes decoding them"""
+        self.reader = reader
+        self.seconds = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def get_data(self, *args, **kwargs):
+        data = iter(self.reader.get_data(*args, **kwargs))
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(data)
+            except StopIteration:
+                self.seconds += time.perf_counter() - start
+                return
+            self.seconds += time.perf_counter() - start
+            yield item
+
+
+class TimedWriter:
+    def __init__(self, writer):
+        """times how long the anonymizer spends handing documents to a writer, including flushing them"""
+        self.writer = writer
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def open_file(self, file_name=None):
+        start = time.perf_counter()
+        self.writer.open_file(file_name)
+        self.seconds += time.perf_counter() - start
+
+    def write_document(self, doc):
+        start = time.perf_counter()
+        self.writer.write_document(doc)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(doc) + 1
+
+    def close_file(self):
+        start = time.perf_counter()
+        self.writer.close_file()
+        self.seconds += time.perf_counter() - start
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario(scenario):
+    # runs in a fresh process, so peak RSS belongs to this scenario alone
+    from anonymizers import LazyAnonymizer
+    from readers import JSONFileReader
+    from writers import FSWriter, MemoryWriter
+
+    masking, mapping_store = maskings[scenario["masking"]]
+    include, exclude = corpus.masked_fields[scenario["shape"]]
+    reader = TimedReader(JSONFileReader({"filepath": scenario["path"]}, include, exclude))
+    if scenario["writer"] == "fs":
+        output = tempfile.TemporaryDirectory(prefix="anonymize-it-benchmark-")
+        params = {"directory": output.name}
+        if scenario["compression"] != "none":
+            params["compression"] = scenario["compression"]
+        writer = TimedWriter(FSWriter(params))
+    else:
+        output = None
+        writer = TimedWriter(MemoryWriter({"keep": False}))
+    anon = LazyAnonymizer(reader=reader, writer=writer, masking=masking, mapping_store=mapping_store,
+                          codec=scenario["codec"])
+
+    start = time.perf_counter()
+    docs = anon.anonymize(include_rest=scenario["include_rest"])
+    seconds = time.perf_counter() - start
+    compressed = None
+    if output:
+        compressed = sum(entry.stat().st_size for entry in os.scandir(output.name))
+        output.cleanup()
+    compressor = getattr(writer.writer, "compressor", None)
+
+    size = os.path.getsize(scenario["path"])
+    return {
+        "name": scenario["name"],
+        "shape": scenario["shape"],
+        "masking": scenario["masking"],
+        "reader": scenario["reader"],
+        "writer": scenario["writer"],
+        "include_rest": scenario["include_rest"],
+        "codec": scenario["codec"],
+        "compression": scenario["compression"],
+        "docs": docs,
+        "bytes": size,
+        "bytes_written": writer.bytes,
+        "bytes_stored": compressed,
+        "ratio": writer.bytes / compressed if compressed else None,
+        # per thread, compression runs on several threads alongside masking
+        "compress_mb_per_sec": compressor.bytes_in / compressor.seconds / (1024 * 1024)
+        if compressor and compressor.seconds else None,
+        "seconds": seconds,
+        "docs_per_sec": docs / seconds,
+        "mb_per_sec": size / seconds / (1024 * 1024),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": {
+            "read": reader.seconds,
+            "mask_encode": max(0.0, seconds - reader.seconds - writer.seconds),
+            "write": writer.seconds
+        }
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    directory = args.dir or tempfile.mkdtemp(prefix="anonymize-it-corpus-")
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for shape in args.shapes:
+        path = os.path.join(directory, "{}-{}-{}-{}.json".format(shape, args.docs, args.cardinality, args.seed))
+        if not os.path.exists(path):
+            print("generating {} {} documents with cardinality {}".format(args.docs, shape, args.cardinality))
+            corpus.write_corpus(path, shape, args.docs, args.cardinality, args.seed)
+        paths[shape] = path
+
+    scenarios = []
+    for shape, masking, reader, writer, compression, include_rest in itertools.product(
+            args.shapes, args.maskings, readers, args.writers, args.compressions, args.include_rest):
+        if compression != "none" and writer != "fs":
+            continue
+        if compression == "zstd" and importlib.util.find_spec("zstandard") is None:
+            print("zstandard is not installed, skipping zstd scenarios")
+            continue
+        # uncompressed scenarios keep their names, so results stay comparable with earlier runs
+        label = writer if compression == "none" else "{}+{}".format(writer, compression)
+        scenarios.append({
+            "name": "{}/{}/{}/{}/{}".format(shape, masking, reader, label, "rest" if include_rest else "fields"),
+            "shape": shape, "masking": masking, "reader": reader, "writer": writer, "compression": compression,
+            "include_rest": include_rest, "codec": args.codec, "path": paths[shape]
+        })
+
+    results = []
+    # a process per scenario, started fresh so no scenario inherits another's memory or caches
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for scenario in scenarios:
+            for repeat in range(args.repeat):
+                result = pool.apply(run_scenario, (scenario,))
+                result["repeat"] = repeat
+                results.append(result)
+                line = "{:<40} {:>10.0f} docs/s {:>8.2f} MB/s {:>8.1f} MB rss  read {:.2f}s mask {:.2f}s write {:.2f}s"\
+                    .format(result["name"], result["docs_per_sec"], result["mb_per_sec"], result["peak_rss_mb"],
+                            result["stages"]["read"], result["stages"]["mask_encode"], result["stages"]["write"])
+                if result["compress_mb_per_sec"]:
+                    line += "  ratio {:.1f}x compress {:.0f} MB/s".format(result["ratio"],
+                                                                        result["compress_mb_per_sec"])
+                print(line)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "docs": args.docs,
+            "cardinality": args.cardinality,
+            "seed": args.seed,
+            "codec": args.codec
+        },
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("results written to {}".format(args.output))
+
+
+def best(results):
+    # the fastest of each scenario's repeats is the least disturbed by whatever else the machine was doing
+    by_name = {}
+    for result in results:
+        if result["name"] not in by_name or result["docs_per_sec"] > by_name[result["name"]]["docs_per_sec"]:
+            by_name[result["name"]] = result
+    return by_name
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print("baseline {} candidate {}".format(baseline["meta"].get("commit"), candidate["meta"].get("commit")))
+    before = best(baseline["results"])
+    after = best(candidate["results"])
+    regressions = []
+    for name in sorted(set(before) & set(after)):
+        speed = after[name]["docs_per_sec"] / before[name]["docs_per_sec"] - 1
+        memory = after[name]["peak_rss_mb"] / before[name]["peak_rss_mb"] - 1
+        flags = []
+        if speed < -args.threshold:
+            flags.append("slower")
+        if memory > args.threshold:
+            flags.append("more memory")
+        if flags:
+            regressions.append(name)
+        print("{:<40} {:>10.0f} -> {:>10.0f} docs/s {:>+7.1%}  {:>8.1f} -> {:>8.1f} MB rss {:>+7.1%}  {}".format(
+            name, before[name]["docs_per_sec"], after[name]["docs_per_sec"], speed, before[name]["peak_rss_mb"],
+            after[name]["peak_rss_mb"], memory, ", ".join(flags)))
+    for name in sorted(set(before) ^ set(after)):
+        print("{:<40} only in {}".format(name, "baseline" if name in before else "candidate"))
+    if regressions:
+        print("{} regressions beyond {:.0%}".format(len(regressions), args.threshold))
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark anonymize-it over synthetic corpora")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="anonymize synthetic corpora and record the results")
+    run_parser.add_argument("--docs", type=int, default=100000, help="documents per corpus")
+    run_parser.add_argument("--cardinality", type=int, default=10000, help="distinct values per masked field")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--shapes", nargs="+", default=sorted(corpus.shapes), choices=sorted(corpus.shapes))
+    run_parser.add_argument("--maskings", nargs="+", default=sorted(maskings), choices=sorted(maskings))
+    run_parser.add_argument("--writers", nargs="+", default=writers, choices=writers)
+    run_parser.add_argument("--compressions", nargs="+", default=["none", "gzip"], choices=compressions,
+                            help="compressions of fs writers")
+    run_parser.add_argument("--include-rest", nargs="+", type=lambda value: value == "true", default=[True, False],
+                            help="true, false or both")
+    run_parser.add_argument("--codec", default="json")
+    run_parser.add_argument("--repeat", type=int, default=1, help="runs per scenario, the fastest is compared")
+    run_parser.add_argument("--dir", help="where corpora are generated, and reused if they already exist")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+
+    compare_parser = commands.add_parser("compare", help="compare two sets of results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="relative change in docs/s or peak RSS reported as a regression")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
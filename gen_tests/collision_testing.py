@@ -1,36 +1,79 @@
-from faker import Faker
-import sys
 import os
+import sys
+import timeit
+
+from allocators import Allocator, IssuedSet, fake_key
+from fakers import faker, file_path, geo_point, ipv4, service_name, username, variant_providers
+from mappings import create_store
+
+# the providers used for masking, as named in masked_fields
+providers = {
+    "file_path": file_path,
+    "ipv4": ipv4,
+    "geo_point": geo_point,
+    "service": service_name,
+    "username": username
+}
+
+stores = {
+    "memory": {"type": "memory"},
+    "sqlite": {"type": "sqlite", "cache_size": 100000}
+}
+
+
+def raw_unique(provider, n):
+    # how often the provider repeats itself without an allocator
+    return len({fake_key(provider(i)) for i in range(n)})
+
+
+def allocate(name, provider, store_params, n):
+    store = create_store(store_params)
+    field_map = store.create_field_maps([name])[name]
+    if store_params["type"] == "memory":
+        issued = IssuedSet()
+    else:
+        issued = store.create_issued_sets([name])[name]
+    allocator = Allocator(name, provider, issued, variant=variant_providers.get(name))
 
+    def run():
+        for i in range(n):
+            # masks are written to the store as the anonymizers do, so sqlite lookups see them
+            field_map[i] = allocator(i)
 
-def main(seed):
-    f = Faker()
-    f.seed(seed)
-    num = [10, 100, 1000, 10000, 100000, 1000000]
-    providers = [f.file_path, f.ipv4, f.phone_number, f.credit_card_number]
-    # generate fake files
+    seconds = timeit.timeit(run, number=1)
+    store.close()
+    return seconds, allocator.stats()
 
-    if not os.path.exists("collision_results.csv"):
-        with open("collision_results.csv", 'w') as f:
-            f.write("seed, provider, total, unique, pct_unique\n")
 
-    with open("collision_results.csv", "a") as f:
-        for provider in providers:
-            print("working on: {}".format(provider.__name__))
-            for n in num:
-                files = []
-                for i in range(n):
-                    files.append(provider())
+def main(seed, sizes):
+    faker.seed_instance(seed)
+    if not os.path.exists("allocator_results.csv"):
+        with open("allocator_results.csv", 'w') as f:
+            f.write("seed,provider,store,total,raw_unique,pct_raw_unique,seconds,allocations_per_sec,collisions,"
+                    "varied\n")
 
-                f.write("{},{},{},{},{: .4f}\n".format(
-                    seed,
-                    provider.__name__,
-                    n,
-                    len(list(set(files))),
-                    100*((len(list(set(files))))/n))
-                )
+    with open("allocator_results.csv", "a") as f:
+        for name, provider in providers.items():
+            print("working on: {}".format(name))
+            for n in sizes:
+                unique = raw_unique(provider, n)
+                for store_name, store_params in stores.items():
+                    seconds, stats = allocate(name, provider, store_params, n)
+                    f.write("{},{},{},{},{},{:.4f},{:.3f},{:.0f},{},{}\n".format(
+                        seed,
+                        name,
+                        store_name,
+                        n,
+                        unique,
+                        100 * unique / n,
+                        seconds,
+                        stats["allocated"] / seconds,
+                        stats["collisions"],
+                        stats["varied"])
+                    )
 
 
 if __name__ == "__main__":
-    seed = sys.argv[1]
-    main(seed)
+    seed = int(sys.argv[1])
+    sizes = [int(size) for size in sys.argv[2:]] or [10, 100, 1000, 10000, 100000, 1000000]
+    main(seed, sizes)
@@ -0,0 +1,167 @@
+import datetime
+import json
+import random
+import sys
+
+# synthetic corpora shaped like the logs anonymize-it is run over. values are drawn from pools of a fixed size, so the
+# cardinality of the masked fields can be controlled independently of the number of documents
+
+methods = ["GET", "GET", "GET", "POST", "PUT", "DELETE"]
+statuses = [200, 200, 200, 201, 301, 304, 404, 500]
+levels = ["INFO", "INFO", "INFO", "WARN", "ERROR", "DEBUG"]
+agents = ["Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/84.0.4147.105 Safari/537.36",
+          "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.2",
+          "curl/7.58.0", "Go-http-client/1.1", "python-requests/2.24.0"]
+words = ["order", "payment", "user", "session", "cache", "query", "index", "search", "upload", "token", "request",
+         "response", "timeout", "retry", "connection", "worker", "queue", "batch", "shard", "node"]
+places = [("US", "North America", 37.751, -97.822), ("GB", "Europe", 51.4964, -0.1224),
+          ("DE", "Europe", 51.2993, 9.491), ("JP", "Asia", 35.69, 139.69), ("BR", "South America", -22.8305, -43.2192),
+          ("AU", "Oceania", -33.494, 143.2104), ("IN", "Asia", 21.0, 78.0), ("ZA", "Africa", -29.0, 24.0)]
+
+
+class Pools:
+    def __init__(self, rng, cardinality):
+        """the distinct values documents are drawn from, cardinality of each kind"""
+        self.rng = rng
+        self.ips = ["%d.%d.%d.%d" % (rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255),
+                                     rng.randint(1, 254)) for _ in range(cardinality)]
+        self.users = ["%s.%s%d" % (rng.choice(words), rng.choice(words), i) for i in range(cardinality)]
+        self.emails = ["%s@example%d.com" % (user, i % 97) for i, user in enumerate(self.users)]
+        self.paths = ["/var/log/%s/%s-%d.log" % (rng.choice(words), rng.choice(words), i) for i in range(cardinality)]
+        self.hosts = ["%s-%s-%d" % (rng.choice(words), rng.choice(words), i) for i in range(max(1, cardinality // 100))]
+        self.services = ["%s-%s" % (rng.choice(words), rng.choice(words)) for _ in range(max(1, cardinality // 100))]
+        self.urls = ["/api/v1/%s/%s/%d" % (rng.choice(words), rng.choice(words), i) for i in range(cardinality)]
+        self.points = [(place, round(place[2] + rng.uniform(-1, 1), 4), round(place[3] + rng.uniform(-1, 1), 4))
+                       for place in (rng.choice(places) for _ in range(cardinality))]
+
+    def pick(self, values):
+        return values[self.rng.randrange(len(values))]
+
+    def uuid(self):
+        return "%08x-%04x-%04x-%04x-%012x" % (self.rng.getrandbits(32), self.rng.getrandbits(16),
+                                              self.rng.getrandbits(16), self.rng.getrandbits(16),
+                                              self.rng.getrandbits(48))
+
+    def geo(self):
+        (iso, continent, _, _), lat, lon = self.pick(self.points)
+        return {"country_iso_code": iso, "location": {"lat": lat, "lon": lon}, "continent_name": continent}
+
+
+def nginx_doc(pools, timestamp):
+    ip = pools.pick(pools.ips)
+    user = pools.pick(pools.users)
+    method = pools.pick(methods)
+    url = pools.pick(pools.urls)
+    status = pools.pick(statuses)
+    size = pools.rng.randint(100, 50000)
+    agent = pools.pick(agents)
+    return {
+        "@timestamp": timestamp.isoformat() + "Z",
+        "message": '%s - %s [%s] "%s %s HTTP/1.1" %d %d "-" "%s"' % (ip, user, timestamp.strftime("%d/%b/%Y:%H:%M:%S"),
+                                                                    method, url, status, size, agent),
+        "log": {"file": {"path": "/var/log/nginx/access.log"}},
+        "host": {"hostname": pools.pick(pools.hosts)},
+        "source": {"ip": ip, "address": ip},
+        "user": {"name": user},
+        "geo": pools.geo(),
+        "http": {"request": {"method": method}, "response": {"status_code": status, "body": {"bytes": size}}},
+        "url": {"original": url},
+        "user_agent": {"original": agent},
+        "related": {"ip": [ip], "user": [user]},
+        "event": {"dataset": "nginx.access", "module": "nginx"}
+    }
+
+
+def app_doc(pools, timestamp):
+    index = pools.rng.randrange(len(pools.users))
+    user = pools.users[index]
+    ip = pools.pick(pools.ips)
+    request = pools.uuid()
+    template = pools.rng.randrange(4)
+    if template == 0:
+        message = "[%s] request %s from %s completed in %dms" % (pools.pick(levels), request, ip,
+                                                                 pools.rng.randint(1, 2000))
+    elif template == 1:
+        message = "sent notification to %s for %s %s" % (pools.emails[index], pools.pick(words),
+                                                         pools.rng.randint(1, 100000))
+    elif template == 2:
+        message = "%s %s failed after %d retries, connection to %s:%d refused" % (
+            pools.pick(words), pools.pick(words), pools.rng.randint(1, 5), ip, pools.rng.randint(1024, 65535))
+    else:
+        message = "%s %s %s %s" % tuple(pools.pick(words) for _ in range(4))
+    return {
+        "@timestamp": timestamp.isoformat() + "Z",
+        "message": message,
+        "log": {"level": pools.pick(levels), "file": {"path": pools.pick(pools.paths)}},
+        "service": {"name": pools.pick(pools.services)},
+        "host": {"hostname": pools.pick(pools.hosts), "ip": [pools.pick(pools.ips)]},
+        "user": {"name": user},
+        "trace": {"id": request},
+        "related": {"user": [user]}
+    }
+
+
+def ecs_doc(pools, timestamp):
+    host = pools.pick(pools.hosts)
+    service = pools.pick(pools.services)
+    pod = "%s-%x" % (service, pools.rng.getrandbits(24))
+    doc = app_doc(pools, timestamp)
+    doc.update({
+        "kubernetes": {"container": {"image": "docker.example.com/%s:7.8.0" % service, "name": service},
+                       "node": {"name": host}, "pod": {"uid": pools.uuid(), "name": pod},
+                       "namespace": service, "labels": {"app": service}},
+        "agent": {"hostname": host, "name": host, "id": pools.uuid(), "type": "filebeat", "version": "7.8.0"},
+        "cloud": {"availability_zone": "us-central1-a", "instance": {"name": host}, "provider": "gcp"},
+        "ecs": {"version": "1.5.0"},
+        "stream": "stdout"
+    })
+    return doc
+
+
+shapes = {
+    "nginx": nginx_doc,
+    "app": app_doc,
+    "ecs": ecs_doc
+}
+
+# the fields masked and excluded when a shape is anonymized
+masked_fields = {
+    "nginx": ({"source.ip": "ipv4", "source.address": "ip", "related.ip": "ipv4", "user.name": "username",
+               "related.user": "username", "geo": "geo_point", "message": "message"}, ["user_agent.original"]),
+    "app": ({"host.ip": "ipv4", "user.name": "username", "related.user": "username", "log.file.path": "file_path",
+             "service.name": "service", "message": "message"}, ["trace.id"]),
+    "ecs": ({"host.ip": "ipv4", "user.name": "username", "log.file.path": "file_path", "service.name": "service",
+             "message": "message"}, ["agent.id", "kubernetes.pod.uid"])
+}
+
+
+def generate(shape, docs, cardinality=10000, seed=0):
+    """yields docs documents of a shape, with cardinality distinct values of each masked field"""
+    rng = random.Random(seed)
+    pools = Pools(rng, cardinality)
+    make = shapes[shape]
+    timestamp = datetime.datetime(2020, 8, 16)
+    for _ in range(docs):
+        timestamp += datetime.timedelta(milliseconds=rng.randint(1, 1000))
+        yield make(pools, timestamp)
+
+
+def write_corpus(path, shape, docs, cardinality=10000, seed=0):
+    """writes a corpus as newline delimited json, returning its size in bytes"""
+    size = 0
+    with open(path, "w") as f:
+        for doc in generate(shape, docs, cardinality, seed):
+            line = json.dumps(doc) + "\n"
+            size += len(line.encode("utf-8"))
+            f.write(line)
+    return size
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("usage: corpus.py <nginx|app|ecs> <docs> <path> [cardinality] [seed]")
+        sys.exit(1)
+    shape, docs, path = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+    cardinality = int(sys.argv[4]) if len(sys.argv) > 4 else 10000
+    seed = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+    print("wrote {} bytes".format(write_corpus(path, shape, docs, cardinality, seed)))
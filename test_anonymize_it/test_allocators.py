@@ -0,0 +1,124 @@
+import ipaddress
+import json
+import sqlite3
+
+import pytest
+
+from allocators import Allocator, AllocatorError, BloomFilter, IssuedSet, SQLiteIssuedSet
+from anonymizers import LazyAnonymizer
+from fakers import geo_point_variant, suffix_variant, variant_providers
+from readers import JSONFileReader
+from writers import MemoryWriter
+
+
+def test_allocator_never_repeats():
+    allocator = Allocator("username", lambda value: "same", IssuedSet(), max_retries=5, variant=suffix_variant)
+    fakes = [allocator(None) for _ in range(20)]
+    assert len(set(fakes)) == 20
+    assert fakes[0] == "same"
+    assert allocator.stats()["allocated"] == 20
+    assert allocator.stats()["varied"] == 19
+    # once the provider has run dry it is only asked once per value
+    assert 19 <= allocator.stats()["collisions"] < 19 * 2
+
+
+def test_allocator_recovers_attempts():
+    fakes = iter(["same"] * 30 + ["fresh{}".format(n) for n in range(100)])
+    allocator = Allocator("username", lambda value: next(fakes), IssuedSet(), max_retries=5, variant=suffix_variant)
+    for _ in range(40):
+        allocator(None)
+    # the provider gets its attempts back once it returns fresh fakes, so values stop being varied
+    varied = allocator.stats()["varied"]
+    for _ in range(20):
+        allocator(None)
+    assert allocator.stats()["varied"] == varied
+
+
+def test_allocator_raises_without_variant():
+    for fake in ({"lat": 1}, "0c2e4b0a-51c9-4f0e-9a55-7d1b3f3c8e6f"):
+        allocator = Allocator("uuid", lambda value: fake, IssuedSet(), max_retries=5)
+        allocator(None)
+        with pytest.raises(AllocatorError):
+            allocator(None)
+
+
+def test_allocator_variants_keep_format():
+    ipv4 = Allocator("ipv4", lambda value: "255.255.255.254", IssuedSet(), max_retries=5,
+                     variant=variant_providers["ipv4"])
+    for ip in [ipv4(None) for _ in range(50)]:
+        ipaddress.IPv4Address(ip)
+    assert ipv4.stats()["varied"] == 49
+
+    email = Allocator("email", lambda value: "jo@example.com", IssuedSet(), max_retries=5,
+                      variant=variant_providers["email"])
+    assert all(address.endswith("@example.com") for address in [email(None) for _ in range(5)])
+    path = Allocator("file_path", lambda value: "/var/log/app.log", IssuedSet(), max_retries=5,
+                     variant=variant_providers["file_path"])
+    assert all(p.endswith(".log") for p in [path(None) for _ in range(5)])
+
+
+def test_allocator_geo_point_variant():
+    point = {"country_iso_code": "US", "location": {"lat": "1.00000", "lon": "2.00000"}, "continent_name": "America"}
+    allocator = Allocator("geo_point", lambda value: point, IssuedSet(), max_retries=5, variant=geo_point_variant)
+    points = [allocator(None) for _ in range(10)]
+    assert len({json.dumps(p) for p in points}) == 10
+    assert all(p["country_iso_code"] == "US" for p in points)
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(str(i))
+    assert all(str(i) in bloom for i in range(1000))
+    false_positives = sum(str(i) in bloom for i in range(1000, 11000))
+    assert false_positives < 300
+
+
+def test_sqlite_issued_set():
+    connection = sqlite3.connect(":memory:")
+    connection.execute('CREATE TABLE "ipv4" (key TEXT PRIMARY KEY, value TEXT)')
+    connection.execute('INSERT INTO "ipv4" VALUES (?, ?)', (json.dumps("1.1.1.1"), json.dumps("2.2.2.2")))
+    issued = SQLiteIssuedSet(connection, "ipv4", capacity=100)
+    # fakes issued by an earlier run are never issued again
+    assert not issued.claim(json.dumps("2.2.2.2"))
+    assert issued.claim(json.dumps("3.3.3.3"))
+    connection.execute('INSERT INTO "ipv4" VALUES (?, ?)', (json.dumps("4.4.4.4"), json.dumps("3.3.3.3")))
+    assert not issued.claim(json.dumps("3.3.3.3"))
+
+
+def test_sqlite_issued_set_saves_filter(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "masks.db"))
+    connection.execute('CREATE TABLE "ipv4" (key TEXT PRIMARY KEY, value TEXT)')
+    connection.executemany('INSERT INTO "ipv4" VALUES (?, ?)',
+                           ((json.dumps("1.1.1.{}".format(n)), json.dumps("2.2.2.{}".format(n))) for n in range(50)))
+    issued = SQLiteIssuedSet(connection, "ipv4", capacity=10)
+    assert issued.scanned == 50
+    # the filter is sized from the masks already in the table rather than the configured capacity
+    assert issued.capacity == 100
+    issued.save()
+    connection.execute('INSERT INTO "ipv4" VALUES (?, ?)', (json.dumps("1.1.1.50"), json.dumps("2.2.2.50")))
+
+    # a later run reads only the masks added since the filter was saved
+    issued = SQLiteIssuedSet(connection, "ipv4", capacity=10)
+    assert issued.scanned == 1
+    assert not any(issued.claim(json.dumps("2.2.2.{}".format(n))) for n in range(51))
+    assert issued.claim(json.dumps("3.3.3.3"))
+
+
+def test_anonymize_reports_collisions():
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "source.ip": "ipv4",
+        "related.ip": "ipv4",
+    }, [])
+    writer = MemoryWriter({})
+    anon = LazyAnonymizer(reader=reader, writer=writer)
+    anon.provider_map["ipv4"] = lambda value: "10.0.0.1"
+    anon.masks = anon.provider_map
+    anon.anonymize(include_rest=True)
+
+    docs = [json.loads(doc) for doc in writer.buffer]
+    ips = {d["source"]["ip"] for d in docs if "source" in d}
+    assert len(ips) == 3
+    stats = anon.allocation_stats["ipv4"]
+    assert stats["varied"] > 0
+    assert stats["collisions"] > 0
@@ -1,9 +1,13 @@
 import collections
 import json
+import os
 
+from natsort import natsorted
+
+import fakers
 from anonymizers import LazyAnonymizer
 from readers import JSONFileReader
-from writers import MemoryWriter
+from writers import FSWriter, MemoryWriter
 
 
 def test_anonymize_include_rest():
@@ -76,3 +80,140 @@ def test_anonymize_limit_fields():
     assert not "random" in doc
     assert not "another_field" in doc
     assert doc["@timestamp"] == "2020-08-16T18:09:13.000Z"
+
+def test_anonymize_parallel(tmp_path):
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "source.ip": "ipv4",
+        "geo": "geo_point",
+        "related.ip": "ipv4",
+        "kubernetes.namespace": "service"
+    }, ["user.name"])
+    writer = FSWriter({"directory": str(tmp_path)})
+    anon = LazyAnonymizer(reader=reader, writer=writer, workers=2)
+    assert anon.anonymize(infer=True, include_rest=True) == 5
+
+    assert sorted(os.listdir(tmp_path)) == ["documents-0-0.json", "documents-1-0.json"]
+    with open(tmp_path / "documents-0-0.json") as f:
+        first = [json.loads(line) for line in f]
+    with open(tmp_path / "documents-1-0.json") as f:
+        second = [json.loads(line) for line in f]
+    assert len(first) == 3
+    assert len(second) == 2
+    doc = first[0]
+    last_doc = second[-1]
+    assert doc["source"]["ip"] != "34.70.236.26"
+    assert not "user" in doc
+    assert doc["source"]["ip"] == doc["related"]["ip"][0]
+    # the same values in different files are masked consistently across workers
+    assert doc["source"]["ip"] == last_doc["source"]["ip"]
+    assert doc["geo"] == last_doc["geo"]
+
+def test_anonymize_parallel_workers_draw_different_fakes(tmp_path):
+    for f in range(4):
+        with open(str(tmp_path / "{}.json".format(f)), "w") as out:
+            out.writelines(json.dumps({"ip": "10.{}.{}.{}".format(f, n // 256, n % 256)}) + "\n" for n in range(500))
+    reader = JSONFileReader({"filepath": str(tmp_path / "*.json")}, {"ip": "ipv4"}, [])
+    anon = LazyAnonymizer(reader=reader, writer=FSWriter({"directory": str(tmp_path / "output")}), workers=4)
+    assert anon.anonymize(include_rest=True) == 2000
+
+    # workers forked with the same random state would draw the same fakes and collide with each other's
+    stats = anon.allocation_stats["ipv4"]
+    assert stats["allocated"] == 2000
+    assert stats["collisions"] <= 2
+    assert stats["varied"] == 0
+
+def test_anonymize_parallel_split(tmp_path):
+    with open("./resources/1.json") as f:
+        lines = f.read().splitlines()
+    (tmp_path / "big.json").write_text("".join(lines[n % len(lines)] + "\n" for n in range(100)))
+    fields = {"source.ip": "ipv4", "related.ip": "ipv4", "user.name": "username"}
+    masking = {"mode": "keyed", "secret": "secret"}
+
+    writer = MemoryWriter({})
+    LazyAnonymizer(reader=JSONFileReader({"filepath": str(tmp_path / "big.json")}, fields, []), writer=writer,
+                   masking=masking).anonymize(include_rest=True)
+
+    output = tmp_path / "output"
+    reader = JSONFileReader({"filepath": str(tmp_path / "big.json"), "split_size": 5000}, fields, [])
+    anon = LazyAnonymizer(reader=reader, writer=FSWriter({"directory": str(output)}), workers=2, masking=masking)
+    assert anon.anonymize(include_rest=True) == 100
+
+    # shards are named file-range-part, so sorting their names restores the order of the input
+    names = natsorted(os.listdir(str(output)))
+    assert len(names) > 2
+    assert names[:2] == ["documents-0-0-0.json", "documents-0-1-0.json"]
+    docs = []
+    for name in names:
+        with open(str(output / name)) as f:
+            docs.extend(json.loads(line) for line in f)
+    assert docs == [json.loads(doc) for doc in writer.buffer]
+
+
+def test_anonymize_keyed():
+    def run(secret):
+        reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+            "log.file.path": "file_path",
+            "source.ip": "ipv4",
+            "geo": "geo_point",
+            "related.ip": "ipv4",
+            "user.name": "username",
+            "kubernetes.namespace": "service"
+        }, [])
+        writer = MemoryWriter({})
+        anon = LazyAnonymizer(reader=reader, writer=writer, masking={"mode": "keyed", "secret": secret})
+        anon.anonymize(infer=True, include_rest=True)
+        return [json.loads(doc) for doc in writer.buffer]
+
+    docs = run("secret")
+    doc = docs[0]
+    last_doc = docs[-1]
+    assert doc["source"]["ip"] != "34.70.236.26"
+    assert doc["source"]["ip"] == doc["related"]["ip"][0]
+    assert doc["source"]["ip"] == last_doc["source"]["ip"]
+    assert doc["geo"] == last_doc["geo"]
+    assert doc["user"]["name"] == last_doc["user"]["name"]
+    # a second run with the same secret reproduces every mask, a different secret does not
+    assert run("secret") == docs
+    assert run("another secret")[0]["source"]["ip"] != doc["source"]["ip"]
+
+def test_keyed_masks_are_cached():
+    mask = fakers.keyed(fakers.username, "secret", cache_size=2)
+    first = mask("alice")
+    assert mask("alice") == first
+    assert mask.cache_info().hits == 1
+    mask("bob")
+    mask("carol")
+    # evicted values are derived again, and get the same mask
+    assert mask("alice") == first
+    assert mask.cache_info().misses == 4
+    assert fakers.keyed(fakers.geo_point, "secret")({"lat": 1, "lon": 2})
+
+def test_anonymize_limit_fields_shared_prefix():
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "kubernetes.namespace": "service",
+        "kubernetes.container.name": None
+    }, ["kubernetes.container.image"])
+    writer = MemoryWriter({})
+    anon = LazyAnonymizer(reader=reader, writer=writer)
+    anon.anonymize(infer=True, include_rest=False)
+
+    k8_doc = json.loads(writer.buffer[1])
+    assert k8_doc["kubernetes"]["namespace"] != "workplace-search-kyko-ren"
+    assert k8_doc["kubernetes"]["container"] == {"name": "enterprise-search"}
+    assert json.loads(writer.buffer[0]) == {}
+
+def test_anonymize_include_rest_passthrough():
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "kubernetes.namespace": "service",
+        "@timestamp": None
+    }, [])
+    writer = MemoryWriter({})
+    anon = LazyAnonymizer(reader=reader, writer=writer)
+    anon.anonymize(infer=True, include_rest=True)
+
+    with open("./resources/1.json") as f:
+        lines = f.read().splitlines()
+    assert len(writer.buffer) == 5
+    # the first document has no kubernetes.namespace, so it is written exactly as it was read
+    assert writer.buffer[0] == lines[0].strip()
+    assert json.loads(writer.buffer[1])["kubernetes"]["namespace"] != "workplace-search-kyko-ren"
@@ -0,0 +1,96 @@
+import json
+import os
+
+import pytest
+
+import anonymizers
+from anonymizers import AnonymizerError, LazyAnonymizer
+from checkpoints import Checkpointer, CheckpointError
+from readers import JSONFileReader
+from writers import FSWriter
+
+
+class FailingWriter(FSWriter):
+    def __init__(self, params, fail_after):
+        super().__init__(params)
+        self.fail_after = fail_after
+        self.written = 0
+
+    def write_document(self, doc):
+        if self.written == self.fail_after:
+            raise IOError("disk full")
+        self.written += 1
+        super().write_document(doc)
+
+
+def write_input(tmp_path):
+    for f in range(2):
+        with open(str(tmp_path / "{}.json".format(f)), "w") as out:
+            for n in range(f * 25, f * 25 + 25):
+                out.write(json.dumps({"n": n, "source": {"ip": "10.0.0.{}".format(n % 7)},
+                                      "host": {"ip": "10.1.0.{}".format(n % 5)}}) + "\n")
+
+
+def anonymizer(tmp_path, writer, **params):
+    reader = JSONFileReader({"filepath": str(tmp_path / "*.json")}, {"source.ip": "ipv4", "host.ip": "ip"}, [])
+    checkpoint = dict({"path": str(tmp_path / "run.checkpoint"), "interval": 0}, **params)
+    return LazyAnonymizer(reader=reader, writer=writer, checkpoint=checkpoint)
+
+
+def test_checkpointer(tmp_path):
+    with pytest.raises(CheckpointError):
+        Checkpointer({})
+    checkpointer = Checkpointer({"path": str(tmp_path / "run.checkpoint"), "interval": 3600})
+    assert checkpointer.load() is None
+    assert not checkpointer.due()
+    checkpointer.save({"docs": 10}, checkpointer.saved)
+    assert checkpointer.load()["docs"] == 10
+    assert checkpointer.checkpoints == 1
+    checkpointer.clear()
+    assert checkpointer.load() is None
+
+
+def test_resume_from_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(anonymizers, "documents_per_file", 10)
+    write_input(tmp_path)
+    output = tmp_path / "output"
+    with pytest.raises(IOError):
+        anonymizer(tmp_path, FailingWriter({"directory": str(output)}, 33)).anonymize(include_rest=True)
+
+    # the checkpoint after 30 documents is in the middle of the second file
+    state = json.loads((tmp_path / "run.checkpoint").read_text())
+    assert state["docs"] == 30
+    assert state["position"][0] == 1
+    assert state["output"] == 3
+    assert os.path.exists(str(tmp_path / "run.checkpoint.masks.db"))
+
+    anon = anonymizer(tmp_path, FSWriter({"directory": str(output)}))
+    assert anon.anonymize(include_rest=True) == 20
+    assert not os.path.exists(str(tmp_path / "run.checkpoint"))
+    assert not os.path.exists(str(tmp_path / "run.checkpoint.masks.db"))
+
+    docs = []
+    for n in range(5):
+        with open(str(output / "documents-{}.json".format(n))) as f:
+            docs.extend(json.loads(line) for line in f)
+    assert [doc["n"] for doc in docs] == list(range(50))
+    # values seen before the failure keep their masks after resuming, mapped and computed alike
+    for field, values in (("source", 7), ("host", 5)):
+        masks = {}
+        for doc in docs:
+            masks.setdefault(doc["n"] % values, set()).add(doc[field]["ip"])
+        assert all(len(mask) == 1 for mask in masks.values())
+        assert len(set.union(*masks.values())) == values
+
+
+def test_checkpoint_errors(tmp_path):
+    write_input(tmp_path)
+    anon = anonymizer(tmp_path, FSWriter({"directory": str(tmp_path / "output")}))
+    anon.workers = 2
+    with pytest.raises(AnonymizerError):
+        anon.anonymize(include_rest=True)
+
+    (tmp_path / "run.checkpoint").write_text(json.dumps({"version": 1, "files": ["other.json"], "position": [0, 0],
+                                                          "docs": 0, "output": 0}))
+    with pytest.raises(AnonymizerError, match="changed"):
+        anonymizer(tmp_path, FSWriter({"directory": str(tmp_path / "output")})).anonymize(include_rest=True)
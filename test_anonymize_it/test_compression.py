@@ -0,0 +1,47 @@
+import gzip
+
+import pytest
+
+from compression import CompressionError, Compressor, create_compressor
+
+
+def compress(compressor, blocks):
+    output = []
+
+    class Sink:
+        def write(self, data):
+            output.append(data)
+
+    compressed = compressor.open(Sink())
+    for block in blocks:
+        compressed.write(block)
+    compressed.close()
+    compressor.close()
+    return b"".join(output)
+
+
+def test_gzip_blocks():
+    lines = [b'{"n": %d}\n' % n for n in range(10000)]
+    compressor = Compressor({"type": "gzip", "level": 1, "threads": 3, "block_size": 4096})
+    data = compress(compressor, lines)
+    # every block is a gzip member, which gzip reads back as one stream
+    assert gzip.decompress(data) == b"".join(lines)
+    assert compressor.bytes_in == sum(len(line) for line in lines)
+    assert compressor.bytes_out == len(data)
+    assert compressor.ratio() > 1
+    assert compressor.seconds > 0
+
+
+def test_zstd_blocks():
+    zstandard = pytest.importorskip("zstandard")
+    lines = [b'{"n": %d}\n' % n for n in range(10000)]
+    data = compress(Compressor({"type": "zstd", "block_size": 4096}), lines)
+    reader = zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True)
+    assert reader.read() == b"".join(lines)
+
+
+def test_create_compressor():
+    assert create_compressor(None) is None
+    assert create_compressor("gzip").extension == ".gz"
+    with pytest.raises(CompressionError):
+        create_compressor({"type": "lz4"})
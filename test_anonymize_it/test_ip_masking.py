@@ -0,0 +1,60 @@
+import ipaddress
+import json
+
+from anonymizers import LazyAnonymizer
+from ip_masking import PrefixPreservingIP
+from readers import JSONFileReader
+from writers import MemoryWriter
+
+
+def common_prefix(a, b):
+    a = ipaddress.ip_address(a)
+    b = ipaddress.ip_address(b)
+    return a.max_prefixlen - (int(a) ^ int(b)).bit_length()
+
+
+def test_ip_preserves_prefixes():
+    mask = PrefixPreservingIP("secret")
+    pairs = [("10.1.2.3", "10.1.2.4"), ("10.1.2.3", "10.1.9.9"), ("10.1.2.3", "192.168.0.1"),
+             ("2001:db8::1", "2001:db8::ff"), ("2001:db8::1", "2001:db9::1")]
+    for a, b in pairs:
+        assert common_prefix(mask(a), mask(b)) == common_prefix(a, b)
+
+
+def test_ip_keeps_family():
+    mask = PrefixPreservingIP("secret")
+    assert ipaddress.ip_address(mask("34.70.236.26")).version == 4
+    assert ipaddress.ip_address(mask("::1")).version == 6
+    assert mask("-") == "-"
+
+
+def test_ip_is_a_bijection():
+    mask = PrefixPreservingIP("secret")
+    masked = [mask.mask_int(address) for address in range(0x0a000000, 0x0a000400)]
+    assert len(set(masked)) == 0x400
+
+
+def test_ip_depends_on_secret_only():
+    assert PrefixPreservingIP("secret")("34.70.236.26") == PrefixPreservingIP("secret")("34.70.236.26")
+    assert PrefixPreservingIP("secret")("34.70.236.26") != PrefixPreservingIP("other")("34.70.236.26")
+
+
+def test_ip_batch_matches_single():
+    mask = PrefixPreservingIP("secret")
+    values = ["34.70.236.26", "34.70.236.27", "2001:db8::1", "-", "130.211.3.156", "34.70.236.26"]
+    assert mask.mask_batch(values) == [mask(value) for value in values]
+
+
+def test_anonymize_ip():
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "source.ip": "ip",
+        "related.ip": "ip",
+    }, [])
+    writer = MemoryWriter({})
+    anon = LazyAnonymizer(reader=reader, writer=writer, masking={"secret": "secret"})
+    anon.anonymize(include_rest=True)
+
+    docs = [json.loads(doc) for doc in writer.buffer]
+    mask = PrefixPreservingIP("secret")
+    assert docs[0]["source"]["ip"] == mask("34.70.236.26")
+    assert docs[0]["related"]["ip"] == [mask("34.70.236.26")]
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from anonymizers import LazyAnonymizer
+from json_codecs import codec_mapping, get_codec
+from readers import JSONFileReader
+from writers import MemoryWriter
+
+
+def anonymize_with(codec, include_rest):
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "log.file.path": "file_path",
+        "source.ip": "ipv4",
+        "geo": "geo_point",
+        "related.ip": "ipv4",
+        "@timestamp": None,
+        "kubernetes.namespace": "service"
+    }, ["user.name"])
+    writer = MemoryWriter({})
+    # keyed masks make runs with different codecs comparable
+    anon = LazyAnonymizer(reader=reader, writer=writer, masking={"mode": "keyed", "secret": "secret"}, codec=codec)
+    anon.anonymize(infer=True, include_rest=include_rest)
+    return writer.buffer
+
+
+@pytest.mark.parametrize("codec", sorted(codec_mapping))
+@pytest.mark.parametrize("include_rest", [True, False])
+def test_codecs_semantically_identical(codec, include_rest):
+    if not codec_mapping[codec].available:
+        pytest.skip("{} is not installed".format(codec))
+    expected = [json.loads(doc) for doc in anonymize_with("json", include_rest)]
+    output = anonymize_with(codec, include_rest)
+    assert len(output) == 5
+    assert [json.loads(doc) for doc in output] == expected
+
+
+@pytest.mark.parametrize("codec", sorted(codec_mapping))
+def test_codec_loads_bytes(codec):
+    codec = get_codec(codec)
+    line = '{"message": "café /var/log", "geo": {"lat": 37.751}}\n'.encode("utf-8")
+    doc = codec.loads(line)
+    assert doc == {"message": "café /var/log", "geo": {"lat": 37.751}}
+    assert json.loads(codec.dumps(doc)) == doc
@@ -0,0 +1,165 @@
+import json
+import os
+
+import pytest
+
+import anonymizers
+from anonymizers import AnonymizerError, LazyAnonymizer
+from manifests import Manifest, ManifestError
+from readers import JSONFileReader
+from writers import FSWriter
+
+
+def write_docs(path, docs, mode="w"):
+    with open(str(path), mode) as f:
+        f.writelines(json.dumps(doc) + "\n" for doc in docs)
+
+
+def test_manifest_plan(tmp_path):
+    for f in range(5):
+        write_docs(tmp_path / "{}.json".format(f), [{"file": f, "n": n} for n in range(10)])
+    files = [str(tmp_path / "{}.json".format(f)) for f in range(5)]
+    params = {"path": str(tmp_path / "anonymize.manifest"), "settle": 0, "hash_size": 64}
+    with pytest.raises(ManifestError):
+        Manifest({})
+
+    manifest = Manifest(params)
+    assert manifest.run == 1
+    sources, entries = manifest.plan(files)
+    assert sources == [(file, (0, os.path.getsize(file))) for file in files]
+    manifest.save(entries)
+
+    sizes = [os.path.getsize(file) for file in files]
+    write_docs(files[0], [{"file": 0, "n": 10}], mode="a")
+    os.utime(files[1], (0, 0))
+    with open(files[2], "r+") as f:
+        f.write('{"file": 9')
+    os.rename(files[4], str(tmp_path / "4.json.1"))
+    write_docs(files[4], [{"file": 5, "n": n} for n in range(3)])
+
+    manifest = Manifest(params)
+    assert manifest.run == 2
+    renamed = files[:4] + [str(tmp_path / "4.json.1"), files[4]]
+    sources, entries = manifest.plan(renamed)
+    # the appended document, the whole of the changed file and the new file, but not the touched or renamed files
+    assert sources == [(files[0], (sizes[0], os.path.getsize(files[0]))), (files[2], (0, sizes[2])),
+                       (files[4], (0, os.path.getsize(files[4])))]
+    assert manifest.stats == {"new": 1, "appended": 1, "changed": 1, "unchanged": 3,
+                              "bytes_skipped": sizes[0] + sizes[1] + sizes[3] + sizes[4]}
+    assert set(entries) == set(renamed)
+
+
+def test_manifest_holds_back_partial_lines(tmp_path):
+    path = tmp_path / "0.json"
+    write_docs(path, [{"n": 0}, {"n": 1}])
+    with open(str(path), "a") as f:
+        f.write('{"n": ')
+    complete = os.path.getsize(str(path)) - len('{"n": ')
+    params = {"path": str(tmp_path / "anonymize.manifest")}
+
+    manifest = Manifest(params)
+    sources, entries = manifest.plan([str(path)])
+    assert sources == [(str(path), (0, complete))]
+    manifest.save(entries)
+
+    with open(str(path), "a") as f:
+        f.write('2}\n')
+    sources, _ = Manifest(params).plan([str(path)])
+    assert sources == [(str(path), (complete, os.path.getsize(str(path))))]
+
+    # once the file has settled, its last line is read even without a newline
+    with open(str(path), "a") as f:
+        f.write('{"n": 3}')
+    sources, _ = Manifest(dict(params, settle=0)).plan([str(path)])
+    assert sources == [(str(path), (complete, os.path.getsize(str(path))))]
+
+
+def anonymizer(tmp_path, writer, **params):
+    reader = JSONFileReader({"filepath": str(tmp_path / "*.json")}, {"user.name": "username"}, [])
+    return LazyAnonymizer(reader=reader, writer=writer, masking={"secret": "secret"},
+                          mapping_store={"path": str(tmp_path / "masks.db")},
+                          incremental={"path": str(tmp_path / "anonymize.manifest"), "settle": 0}, **params)
+
+
+def read_output(output):
+    docs = {}
+    for name in sorted(os.listdir(str(output))):
+        with open(str(output / name)) as f:
+            docs[name] = [json.loads(line) for line in f]
+    return docs
+
+
+def test_incremental_runs(tmp_path):
+    output = tmp_path / "output"
+    write_docs(tmp_path / "0.json", [{"n": n, "user": {"name": "user{}".format(n % 3)}} for n in range(10)])
+    assert anonymizer(tmp_path, FSWriter({"directory": str(output)})).anonymize(include_rest=True) == 10
+
+    write_docs(tmp_path / "0.json", [{"n": n, "user": {"name": "user{}".format(n % 4)}} for n in range(10, 14)],
+               mode="a")
+    assert anonymizer(tmp_path, FSWriter({"directory": str(output)})).anonymize(include_rest=True) == 4
+    assert anonymizer(tmp_path, FSWriter({"directory": str(output)})).anonymize(include_rest=True) == 0
+
+    docs = read_output(output)
+    assert list(docs) == ["documents-run1-0.json", "documents-run2-0.json"]
+    assert [doc["n"] for doc in docs["documents-run2-0.json"]] == list(range(10, 14))
+    # values seen by the first run keep their masks in the second
+    masks = {}
+    for doc in docs["documents-run1-0.json"] + docs["documents-run2-0.json"]:
+        masks.setdefault(doc["n"] % 4 if doc["n"] >= 10 else doc["n"] % 3, set()).add(doc["user"]["name"])
+    assert all(len(mask) == 1 for mask in masks.values())
+
+
+def test_incremental_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(anonymizers, "documents_per_file", 5)
+    output = tmp_path / "output"
+    write_docs(tmp_path / "0.json", [{"n": n, "user": {"name": "user{}".format(n % 3)}} for n in range(12)])
+
+    class FailingWriter(FSWriter):
+        def open_file(self, file_name):
+            if file_name.endswith("-2"):
+                raise IOError("disk full")
+            super().open_file(file_name)
+
+    checkpoint = {"path": str(tmp_path / "run.checkpoint"), "interval": 0}
+    with pytest.raises(IOError):
+        anonymizer(tmp_path, FailingWriter({"directory": str(output)}), checkpoint=checkpoint).anonymize(
+            include_rest=True)
+    assert not os.path.exists(str(tmp_path / "anonymize.manifest"))
+
+    # documents appended after the failure are left to the next run
+    write_docs(tmp_path / "0.json", [{"n": 12}], mode="a")
+    anon = anonymizer(tmp_path, FSWriter({"directory": str(output)}), checkpoint=checkpoint)
+    assert anon.anonymize(include_rest=True) == 2
+    assert anonymizer(tmp_path, FSWriter({"directory": str(output)})).anonymize(include_rest=True) == 1
+
+    docs = read_output(output)
+    assert list(docs) == ["documents-run1-0.json", "documents-run1-1.json", "documents-run1-2.json",
+                          "documents-run2-0.json"]
+    assert [doc["n"] for name in docs for doc in docs[name]] == list(range(13))
+
+
+def test_incremental_requires_stable_masks(tmp_path):
+    reader = JSONFileReader({"filepath": str(tmp_path / "*.json")}, {"user.name": "username"}, [])
+    with pytest.raises(AnonymizerError, match="stable masks"):
+        LazyAnonymizer(reader=reader, writer=FSWriter({"directory": str(tmp_path)}),
+                       incremental={"path": str(tmp_path / "anonymize.manifest")})
+
+
+def test_incremental_parallel(tmp_path):
+    output = tmp_path / "output"
+    for f in range(2):
+        write_docs(tmp_path / "{}.json".format(f), [{"n": n, "user": {"name": "user{}".format(n)}} for n in range(5)])
+
+    def run():
+        reader = JSONFileReader({"filepath": str(tmp_path / "*.json")}, {"user.name": "username"}, [])
+        return LazyAnonymizer(reader=reader, writer=FSWriter({"directory": str(output)}), workers=2,
+                              masking={"mode": "keyed", "secret": "secret"},
+                              incremental={"path": str(tmp_path / "anonymize.manifest"), "settle": 0}
+                              ).anonymize(include_rest=True)
+
+    assert run() == 10
+    write_docs(tmp_path / "1.json", [{"n": 5, "user": {"name": "user0"}}], mode="a")
+    assert run() == 1
+    docs = read_output(output)
+    assert sorted(docs) == ["documents-run1-0-0.json", "documents-run1-1-0.json", "documents-run2-0-0.json"]
+    assert docs["documents-run2-0-0.json"][0]["user"]["name"] == docs["documents-run1-1-0.json"][0]["user"]["name"]
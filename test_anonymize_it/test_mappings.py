@@ -0,0 +1,75 @@
+import json
+import sqlite3
+
+import pytest
+
+from anonymizers import LazyAnonymizer
+from mappings import MappingStoreError, SQLiteFieldMap, create_store
+from readers import JSONFileReader
+from writers import MemoryWriter
+
+
+def test_sqlite_field_map_evicts_to_disk():
+    field_map = SQLiteFieldMap(sqlite3.connect(":memory:"), "ipv4", cache_size=2)
+    for i in range(5):
+        assert not "10.0.0.%s" % i in field_map
+        field_map["10.0.0.%s" % i] = "192.168.0.%s" % i
+
+    assert len(field_map.cache) == 2
+    assert len(field_map) == 5
+    # the oldest mask was evicted from memory but is still found on disk
+    assert "10.0.0.0" in field_map
+    assert field_map["10.0.0.0"] == "192.168.0.0"
+    assert "10.0.0.0" in field_map
+    assert field_map.stats() == {"cached": 2, "hits": 1, "disk_hits": 1, "misses": 5}
+
+
+def test_sqlite_store_requires_cache(tmp_path):
+    with pytest.raises(MappingStoreError):
+        create_store({"type": "sqlite", "path": str(tmp_path / "masks.db"), "cache_size": 0})
+
+
+def test_anonymize_sqlite_store(tmp_path):
+    path = str(tmp_path / "masks.db")
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "source.ip": "ipv4",
+        "geo": "geo_point",
+        "related.ip": "ipv4",
+    }, [])
+    writer = MemoryWriter({})
+    anon = LazyAnonymizer(reader=reader, writer=writer, mapping_store={"type": "sqlite", "path": path, "cache_size": 1})
+    anon.anonymize(infer=True, include_rest=True)
+
+    doc = json.loads(writer.buffer[0])
+    last_doc = json.loads(writer.buffer[-1])
+    assert doc["source"]["ip"] == doc["related"]["ip"][0]
+    assert doc["source"]["ip"] == last_doc["source"]["ip"]
+    assert doc["geo"] == last_doc["geo"]
+    store = create_store({"type": "sqlite", "path": path})
+    field_maps = store.create_field_maps(["ipv4"])
+    assert "34.70.236.26" in field_maps["ipv4"]
+    assert field_maps["ipv4"]["34.70.236.26"] == doc["source"]["ip"]
+    store.close()
+
+
+def test_anonymize_reuses_mapping_file(tmp_path):
+    path = str(tmp_path / "masks.db")
+
+    def run(fields):
+        reader = JSONFileReader({"filepath": "./resources/*.json"}, fields, [])
+        writer = MemoryWriter({})
+        anon = LazyAnonymizer(reader=reader, writer=writer, mapping_store={"type": "memory", "path": path})
+        anon.anonymize(infer=True, include_rest=False)
+        return [json.loads(doc) for doc in writer.buffer]
+
+    first = run({"source.ip": "ipv4"})
+    second = run({"source.ip": "ipv4", "log.file.path": "file_path"})
+    assert [doc.get("source") for doc in first] == [doc.get("source") for doc in second]
+
+    store = create_store({"type": "memory", "path": path})
+    field_maps = store.create_field_maps(["ipv4", "file_path"])
+    assert "34.70.236.26" in field_maps["ipv4"]
+    assert field_maps["ipv4"]["34.70.236.26"] == first[0]["source"]["ip"]
+    assert "/var/log/auth.log" in field_maps["file_path"]
+    assert field_maps["ipv4"].stats() == {"cached": 1, "loaded": 1, "new": 0}
+    store.close()
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from anonymizers import LazyAnonymizer
+from metrics import Metrics, MetricsError, create_metrics
+from readers import JSONFileReader
+from writers import MemoryWriter
+
+
+def test_create_metrics():
+    assert create_metrics(None) is None
+    assert len(create_metrics({}).sinks) == 1
+    with pytest.raises(MetricsError):
+        create_metrics({"sinks": [{"type": "statsd"}]})
+    with pytest.raises(MetricsError):
+        create_metrics({"sinks": [{"type": "json"}]})
+
+
+def test_snapshot_and_merge():
+    metrics = Metrics()
+    metrics.counters["docs"] += 10
+    metrics.seconds["read"] += 3.0
+    metrics.seconds["decode"] += 1.0
+    metrics.add_field("source.ip", "ipv4", 10, 0.5)
+    metrics.add_mappings({"ipv4": {"cached": 4, "allocated": 4}})
+    snapshot = metrics.snapshot()
+    assert snapshot["stages"]["read"] == 2.0
+    assert snapshot["providers"]["ipv4"] == {"values": 10, "seconds": 0.5}
+    assert snapshot["mappings"]["ipv4"]["hit_rate"] == pytest.approx(0.6)
+
+    merged = Metrics()
+    merged.merge(snapshot)
+    merged.merge(snapshot)
+    totals = merged.snapshot()
+    assert totals["docs"] == 20
+    assert totals["stages"]["read"] == 4.0
+    assert totals["stages"]["decode"] == 2.0
+    assert totals["fields"]["source.ip"]["values"] == 20
+    assert totals["mappings"]["ipv4"]["allocated"] == 8
+
+
+def test_file_sinks(tmp_path):
+    json_path = tmp_path / "stats.json"
+    prometheus_path = tmp_path / "anonymize_it.prom"
+    metrics = create_metrics({"sinks": [{"type": "json", "path": str(json_path)},
+                                        {"type": "prometheus", "path": str(prometheus_path)}]})
+    metrics.counters["docs"] += 5
+    metrics.add_field("user.name", "username", 5, 0.1)
+    metrics.emit(final=True)
+
+    stats = json.loads(json_path.read_text())
+    assert stats["docs"] == 5
+    assert stats["final"]
+    prometheus = prometheus_path.read_text()
+    assert "anonymize_it_documents_total 5" in prometheus
+    assert 'anonymize_it_field_values_total{field="user.name",provider="username"} 5' in prometheus
+
+
+def test_anonymize_with_metrics(tmp_path):
+    path = tmp_path / "stats.json"
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {"source.ip": "ipv4", "host.ip": "ipv4"}, [])
+    anon = LazyAnonymizer(reader=reader, writer=MemoryWriter({}),
+                          metrics={"sinks": [{"type": "json", "path": str(path)}]})
+    count = anon.anonymize(include_rest=True)
+
+    stats = json.loads(path.read_text())
+    assert stats["final"]
+    assert stats["docs"] == count
+    assert stats["bytes_read"] > 0
+    assert stats["bytes_written"] > 0
+    assert set(stats["stages"]) == {"read", "decode", "mask", "encode", "write"}
+    assert stats["fields"]["source.ip"]["provider"] == "ipv4"
+    assert stats["fields"]["source.ip"]["values"] > 0
+    assert stats["mappings"]["ipv4"]["allocated"] > 0
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from anonymizers import LazyAnonymizer
+from pipeline import BackgroundWriter, PipelineError, read_ahead, read_merged
+from readers import JSONFileReader
+from writers import BaseWriter, MemoryWriter
+
+
+class FailingWriter(BaseWriter):
+    def __init__(self, params):
+        super().__init__(params)
+        self.files = []
+
+    def open_file(self, file_name=None):
+        if len(self.files) == 1:
+            raise IOError("upload failed")
+        self.files.append([])
+
+    def write_document(self, doc):
+        self.files[-1].append(doc)
+
+    def close_file(self):
+        pass
+
+
+def test_read_ahead():
+    assert list(read_ahead(range(2500), queue_size=1, chunk_size=100)) == list(range(2500))
+
+
+def test_read_merged():
+    merged = list(read_merged([range(0, 1000), range(1000, 1500), []], queue_size=1, chunk_size=100))
+    assert sorted(merged) == list(range(1500))
+
+    def failing():
+        yield 1
+        raise IOError("slice failed")
+    with pytest.raises(IOError):
+        list(read_merged([range(1000), failing()], chunk_size=10))
+
+
+def test_read_ahead_raises_reader_errors():
+    def documents():
+        yield 1
+        raise ValueError("bad file")
+
+    with pytest.raises(ValueError):
+        list(read_ahead(documents(), chunk_size=1))
+
+
+def test_background_writer_raises_writer_errors():
+    writer = BackgroundWriter(FailingWriter({}), queue_size=1, chunk_size=2)
+    with pytest.raises(PipelineError):
+        for i in range(10):
+            writer.open_file()
+            for doc in range(5):
+                writer.write_document(doc)
+            writer.close_file()
+        writer.close()
+    assert writer.writer.files == [[0, 1, 2, 3, 4]]
+
+
+def test_anonymize_pipeline():
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "source.ip": "ipv4",
+        "related.ip": "ipv4",
+    }, ["user.name"])
+    writer = MemoryWriter({})
+    anon = LazyAnonymizer(reader=reader, writer=writer, pipeline={"queue_size": 1})
+    assert anon.anonymize(infer=True, include_rest=True) == 5
+
+    assert len(writer.buffer) == 5
+    doc = json.loads(writer.buffer[0])
+    assert doc["source"]["ip"] != "34.70.236.26"
+    assert doc["source"]["ip"] == doc["related"]["ip"][0]
+    assert doc["source"]["ip"] == json.loads(writer.buffer[-1])["source"]["ip"]
@@ -0,0 +1,59 @@
+import json
+import re
+
+from anonymizers import LazyAnonymizer
+from fakers import geo_point_batch, ipv4_batch
+from pools import FakePool
+from readers import JSONFileReader
+from writers import MemoryWriter
+
+
+def test_ipv4_batch():
+    ips = ipv4_batch(1000)
+    assert len(ips) == 1000
+    for ip in ips:
+        assert re.match(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", ip)
+        assert all(0 <= int(octet) <= 255 for octet in ip.split("."))
+
+
+def test_geo_point_batch():
+    points = geo_point_batch(100)
+    assert len(points) == 100
+    for point in points:
+        assert set(point) == {"country_iso_code", "location", "continent_name"}
+        assert -90 <= float(point["location"]["lat"]) <= 90
+
+
+def test_pool_generates_in_batches():
+    sizes = []
+
+    def generate(size):
+        sizes.append(size)
+        return [str(i) for i in range(size)]
+
+    pool = FakePool("username", generate, batch_size=10)
+    fakes = [pool(None) for _ in range(15)]
+    assert fakes[:10] == [str(i) for i in range(10)]
+    assert sizes == [10, 10]
+
+
+def test_anonymize_pool():
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "source.ip": "ipv4",
+        "geo": "geo_point",
+        "related.ip": "ipv4",
+        "user.name": "username",
+    }, [])
+    writer = MemoryWriter({})
+    anon = LazyAnonymizer(reader=reader, writer=writer, masking={"mode": "pool", "batch_size": 100})
+    anon.anonymize(infer=True, include_rest=True)
+
+    docs = [json.loads(doc) for doc in writer.buffer]
+    doc = docs[0]
+    assert doc["source"]["ip"] != "34.70.236.26"
+    assert doc["source"]["ip"] == doc["related"]["ip"][0]
+    assert doc["source"]["ip"] == docs[-1]["source"]["ip"]
+    assert doc["geo"] == docs[-1]["geo"]
+    # distinct source ips get distinct masks
+    ips = {d["source"]["ip"] for d in docs if "source" in d}
+    assert len(ips) == 3
@@ -0,0 +1,64 @@
+import pstats
+
+import pytest
+
+from anonymizers import LazyAnonymizer
+from profiling import Profiler, ProfilerError, create_profiler, stage_of, stage_shares
+from readers import JSONFileReader
+from writers import MemoryWriter
+
+
+def test_create_profiler():
+    assert create_profiler(None) is None
+    assert create_profiler({}).docs == 10000
+    assert create_profiler({"seconds": 5}).docs is None
+    with pytest.raises(ProfilerError):
+        Profiler({"docs": 0})
+
+
+def test_stage_of():
+    assert stage_of("/root/anonymize_it/fakers.py", "ipv4") == "mask"
+    assert stage_of("/root/anonymize_it/json_codecs.py", "loads") == "decode"
+    assert stage_of("/root/anonymize_it/json_codecs.py", "encode") == "encode"
+    assert stage_of("~", "<built-in method orjson.loads>") == "decode"
+    assert stage_of("~", "<method 'write' of '_io.BufferedWriter' objects>") == "write"
+    assert stage_of("~", "<method 'acquire' of '_thread.lock' objects>") is None
+
+
+def test_stage_shares_follow_callers():
+    fake = ("/root/anonymize_it/fakers.py", 12, "ipv4")
+    encode = ("/root/anonymize_it/json_codecs.py", 29, "encode")
+    join = ("~", 0, "<method 'join' of 'str' objects>")
+    stats = {
+        fake: (1, 1, 0.1, 0.4, {}),
+        encode: (1, 1, 0.1, 0.2, {}),
+        join: (4, 4, 0.4, 0.4, {fake: (3, 3, 0.3, 0.3), encode: (1, 1, 0.1, 0.1)})
+    }
+    shares = stage_shares(stats)
+    assert shares[fake] == {"mask": 1.0}
+    assert shares[join] == pytest.approx({"mask": 0.75, "encode": 0.25})
+
+
+def test_limit_stops_profiling():
+    profiler = Profiler({"docs": 3})
+    profiler.start()
+    assert list(profiler.limit(range(10))) == list(range(10))
+    assert not profiler.running
+    assert profiler.profiled_docs == 3
+
+
+def test_report_without_profile():
+    assert Profiler().report()["docs"] == 0
+
+
+def test_anonymize_with_profiling(tmp_path):
+    path = tmp_path / "anonymize.pstats"
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {"source.ip": "ipv4", "message": "message"}, [])
+    anon = LazyAnonymizer(reader=reader, writer=MemoryWriter({}), profiling={"docs": 2, "path": str(path)})
+    anon.anonymize(include_rest=True)
+
+    report = anon.profile_report
+    assert report["docs"] == 2
+    assert report["stages"]["mask"] > 0
+    assert any("scrubbing.py" in entry["function"] for entry in report["providers"])
+    assert pstats.Stats(str(path)).total_calls > 0
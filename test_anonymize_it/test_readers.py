@@ -1,4 +1,243 @@
-from anonymize_it import readers
+import getpass
+import json
+import threading
 
-def test_esreader():
-    pass
\ No newline at end of file
+import pytest
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, TransportError
+
+from anonymizers import Anonymizer
+from metrics import Metrics
+from readers import ESReader, ESReaderError, JSONFileReader
+from source import SourceError, split_ranges
+from writers import MemoryWriter
+
+
+class FakeElasticsearch:
+    def __init__(self, docs, failures=None, shard_failures=0):
+        """stands in for the elasticsearch client, serving sliced scrolls and composite aggregations over docs
+
+        :param failures: exceptions raised by the next requests, one per request
+        """
+        self.docs = docs
+        self.failures = list(failures or [])
+        self.shard_failures = shard_failures
+        self.bodies = []
+        self.scrolls = {}
+        self.cleared = []
+        self.lock = threading.Lock()
+
+    def __fail(self):
+        with self.lock:
+            if self.failures:
+                raise self.failures.pop(0)
+
+    def __page(self, scroll_id):
+        docs, size, position = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (docs, size, position + size)
+        hits = [{"_index": "logs", "_type": "doc", "_id": str(doc["n"]), "_source": self.__source(doc)}
+                for doc in docs[position:position + size]]
+        return {"_scroll_id": scroll_id, "_shards": {"total": 2, "failed": self.shard_failures},
+                "hits": {"total": len(docs), "hits": hits}}
+
+    def __source(self, doc):
+        source = self.bodies[-1].get("_source", {})
+        includes = source.get("includes", source.get("include"))
+        if not includes:
+            return doc
+        return {key: value for key, value in doc.items() if key in {field.split(".")[0] for field in includes}}
+
+    def __aggregate(self, body):
+        composite = json.loads(body)["aggs"]["my_buckets"]["composite"]
+        field, after = next(iter(composite["after"].items()))
+        values = set()
+        for doc in self.docs:
+            value = doc
+            for key in field.split("."):
+                value = value.get(key, {})
+            values.add(value)
+        buckets = [{"key": {field: value}} for value in sorted(values) if value > after][:composite["size"]]
+        return {"aggregations": {"my_buckets": {"buckets": buckets}}}
+
+    def count(self, index, doc_type=None, body=None):
+        return {"count": len(self.docs)}
+
+    def search(self, index, body, scroll=None, size=None):
+        self.__fail()
+        if isinstance(body, str):
+            return self.__aggregate(body)
+        self.bodies.append(body)
+        slice = body.get("slice", {"id": 0, "max": 1})
+        docs = [doc for doc in self.docs if doc["n"] % slice["max"] == slice["id"]]
+        scroll_id = "scroll-{}".format(slice["id"])
+        self.scrolls[scroll_id] = (docs, size, 0)
+        return self.__page(scroll_id)
+
+    def scroll(self, scroll_id, scroll):
+        self.__fail()
+        return self.__page(scroll_id)
+
+    def clear_scroll(self, scroll_id, ignore):
+        self.cleared.append(scroll_id)
+
+
+def es_reader(monkeypatch, es, **params):
+    monkeypatch.setattr(getpass, "getpass", lambda prompt: "elastic")
+    params = dict({"host": "localhost:9200", "index": "logs", "page_size": 7, "retry_delay": 0}, **params)
+    reader = ESReader(params, {"user.name": "username"}, [])
+    reader.es = es
+    return reader
+
+
+def test_esreader_scroll(monkeypatch):
+    es = FakeElasticsearch([{"n": n} for n in range(20)])
+    reader = es_reader(monkeypatch, es)
+    hits = list(reader.get_data(["user.name"], [], include_all=True))
+    assert [hit.n for hit in hits] == list(range(20))
+    assert hits[0].meta["index"] == "logs"
+    assert "slice" not in es.bodies[0]
+    assert es.cleared == ["scroll-0"]
+
+
+def test_esreader_sliced_scroll(monkeypatch):
+    es = FakeElasticsearch([{"n": n} for n in range(100)])
+    reader = es_reader(monkeypatch, es, slices=4)
+    hits = list(reader.get_data(["user.name"], [], include_all=True))
+    assert sorted(hit.n for hit in hits) == list(range(100))
+    assert sorted(body["slice"]["id"] for body in es.bodies) == [0, 1, 2, 3]
+    assert sorted(es.cleared) == ["scroll-0", "scroll-1", "scroll-2", "scroll-3"]
+
+
+def test_esreader_retries(monkeypatch):
+    es = FakeElasticsearch([{"n": n} for n in range(20)],
+                           failures=[TransportError(429, "too_many_requests"),
+                                     ESConnectionError("N/A", "connection refused", None)])
+    reader = es_reader(monkeypatch, es, slices=2)
+    assert sorted(hit.n for hit in reader.get_data(["user.name"], [], include_all=True)) == list(range(20))
+
+
+def test_esreader_failures(monkeypatch):
+    es = FakeElasticsearch([{"n": n} for n in range(20)], failures=[TransportError(429, "too_many_requests")] * 3)
+    reader = es_reader(monkeypatch, es, max_retries=2)
+    with pytest.raises(ESReaderError, match="after 2 retries"):
+        list(reader.get_data(["user.name"], [], include_all=True))
+
+    es = FakeElasticsearch([{"n": n} for n in range(20)], failures=[TransportError(404, "search_context_missing")])
+    reader = es_reader(monkeypatch, es, slices=2)
+    with pytest.raises(ESReaderError):
+        list(reader.get_data(["user.name"], [], include_all=True))
+
+    reader = es_reader(monkeypatch, FakeElasticsearch([{"n": 1}], shard_failures=1))
+    with pytest.raises(ESReaderError, match="shards"):
+        list(reader.get_data(["user.name"], [], include_all=True))
+
+
+def test_esreader_mappings(monkeypatch):
+    docs = [{"n": n, "user": {"name": "user{}".format(n % 5)}, "host": {"name": "host{}".format(n % 3)}}
+            for n in range(20)]
+    monkeypatch.setattr(getpass, "getpass", lambda prompt: "elastic")
+    reader = ESReader({"host": "localhost:9200", "index": "logs", "mapping_concurrency": 2, "retry_delay": 0},
+                      {"user.name": "username", "host.name": "username", "n": None}, [])
+    reader.es = FakeElasticsearch(docs, failures=[TransportError(503, "unavailable")])
+    mappings = reader.create_mappings()
+    assert list(mappings) == ["user.name", "host.name", "n"]
+    assert mappings["user.name"] == {"user{}".format(n): None for n in range(5)}
+    assert mappings["host.name"] == {"host{}".format(n): None for n in range(3)}
+    assert mappings["n"] == {}
+
+
+def test_anonymizer_masks_fetched_values(monkeypatch):
+    docs = [{"n": n, "user": {"name": "user{}".format(n % 5)}} for n in range(20)]
+    reader = es_reader(monkeypatch, FakeElasticsearch(docs))
+    writer = MemoryWriter({})
+    assert Anonymizer(reader=reader, writer=writer).anonymize() == 20
+
+    masked = [json.loads(doc) for doc in writer.buffer[1::2]]
+    assert len({doc["user.name"] for doc in masked}) == 5
+    assert not {doc["user.name"] for doc in masked} & {"user{}".format(n) for n in range(5)}
+
+
+def write_files(tmp_path, files=5, docs=50):
+    for f in range(files):
+        with open(str(tmp_path / "{}.json".format(f)), "w") as out:
+            out.writelines(json.dumps({"file": f, "n": n}) + "\n" for n in range(docs))
+    return [{"file": f, "n": n} for f in range(files) for n in range(docs)]
+
+
+def test_jsonfilereader_processes(tmp_path):
+    docs = write_files(tmp_path)
+    params = {"filepath": str(tmp_path / "*.json"), "batch_size": 7}
+    assert list(JSONFileReader(params, {}, []).get_data([], [], True)) == docs
+
+    reader = JSONFileReader(dict(params, processes=3), {}, [])
+    metrics = Metrics()
+    assert list(reader.get_data([], [], True, metrics=metrics)) == docs
+    assert metrics.counters["bytes_read"] == sum(len(json.dumps(doc)) + 1 for doc in docs)
+    assert metrics.seconds["decode"] > 0
+
+    reader = JSONFileReader(dict(params, processes=3, ordered=False), {}, [])
+    unordered = list(reader.get_data([], [], True))
+    assert sorted(unordered, key=lambda doc: (doc["file"], doc["n"])) == docs
+    # batches of a file still arrive in order
+    assert [doc["n"] for doc in unordered if doc["file"] == 2] == list(range(50))
+
+
+def test_jsonfilereader_process_failures(tmp_path):
+    write_files(tmp_path)
+    (tmp_path / "2.json").unlink()
+    (tmp_path / "2.json").mkdir()
+    reader = JSONFileReader({"filepath": str(tmp_path / "*.json"), "processes": 2}, {}, [])
+    with pytest.raises(SourceError, match="2.json"):
+        list(reader.get_data([], [], True))
+
+
+def test_split_ranges(tmp_path):
+    path = tmp_path / "big.json"
+    docs = [{"n": n, "padding": "x" * (n % 13)} for n in range(300)]
+    path.write_text("".join(json.dumps(doc) + "\n" for doc in docs))
+    ranges = split_ranges(str(path), 1000)
+    assert len(ranges) > 5
+    assert ranges[0][0] == 0 and ranges[-1][1] == path.stat().st_size
+    data = path.read_bytes()
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert data[end - 1:end] == b"\n"
+
+    read = []
+    for byte_range in ranges:
+        reader = JSONFileReader({"filepath": str(path), "byte_range": byte_range}, {}, [])
+        read.extend(reader.get_data([], [], True))
+    assert read == docs
+
+    # a range is divided within its bounds, even one ending part way through a line
+    start, end = ranges[1][0], ranges[3][1] - 5
+    sub_ranges = split_ranges(str(path), end - start - 10, (start, end))
+    assert sub_ranges[0][0] == start and sub_ranges[-1][1] == end
+    assert all(range_end <= end for _, range_end in sub_ranges)
+
+    shards = JSONFileReader({"filepath": str(tmp_path / "*.json"), "split_size": 1000}, {}, []).get_shards()
+    assert [shard[0] for shard in shards] == ["0-{}".format(n) for n in range(len(ranges))]
+    assert [shard[2] for shard in shards] == ranges
+
+
+def test_jsonfilereader_marks(tmp_path):
+    docs = write_files(tmp_path, files=3, docs=10)
+    params = {"filepath": str(tmp_path / "*.json")}
+    marks = {}
+    assert list(JSONFileReader(params, {}, []).get_data([], [], True, marks=marks, mark_every=4)) == docs
+    assert sorted(marks) == [4, 8, 12, 16, 20, 24, 28]
+    for count in (8, 12, 20):
+        resumed = JSONFileReader(params, {}, []).get_data([], [], True, start=marks[count])
+        assert list(resumed) == docs[count:]
+
+    reader = JSONFileReader(dict(params, processes=2), {}, [])
+    with pytest.raises(SourceError):
+        list(reader.get_data([], [], True, marks={}, mark_every=4))
+
+
+def test_jsonfilereader_passthrough_drops_malformed(tmp_path):
+    path = tmp_path / "docs.json"
+    path.write_text('{"user": "alice", "n": 1}\n{"n": 2, "msg": "cut}\n{"n": 3}\n')
+    reader = JSONFileReader({"filepath": str(path)}, {"user": "username"}, [])
+    docs = list(reader.get_data([], [], True, passthrough=True))
+    # the line holding a masked field is decoded, the others are passed through, and the malformed one is dropped
+    assert docs == [{"user": "alice", "n": 1}, b'{"n": 3}']
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from anonymizers import LazyAnonymizer
+from readers import JSONFileReader
+from scrubbing import MessageScrubber, ScrubberError
+from writers import MemoryWriter
+
+
+def fake_masks():
+    masks = {}
+
+    def mask_value(mask_str, value):
+        return masks.setdefault((mask_str, value), "<{}{}>".format(mask_str, len(masks)))
+    return mask_value
+
+
+def test_scrubber_replaces_each_match():
+    scrubber = MessageScrubber(fake_masks())
+    message = "login from 10.0.0.1 by bob@example.com, then 10.0.0.2 and 10.0.0.1 for " \
+              "70a2484e-c83d-4f2d-9f7c-774104c5c6c4 via 2001:db8::1"
+    assert scrubber(message) == "login from <ipv40> by <email1>, then <ipv42> and <ipv40> for <uuid3> via <ip4>"
+
+
+def test_scrubber_ignores_lookalikes():
+    scrubber = MessageScrubber(fake_masks())
+    message = "[2020-08-17T15:18:15.805+00:00] mac ae:20:e9:9e:7c:35 version 1.2.3.4.5 at 300.1.1.1"
+    assert scrubber(message) == message
+    assert scrubber.stats()["matches"] == 0
+
+
+def test_scrubber_skips_messages_without_hints():
+    scrubber = MessageScrubber(fake_masks(), {"email": "email"})
+    assert scrubber("nothing to see here") == "nothing to see here"
+    assert scrubber(None) is None
+    assert scrubber.stats() == {"skipped": 1, "scrubbed": 0, "matches": 0}
+
+
+def test_scrubber_skips_timestamped_messages_without_candidates():
+    scrubber = MessageScrubber(fake_masks(), {"ipv6": "ip", "uuid": "uuid"})
+    message = "[2020-08-17T15:18:15.805+00:00] request-handler: completed in 12:03 - ok"
+    # the dashes and colons of the timestamp alone do not run the regex
+    assert scrubber(message) == message
+    assert scrubber.stats() == {"skipped": 1, "scrubbed": 0, "matches": 0}
+    assert scrubber.patterns == {}
+    assert scrubber("from ::1 for 70a2484e-c83d-4f2d-9f7c-774104c5c6c4 at 12:03") == "from <ip0> for <uuid1> at 12:03"
+    assert scrubber("via 2001:db8:0:0:0:0:2:1 and fe80::1ff:fe23:4567:890a") == "via <ip2> and <ip3>"
+
+
+def test_scrubber_optional_detectors():
+    scrubber = MessageScrubber(fake_masks(), {"username": "username", "hostname": "hostname"})
+    assert scrubber("user=alice connected to db1.example.com") == "user=<username0> connected to <hostname1>"
+
+
+def test_scrubber_unknown_detector():
+    with pytest.raises(ScrubberError):
+        MessageScrubber(fake_masks(), {"phone": "phone"})
+
+
+def test_anonymize_message():
+    reader = JSONFileReader({"filepath": "./resources/*.json"}, {
+        "source.ip": "ipv4",
+        "host.ip": "ipv4",
+        "message": "message",
+    }, [])
+    writer = MemoryWriter({})
+    anon = LazyAnonymizer(reader=reader, writer=writer)
+    anon.anonymize(include_rest=True)
+
+    docs = [json.loads(doc) for doc in writer.buffer]
+    assert "12.12.12.44" not in docs[0]["message"]
+    assert "12.112.13.32" not in docs[0]["message"]
+    assert docs[1]["host"]["ip"] != ["10.72.1.5"]
+    assert "for 10.72.1.3 at" not in docs[1]["message"]
+    assert docs[1]["message"].startswith("[2020-08-17T15:18:15.805+00:00][15][2356][app-server][INFO]: [")
+
+
+def test_anonymize_message_shares_masks(tmp_path):
+    path = tmp_path / "docs.json"
+    path.write_text(json.dumps({"source": {"ip": "1.2.3.4"}, "message": "denied 1.2.3.4 and 5.6.7.8"}) + "\n" +
+                    json.dumps({"source": {"ip": "5.6.7.8"}}) + "\n")
+    reader = JSONFileReader({"filepath": str(path)}, {"source.ip": "ipv4", "message": "message"}, [])
+    writer = MemoryWriter({})
+    LazyAnonymizer(reader=reader, writer=writer).anonymize(include_rest=True)
+
+    first, second = [json.loads(doc) for doc in writer.buffer]
+    assert first["message"] == "denied {} and {}".format(first["source"]["ip"], second["source"]["ip"])
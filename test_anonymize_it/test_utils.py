@@ -15,3 +15,35 @@ def test_flatten_nest():
     flattened = utils.flatten_nest(old)
     new = {"this.is.a.test": True}
     assert new == flattened
+
+
+def test_compile_field_plan():
+    plan = utils.compile_field_plan({
+        "source.ip": "ipv4",
+        "source.address": "ipv4",
+        "user.name": "username",
+        "@timestamp": None
+    }, {"user.name", "related.user"})
+
+    assert set(plan) == {"source", "user", "@timestamp", "related"}
+    assert not plan["source"].included
+    assert set(plan["source"].children) == {"ip", "address"}
+    assert plan["source"].children["ip"].included
+    assert plan["source"].children["ip"].mask_str == "ipv4"
+    assert plan["@timestamp"].included
+    assert plan["@timestamp"].mask_str is None
+    # excluded fields are never included
+    assert plan["user"].children["name"].excluded
+    assert not plan["user"].children["name"].included
+    assert plan["related"].children["user"].excluded
+
+
+def test_compile_key_filter():
+    key_filter = utils.compile_key_filter(["source.ip", "geo", "user.name"])
+
+    assert key_filter.search(b'{"source": {"ip": "10.0.0.1"}}')
+    assert key_filter.search(b'{"geo" : {"location": {}}}')
+    assert key_filter.search(b'{"user": {"name": "bob"}}')
+    assert not key_filter.search(b'{"message": "ip geo name", "host": {"hostname": "a"}}')
+    # keys could be written with unicode escapes, so these are never passed through
+    assert key_filter.search(b'{"\\u0069p": "10.0.0.1"}')
@@ -1,6 +1,23 @@
 from anonymize_it import writers
+import base64
+import gzip
+import http.server
 import json
 import os
+import threading
+import urllib.parse
+
+import pytest
+
+try:
+    import google_crc32c
+except ImportError:
+    # only clients that check uploads against a crc32c depend on it, older ones ignore the checksum
+    google_crc32c = None
+
+from anonymizers import Anonymizer, LazyAnonymizer
+from readers import JSONFileReader
+from test_anonymize_it.test_readers import FakeElasticsearch, es_reader
 
 
 def test_fswriter():
@@ -26,5 +43,323 @@ def test_fswriter():
     assert data == in_data
 
 
-def test_ESWriter():
-    pass
+def test_fswriter_compressed_parts(tmp_path):
+    writer = writers.FSWriter({"directory": str(tmp_path), "max_file_size": 1000,
+                               "compression": {"type": "gzip", "threads": 2, "block_size": 100}})
+    docs = [json.dumps({"n": n}) for n in range(200)]
+    writer.write_data(docs, file_name="output")
+    writer.close()
+
+    # 2090 bytes of documents, split after the first document taking a part to 1000 bytes
+    parts = ["output.json.gz", "output.part1.json.gz", "output.part2.json.gz"]
+    assert sorted(os.listdir(str(tmp_path))) == parts
+    lines = []
+    for part in parts:
+        with gzip.open(str(tmp_path / part), "rt") as f:
+            lines.extend(f.read().splitlines())
+    assert lines == docs
+
+
+class BulkHandler(http.server.BaseHTTPRequestHandler):
+    """a local stand-in for the elasticsearch endpoints the ESWriter uses"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('content-length', 0)))
+
+    def do_POST(self):
+        cluster = self.server.cluster
+        body = self.body()
+        if self.path.endswith('/_refresh'):
+            cluster["refreshed"].append(self.path.split('/')[1])
+            return self.respond(200, {})
+        with cluster["lock"]:
+            cluster["requests"] += 1
+            status = cluster["statuses"].pop(0) if cluster["statuses"] else 200
+            if status != 200:
+                error = {"type": "rejected_execution_exception", "reason": "rejected"}
+                return self.respond(status, {"error": dict(error, root_cause=[error]), "status": status})
+            item_statuses = cluster["item_statuses"]
+            lines = body.decode('utf-8').splitlines()
+            items = []
+            for action, source in zip(lines[::2], lines[1::2]):
+                item_status = item_statuses.pop(0) if item_statuses else 201
+                if item_status == 201:
+                    cluster["docs"].append((json.loads(action), json.loads(source)))
+                items.append({"index": {"status": item_status} if item_status == 201 else
+                              {"status": item_status, "error": {"type": "mapper_parsing_exception"}}})
+        self.respond(200, {"errors": any(item["index"]["status"] != 201 for item in items), "items": items})
+
+    def do_GET(self):
+        if self.server.cluster["settings"] is None:
+            error = {"type": "index_not_found_exception", "reason": "no such index"}
+            return self.respond(404, {"error": dict(error, root_cause=[error]), "status": 404})
+        self.respond(200, self.server.cluster["settings"])
+
+    def do_PUT(self):
+        self.server.cluster["puts"].append((self.path, json.loads(self.body())))
+        self.respond(200, {"acknowledged": True})
+
+
+@pytest.fixture
+def cluster():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BulkHandler)
+    server.cluster = {"lock": threading.Lock(), "requests": 0, "statuses": [], "item_statuses": [], "docs": [],
+                      "settings": None, "puts": [], "refreshed": [],
+                      "host": "127.0.0.1:{}".format(server.server_address[1])}
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server.cluster
+    server.shutdown()
+    server.server_close()
+
+
+def es_writer(cluster, **params):
+    return writers.ESWriter(dict({"host": cluster["host"], "username": "", "retry_delay": 0}, **params))
+
+
+def test_eswriter_bulk(cluster):
+    cluster["statuses"] = [429]
+    cluster["item_statuses"] = [429, 201, 400]
+    writer = es_writer(cluster, index="anonymized", concurrency=3, chunk_size=200)
+    docs = [json.dumps({"n": n}) for n in range(50)]
+    writer.prepare()
+    writer.write_data(docs)
+    writer.close()
+
+    assert cluster["requests"] > 3
+    # requests are sent concurrently, so which document was rejected depends on the order they arrive in
+    indexed = [source["n"] for _, source in cluster["docs"]]
+    assert len(indexed) == len(set(indexed)) == 49
+    assert {action["index"]["_index"] for action, _ in cluster["docs"]} == {"anonymized"}
+    assert writer.indexed == 49
+    assert writer.rejected == 1
+
+
+def test_eswriter_action_pairs(cluster):
+    writer = es_writer(cluster)
+    lines = []
+    for n in range(10):
+        lines.append(json.dumps({"index": {"_index": "logs-{}".format(n % 2), "_type": "doc"}}))
+        lines.append(json.dumps({"n": n}))
+    writer.write_data(lines)
+    assert sorted((action["index"]["_index"], source["n"]) for action, source in cluster["docs"]) == \
+        sorted(("logs-{}".format(n % 2), n) for n in range(10))
+
+    with pytest.raises(writers.ESWriterError):
+        writer.write_data(lines[:1])
+
+
+def test_eswriter_requires_index_without_actions(cluster, tmp_path):
+    es_writer(cluster).prepare(actions=True)
+    with pytest.raises(writers.ESWriterError, match="index is required"):
+        es_writer(cluster).prepare()
+
+    # the lazy anonymizer writes sources alone, so it fails before reading anything
+    path = tmp_path / "docs.json"
+    path.write_text(json.dumps({"n": 1}) + "\n")
+    reader = JSONFileReader({"filepath": str(path)}, {}, [])
+    with pytest.raises(writers.ESWriterError):
+        LazyAnonymizer(reader=reader, writer=es_writer(cluster)).anonymize(include_rest=True)
+    assert cluster["requests"] == 0
+
+
+def test_eswriter_replaces_actions_with_index(cluster, monkeypatch):
+    docs = [{"n": n, "user": {"name": "user{}".format(n % 5)}} for n in range(20)]
+    reader = es_reader(monkeypatch, FakeElasticsearch(docs))
+    writer = es_writer(cluster, index="anonymized")
+    assert Anonymizer(reader=reader, writer=writer).anonymize() == 20
+
+    # each action written by the anonymizer is replaced, rather than indexed as a document of its own
+    assert len(cluster["docs"]) == writer.indexed == 20
+    assert all(set(source) == {"user.name"} for _, source in cluster["docs"])
+    assert {action["index"]["_index"] for action, _ in cluster["docs"]} == {"anonymized"}
+
+
+def test_eswriter_failures(cluster):
+    cluster["statuses"] = [400]
+    writer = es_writer(cluster, index="anonymized")
+    with pytest.raises(writers.ESWriterError):
+        writer.write_data([json.dumps({"n": 1})])
+
+    cluster["statuses"] = [429, 429, 429]
+    writer = es_writer(cluster, index="anonymized", max_retries=2)
+    with pytest.raises(writers.ESWriterError, match="after 2 retries"):
+        writer.write_data([json.dumps({"n": 1})])
+
+
+def test_eswriter_pauses_refresh(cluster):
+    cluster["settings"] = {"anonymized": {"settings": {"index": {"refresh_interval": "30s"}}}}
+    writer = es_writer(cluster, index="anonymized", disable_refresh=True)
+    assert not writer.params["disable_refresh"]
+    writer.prepare()
+    writer.write_data([json.dumps({"n": 1})])
+    writer.close()
+    assert [body for _, body in cluster["puts"]] == [{"index": {"refresh_interval": "-1"}},
+                                                     {"index": {"refresh_interval": "30s"}}]
+    assert cluster["refreshed"] == ["anonymized"]
+
+
+class GCSHandler(http.server.BaseHTTPRequestHandler):
+    """a local stand-in for the parts of the GCS json api the GCSWriter uses"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=None, headers=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        for header, value in dict({'content-type': 'application/json'}, **(headers or {})).items():
+            self.send_header(header, value)
+        self.send_header('content-length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('content-length', 0)))
+
+    def store(self, name, data):
+        gcs = self.server.gcs
+        gcs["objects"][name] = data
+        resource = {"bucket": gcs["bucket"], "name": name, "size": str(len(data)),
+                    "contentType": "application/octet-stream"}
+        if google_crc32c:
+            resource["crc32c"] = base64.b64encode(google_crc32c.Checksum(data).digest()).decode('ascii')
+        return resource
+
+    def fail(self):
+        gcs = self.server.gcs
+        with gcs["lock"]:
+            gcs["requests"] += 1
+            status = gcs["statuses"].pop(0) if gcs["statuses"] else None
+        if status:
+            self.respond(status, {"error": {"code": status, "message": "injected failure"}})
+        return status
+
+    def do_GET(self):
+        self.respond(200, {"name": self.server.gcs["bucket"]})
+
+    def do_POST(self):
+        gcs = self.server.gcs
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        body = self.body()
+        if url.path.endswith('/compose'):
+            name = urllib.parse.unquote(url.path.split('/o/')[1][:-len('/compose')])
+            sources = [source["name"] for source in json.loads(body)["sourceObjects"]]
+            gcs["composes"].append(len(sources))
+            return self.respond(200, self.store(name, b"".join(gcs["objects"][source] for source in sources)))
+        if self.fail():
+            return
+        if query["uploadType"] == ["multipart"]:
+            boundary = self.headers['content-type'].split('boundary=')[1].strip('"').encode('ascii')
+            metadata, media = body.split(b'--' + boundary)[1:3]
+            name = json.loads(metadata.split(b'\r\n\r\n', 1)[1])["name"]
+            return self.respond(200, self.store(name, media.split(b'\r\n\r\n', 1)[1][:-2]))
+        upload = str(len(gcs["uploads"]))
+        gcs["uploads"][upload] = (json.loads(body)["name"], [])
+        self.respond(200, {}, {'location': 'http://{}/resumable/{}'.format(gcs["host"], upload)})
+
+    def do_PUT(self):
+        if self.fail():
+            return
+        gcs = self.server.gcs
+        name, chunks = gcs["uploads"][self.path.split('/')[-1]]
+        chunks.append(self.body())
+        # content-range is like bytes 0-262143/9241889, with a total of * while the size is unknown
+        end, total = self.headers['content-range'].split(' ')[1].split('-')[1].split('/')
+        if total == '*' or int(end) + 1 < int(total):
+            return self.respond(308, None, {'range': 'bytes=0-{}'.format(end)})
+        self.respond(200, self.store(name, b"".join(chunks)))
+
+    def do_DELETE(self):
+        name = urllib.parse.unquote(urllib.parse.urlparse(self.path).path.split('/o/')[1])
+        del self.server.gcs["objects"][name]
+        self.respond(204)
+
+
+@pytest.fixture
+def gcs():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), GCSHandler)
+    server.gcs = {"lock": threading.Lock(), "bucket": "anonymized", "objects": {}, "uploads": {}, "composes": [],
+                  "statuses": [], "requests": 0, "host": "127.0.0.1:{}".format(server.server_address[1])}
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server.gcs
+    server.shutdown()
+    server.server_close()
+
+
+def gcs_writer(gcs, **params):
+    return writers.GCSWriter(dict({"bucket": gcs["bucket"], "endpoint": "http://" + gcs["host"], "dir_pattern": "logs/",
+                                   "retry_delay": 0}, **params))
+
+
+def test_gcswriter_uploads(gcs):
+    gcs["statuses"] = [503]
+    writer = gcs_writer(gcs, upload_concurrency=3, max_file_size=1000)
+    docs = [json.dumps({"n": n}) for n in range(200)]
+    writer.prepare()
+    for i in range(3):
+        writer.write_data(docs, file_name="documents-{}".format(i))
+    writer.close()
+
+    assert sorted(gcs["objects"]) == sorted("logs/documents-{}{}".format(i, part)
+                                            for i in range(3) for part in ["", ".part1", ".part2"])
+    for i in range(3):
+        parts = ["logs/documents-{}{}".format(i, part) for part in ["", ".part1", ".part2"]]
+        assert b"\n".join(gcs["objects"][part] for part in parts).decode('utf-8').split("\n") == docs
+    assert writer.uploaded == 9
+    assert writer.retried == 1
+    # objects this small are sent in a single request, so no resumable upload was started
+    assert gcs["uploads"] == {}
+
+
+def test_gcswriter_resumable_upload(gcs):
+    gcs["statuses"] = [None, None, 503]
+    writer = gcs_writer(gcs, chunk_size=256 * 1024)
+    docs = [json.dumps({"n": n, "padding": "x" * 1000}) for n in range(9000)]
+    writer.write_data(docs, file_name="documents-0")
+    writer.close()
+
+    assert gcs["objects"]["logs/documents-0"].decode('utf-8').split("\n") == docs
+    # over 8MB, so the object was sent in 256KB chunks, and restarted after the failed chunk
+    assert len(gcs["uploads"]) == 2
+    assert writer.retried == 1
+
+
+def test_gcswriter_composes(gcs):
+    writer = gcs_writer(gcs, compose_size=100, compression={"type": "gzip", "block_size": 50})
+    docs = [json.dumps({"n": n}) for n in range(500)]
+    writer.write_data(docs, file_name="documents-0")
+    writer.close()
+
+    # 5390 bytes of documents in 50 components of about 100 bytes, composed 32 at a time and then into the object
+    assert list(gcs["objects"]) == ["logs/documents-0.gz"]
+    assert sorted(gcs["composes"]) == [2, 18, 32]
+    assert gzip.decompress(gcs["objects"]["logs/documents-0.gz"]).decode('utf-8').split("\n") == docs
+    assert writer.composed == 1
+
+
+def test_gcswriter_failures(gcs):
+    gcs["statuses"] = [403]
+    writer = gcs_writer(gcs)
+    writer.write_data([json.dumps({"n": 1})])
+    with pytest.raises(writers.GCSWriterError, match="upload of logs/"):
+        writer.close()
+
+    gcs["statuses"] = [503, 503, 503]
+    writer = gcs_writer(gcs, max_retries=2)
+    writer.write_data([json.dumps({"n": 1})])
+    with pytest.raises(writers.GCSWriterError, match="after 2 retries"):
+        writer.close()